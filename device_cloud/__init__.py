@@ -22,15 +22,46 @@ from logging import DEBUG as LOGDEBUG
 from logging import INFO as LOGINFO
 from logging import NOTSET as LOGNOTSET
 from logging import WARNING as LOGWARNING
+import sys
 
 from device_cloud._core.client import Client
+# AsyncClient requires asyncio from Python 3.5 on
+AsyncClient = None
+if sys.version_info >= (3, 5):
+    from device_cloud._core.async_client import AsyncClient
 from device_cloud._core.handler import status_string
 
+from device_cloud._core.constants import DEFAULT_ACTION_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_API_BURST
+from device_cloud._core.constants import DEFAULT_API_RATE
+from device_cloud._core.constants import DEFAULT_CHILD_MAILBOX_INTERVAL
 from device_cloud._core.constants import DEFAULT_CONFIG_DIR
 from device_cloud._core.constants import DEFAULT_CONFIG_FILE
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
+from device_cloud._core.constants import DEFAULT_LOG_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_LOG_RATE_INTERVAL
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
+from device_cloud._core.constants import DEFAULT_PUBLISH_COALESCE
+from device_cloud._core.constants import DEFAULT_PUBLISH_COMBINE
+from device_cloud._core.constants import DEFAULT_PUBLISH_LINGER
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_PAYLOAD
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_MAX_COUNT
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_MAX_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_STORE_COMMIT_COUNT
+from device_cloud._core.constants import DEFAULT_PUBLISH_STORE_MAX_SIZE
+from device_cloud._core.constants import DEFAULT_REPLY_EXPIRY
+from device_cloud._core.constants import DEFAULT_SEND_LINGER
+from device_cloud._core.constants import DEFAULT_TELEMETRY_AGGREGATE_PERCENTILES
+from device_cloud._core.constants import DEFAULT_TELEMETRY_AGGREGATE_STATS
+from device_cloud._core.constants import DEFAULT_TELEMETRY_AGGREGATE_WINDOW
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_THREAD_COUNT_MAX
+from device_cloud._core.constants import DEFAULT_THREAD_IDLE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_TRANSFER_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_WORK_WAIT_TARGET
 
 from device_cloud._core.constants import STATUS_SUCCESS
 from device_cloud._core.constants import STATUS_INVOKED
@@ -59,16 +90,41 @@ import device_cloud.relay
 import device_cloud.identity
 
 __all__ = ["Client",
+           "AsyncClient",
            "status_string",
            "osal"
            "ota_handler",
            "relay",
            "identity",
+           "DEFAULT_API_BURST",
+           "DEFAULT_API_RATE",
            "DEFAULT_CONFIG_DIR",
            "DEFAULT_CONFIG_FILE",
            "DEFAULT_KEEP_ALIVE",
+           "DEFAULT_LOG_MAX_BATCH",
+           "DEFAULT_LOG_RATE_INTERVAL",
            "DEFAULT_LOOP_TIME",
+           "DEFAULT_PUBLISH_COALESCE",
+           "DEFAULT_PUBLISH_COMBINE",
+           "DEFAULT_PUBLISH_LINGER",
+           "DEFAULT_PUBLISH_MAX_BATCH",
+           "DEFAULT_PUBLISH_MAX_PAYLOAD",
+           "DEFAULT_PUBLISH_QUEUE_MAX_COUNT",
+           "DEFAULT_PUBLISH_QUEUE_MAX_SIZE",
+           "DEFAULT_PUBLISH_QUEUE_POLICY",
+           "DEFAULT_PUBLISH_QUEUE_TIMEOUT",
+           "DEFAULT_PUBLISH_STORE_COMMIT_COUNT",
+           "DEFAULT_PUBLISH_STORE_MAX_SIZE",
+           "DEFAULT_REPLY_EXPIRY",
+           "DEFAULT_SEND_LINGER",
+           "DEFAULT_TELEMETRY_AGGREGATE_PERCENTILES",
+           "DEFAULT_TELEMETRY_AGGREGATE_STATS",
+           "DEFAULT_TELEMETRY_AGGREGATE_WINDOW",
            "DEFAULT_THREAD_COUNT",
+           "DEFAULT_THREAD_COUNT_MAX",
+           "DEFAULT_THREAD_IDLE_TIMEOUT",
+           "DEFAULT_TRANSFER_THREAD_COUNT",
+           "DEFAULT_WORK_WAIT_TARGET",
            "LOGCRITICAL",
            "LOGERROR",
            "LOGDEBUG",
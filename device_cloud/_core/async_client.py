@@ -0,0 +1,349 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the AsyncClient class for applications built on asyncio.
+It requires Python 3.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core import tr50
+from device_cloud._core.client import Client
+
+
+def _copy_result(source, dest):
+    """
+    Set the result of a done future, or the error it raised, on another
+    """
+
+    if source.cancelled():
+        dest.set_exception(concurrent.futures.CancelledError())
+        return
+    error = source.exception()
+    if error is not None:
+        dest.set_exception(error)
+    else:
+        dest.set_result(source.result())
+
+
+class AsyncAction(defs.Action):
+    """
+    Holds information associating an action and a coroutine function callback.
+    The coroutine runs on the event loop; the action is reported as invoked
+    straight away and acknowledged once the coroutine returns.
+    """
+
+    def __init__(self, name, callback, client, loop, user_data=None,
+                 thing_key=None):
+        super(AsyncAction, self).__init__(name, callback, client, user_data,
+                                          thing_key=thing_key)
+        self.loop = loop
+
+    def __str__(self):
+        return "Action {} --> Coroutine {}".format(
+            defs.action_key(self.name, self.thing_key), self.callback.__name__)
+
+    def execute(self, request):
+        """
+        Schedule the coroutine on the event loop, returning a future for its
+        result. The future is resolved on the Client's send thread, so that
+        acknowledging the action never blocks the event loop.
+        """
+
+        coroutine = super(AsyncAction, self).execute(request)
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        result = concurrent.futures.Future()
+        future.add_done_callback(lambda future: self.client.executor.submit(
+            _copy_result, future, result))
+        return result
+
+
+class AsyncClient(Client):
+    """
+    Client for applications built on asyncio. Calls that wait on the Cloud
+    return awaitables resolved when the reply is received, rather than
+    blocking a thread, and action callbacks can be coroutine functions.
+    Requests are sent, in order, from a thread of the Client's own, so that
+    waiting for the api_rate limit never blocks the event loop. Everything
+    else behaves as it does for Client.
+    """
+
+    def __init__(self, app_id, kwargs=None, offline=False, error_handler=None,
+                 loop=None):
+        """
+        Parameters:
+          loop        (asyncio loop) Event loop awaitables are resolved on, and
+                                     coroutine action callbacks run on.
+                                     Defaults to the running event loop, so
+                                     it is required unless the AsyncClient
+                                     is created from a coroutine.
+        """
+
+        super(AsyncClient, self).__init__(app_id, kwargs=kwargs,
+                                          offline=offline,
+                                          error_handler=error_handler)
+        if loop is None:
+            # get_running_loop is only available from Python 3.7 on
+            get_running_loop = getattr(asyncio, "get_running_loop",
+                                       asyncio.get_event_loop)
+            loop = get_running_loop()
+        self.loop = loop
+
+        # Single thread that sends requests and queues publishes in the order
+        # they were made
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _future(self, result=None, resolved=False):
+        """
+        Create a future on the event loop, optionally already resolved
+        """
+
+        future = self.loop.create_future()
+        if resolved:
+            future.set_result(result)
+        return future
+
+    def _resolve(self, future, result):
+        """
+        Resolve a future from any thread, unless it already is
+        """
+
+        def set_result():
+            if not future.done():
+                future.set_result(result)
+        self.loop.call_soon_threadsafe(set_result)
+
+    def _request_current(self, command, message_desc):
+        """
+        Send a request for a current value, returning a future resolved with
+        (status, value, timestamp)
+        """
+
+        future = self._future()
+
+        def request():
+            status, reply = self.handler.send_current(command, message_desc)
+            if status != constants.STATUS_SUCCESS:
+                self._resolve(future, (status, None, None))
+                return
+            reply.add_done_callback(lambda reply: self._resolve(
+                future, self.handler.current_result(reply)))
+        self.executor.submit(request)
+        self.loop.call_later(constants.REPLY_TIMEOUT, self._resolve, future,
+                             (constants.STATUS_TIMED_OUT, None, None))
+        return future
+
+    def _request_transfer(self, request, *args):
+        """
+        Request a file transfer, returning a future resolved with its status
+        """
+
+        future = self._future()
+
+        def request_transfer():
+            status = request(*args, on_done=lambda transfer: self._resolve(
+                future, transfer.status))
+            if status != constants.STATUS_SUCCESS:
+                self._resolve(future, status)
+        self.executor.submit(request_transfer)
+        return future
+
+    def action_register_callback(self, action_name, callback_function,
+                                 user_data=None, long_running=False,
+                                 thing_key=None):
+        """
+        Associate a callback function with an action in the Cloud. The
+        callback function can be a coroutine function, which is run on the
+        event loop; its return value is used as the result of the action.
+        See Client.action_register_callback.
+        """
+
+        if not asyncio.iscoroutinefunction(callback_function):
+            return super(AsyncClient, self).action_register_callback(
+                action_name, callback_function, user_data, long_running,
+                thing_key)
+        action = AsyncAction(action_name, callback_function, self, self.loop,
+                             user_data=user_data, thing_key=thing_key)
+        return self.handler.action_register(action)
+
+    def attribute_read_last_sample(self, attribute_name):
+        """
+        Read back last/current attribute sample from the Cloud
+
+        Returns:
+          Awaitable resolved with (status, value, timestamp)
+        """
+
+        command = tr50.create_attribute_current(self.config.key,
+                                                attribute_name)
+        return self._request_current(command, "Reading current attribute...")
+
+    def connect(self, timeout=0):
+        """
+        Connect the Client to the Cloud without blocking the event loop
+
+        Returns:
+          Awaitable resolved with the status of Client.connect
+        """
+
+        return self.loop.run_in_executor(
+            None, super(AsyncClient, self).connect, timeout)
+
+    def disconnect(self, wait_for_replies=False, timeout=0):
+        """
+        End Client connection to the Cloud without blocking the event loop
+
+        Returns:
+          Awaitable resolved with the status of Client.disconnect
+        """
+
+        def disconnect():
+            try:
+                return super(AsyncClient, self).disconnect(wait_for_replies,
+                                                           timeout)
+            finally:
+                # Let the send thread exit. Its replacement only starts a
+                # thread once it is used again, after reconnecting.
+                executor = self.executor
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1)
+                executor.shutdown(wait=False)
+        return self.loop.run_in_executor(None, disconnect)
+
+    def file_download(self, file_name, download_dest, callback=None,
+                      file_global=False):
+        """
+        Download a file from the Cloud to the device (C2D)
+
+        Parameters:
+          file_name           (string) File in Cloud to download
+          download_dest       (string) Destination for downloaded file
+          callback              (func) Function to be executed as soon as file
+                                       transfer is complete. It will be passed
+                                       (client, file_name, status).
+          file_global                  Flag that indicates whether or not the
+                                       file to download is in the global file
+                                       store or the thing's file store
+
+        Returns:
+          Awaitable resolved with the status of the file transfer
+        """
+
+        return self._request_transfer(self.handler.request_download,
+                                      file_name, download_dest, False,
+                                      callback, 0, file_global)
+
+    def file_upload(self, file_path, upload_name=None, callback=None,
+                    file_global=False):
+        """
+        Upload a file, or every file in a directory, from the device to the
+        Cloud (D2C)
+
+        Parameters:
+          file_path           (string) Absolute path for file to upload.
+          upload_name         (string) Name for file uploaded in Cloud.
+                                       Default is the file name on the device.
+          callback              (func) Function to be executed as soon as file
+                                       transfer is complete. It will be passed
+                                       (client, file_name, status).
+          file_global                  Flag that indicates whether or not the
+                                       file should be uploaded to the global
+                                       file store or the thing's file store
+
+        Returns:
+          Awaitable resolved with the status of the file transfer, or the
+          highest status of the files in a directory
+        """
+
+        if self.offline:
+            return self._future(None, resolved=True)
+        if not os.path.isdir(file_path):
+            return self._request_transfer(self.handler.request_upload,
+                                          file_path, upload_name, False,
+                                          callback, 0, file_global)
+
+        transfers = [self._request_transfer(self.handler.request_upload,
+                                            os.path.join(file_path, name),
+                                            name, False, callback, 0,
+                                            file_global)
+                     for name in os.listdir(file_path)]
+        if not transfers:
+            return self._future(constants.STATUS_NOT_FOUND, resolved=True)
+        future = self._future()
+
+        def set_status(gathered):
+            if future.done():
+                return
+            if gathered.cancelled():
+                future.cancel()
+            elif gathered.exception():
+                future.set_exception(gathered.exception())
+            else:
+                future.set_result(max(gathered.result()))
+        asyncio.gather(*transfers).add_done_callback(set_status)
+        return future
+
+    def telemetry_publish(self, telemetry_name, value, cloud_response=False,
+                          timestamp=None, corr_id=None, aggregate=False,
+                          thing_key=None):
+        """
+        Publish telemetry to the Cloud. See Client.telemetry_publish.
+
+        Returns:
+          Awaitable resolved with the status. With cloud_response, it is
+          resolved once the Cloud replies.
+        """
+
+        if not cloud_response or aggregate:
+            # Queuing a publish can wait for room with the block
+            # publish_queue_policy
+            return self.loop.run_in_executor(self.executor, functools.partial(
+                super(AsyncClient, self).telemetry_publish, telemetry_name,
+                value, timestamp=timestamp, corr_id=corr_id,
+                aggregate=aggregate, thing_key=thing_key))
+        if not thing_key and \
+           not self.handler.filter_telemetry(telemetry_name, value):
+            return self._future(constants.STATUS_SUCCESS, resolved=True)
+
+        future = self._future()
+        telem = defs.PublishTelemetry(telemetry_name, value, timestamp,
+                                      corr_id)
+        telem.thing_key = thing_key
+        telem.future = defs.ReplyFuture()
+
+        def publish():
+            status = self.handler.queue_publish(telem)
+            telem.future.add_done_callback(lambda reply: self._resolve(
+                future, self.handler.publish_status(reply, status)))
+        self.executor.submit(publish)
+        self.loop.call_later(constants.REPLY_TIMEOUT, self._resolve, future,
+                             constants.STATUS_TIMED_OUT)
+        return future
+
+    def telemetry_read_last_sample(self, telemetry_name):
+        """
+        Read back last/current telemetry sample from the Cloud
+
+        Returns:
+          Awaitable resolved with (status, value, timestamp)
+        """
+
+        command = tr50.create_property_get_current(self.config.key,
+                                                   telemetry_name)
+        return self._request_current(command, "Reading current property...")
@@ -20,13 +20,39 @@ import json
 import os
 import uuid
 
+from device_cloud._core.constants import DEFAULT_ACTION_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_API_BURST
+from device_cloud._core.constants import DEFAULT_API_RATE
+from device_cloud._core.constants import DEFAULT_CHILD_MAILBOX_INTERVAL
 from device_cloud._core.constants import DEFAULT_CONFIG_DIR
 from device_cloud._core.constants import DEFAULT_CONFIG_FILE
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
+from device_cloud._core.constants import DEFAULT_LOG_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_LOG_RATE_INTERVAL
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
+from device_cloud._core.constants import DEFAULT_PUBLISH_COALESCE
+from device_cloud._core.constants import DEFAULT_PUBLISH_COMBINE
+from device_cloud._core.constants import DEFAULT_PUBLISH_LINGER
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_PAYLOAD
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_MAX_COUNT
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_MAX_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_STORE_COMMIT_COUNT
+from device_cloud._core.constants import DEFAULT_PUBLISH_STORE_MAX_SIZE
+from device_cloud._core.constants import DEFAULT_REPLY_EXPIRY
+from device_cloud._core.constants import DEFAULT_SEND_LINGER
+from device_cloud._core.constants import DEFAULT_TELEMETRY_AGGREGATE_PERCENTILES
+from device_cloud._core.constants import DEFAULT_TELEMETRY_AGGREGATE_STATS
+from device_cloud._core.constants import DEFAULT_TELEMETRY_AGGREGATE_WINDOW
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_THREAD_COUNT_MAX
+from device_cloud._core.constants import DEFAULT_THREAD_IDLE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_TRANSFER_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_WORK_WAIT_TARGET
+from device_cloud._core.constants import STATUS_BAD_PARAMETER
 from device_cloud._core.constants import STATUS_SUCCESS
-from device_cloud._core.constants import WORK_PUBLISH
 from device_cloud._core.constants import STATUS_NOT_FOUND
 from device_cloud._core.constants import TIME_FORMAT
 from device_cloud._core import defs
@@ -90,8 +116,8 @@ class Client(object):
 
         self.database = None
 
-        # Add sleep for idle loop
-        # default is 0.1
+        # Deprecated. Outgoing requests are now limited by the api_rate and
+        # api_burst configuration.
         self.idle_sleep = 0.1
 
         # Client notification handler for reply errors
@@ -184,6 +210,33 @@ class Client(object):
             "keep_alive":DEFAULT_KEEP_ALIVE,
             "loop_time":DEFAULT_LOOP_TIME,
             "thread_count":DEFAULT_THREAD_COUNT,
+            "thread_count_max":DEFAULT_THREAD_COUNT_MAX,
+            "thread_idle_timeout":DEFAULT_THREAD_IDLE_TIMEOUT,
+            "transfer_thread_count":DEFAULT_TRANSFER_THREAD_COUNT,
+            "action_thread_count":DEFAULT_ACTION_THREAD_COUNT,
+            "work_wait_target":DEFAULT_WORK_WAIT_TARGET,
+            "api_rate":DEFAULT_API_RATE,
+            "api_burst":DEFAULT_API_BURST,
+            "child_mailbox_interval":DEFAULT_CHILD_MAILBOX_INTERVAL,
+            "log_max_batch":DEFAULT_LOG_MAX_BATCH,
+            "log_rate_interval":DEFAULT_LOG_RATE_INTERVAL,
+            "publish_coalesce":DEFAULT_PUBLISH_COALESCE,
+            "publish_combine":DEFAULT_PUBLISH_COMBINE,
+            "publish_max_payload":DEFAULT_PUBLISH_MAX_PAYLOAD,
+            "publish_linger":DEFAULT_PUBLISH_LINGER,
+            "publish_max_batch":DEFAULT_PUBLISH_MAX_BATCH,
+            "publish_queue_max_count":DEFAULT_PUBLISH_QUEUE_MAX_COUNT,
+            "publish_queue_max_size":DEFAULT_PUBLISH_QUEUE_MAX_SIZE,
+            "publish_queue_policy":DEFAULT_PUBLISH_QUEUE_POLICY,
+            "publish_queue_timeout":DEFAULT_PUBLISH_QUEUE_TIMEOUT,
+            "publish_store_max_size":DEFAULT_PUBLISH_STORE_MAX_SIZE,
+            "publish_store_commit_count":DEFAULT_PUBLISH_STORE_COMMIT_COUNT,
+            "reply_expiry":DEFAULT_REPLY_EXPIRY,
+            "send_linger":DEFAULT_SEND_LINGER,
+            "telemetry_aggregate_window":DEFAULT_TELEMETRY_AGGREGATE_WINDOW,
+            "telemetry_aggregate_stats":DEFAULT_TELEMETRY_AGGREGATE_STATS,
+            "telemetry_aggregate_percentiles":
+                DEFAULT_TELEMETRY_AGGREGATE_PERCENTILES,
             "ca_bundle_file":certifi.where()
         }
         self.config.update(config_defaults, False)
@@ -248,22 +301,25 @@ class Client(object):
         return ret
 
 
-    def action_deregister(self, action_name):
+    def action_deregister(self, action_name, thing_key=None):
         """
         Dissociates a Cloud action action from any command or callback
 
         Parameters:
           action_name         (string) Action to deregister
+          thing_key           (string) Optional key of the child device the
+                                       action was registered for
 
         Returns:
           STATUS_NOT_FOUND             No action with that name registered
           STATUS_SUCCESS               Action deregistered
         """
 
-        return self.handler.action_deregister(action_name)
+        return self.handler.action_deregister(action_name, thing_key)
 
     def action_register_callback(self, action_name, callback_function,
-                                 user_data=None):
+                                 user_data=None, long_running=False,
+                                 thing_key=None):
         """
         Associate a callback function with an action in the Cloud
 
@@ -278,6 +334,15 @@ class Client(object):
                                        The callback function must also return
                                        status_code, or (status_code,
                                        status_message) in a tuple.
+          long_running          (bool) Execute the action on the worker
+                                       threads for long running actions, so
+                                       that it does not hold up other work
+          thing_key           (string) Optional key of a child device to
+                                       register the action for in gateway
+                                       mode. Actions registered without one
+                                       also handle requests for children that
+                                       have no action of that name, with
+                                       action_request.thing_key set.
 
         Returns:
           STATUS_EXISTS                Action with that name already exists
@@ -285,9 +350,11 @@ class Client(object):
         """
         return self.handler.action_register_callback(action_name,
                                                      callback_function,
-                                                     user_data)
+                                                     user_data, long_running,
+                                                     thing_key)
 
-    def action_register_command(self, action_name, command):
+    def action_register_command(self, action_name, command,
+                                long_running=False, thing_key=None):
         """
         Associate a console command with an action in the Cloud
 
@@ -295,14 +362,21 @@ class Client(object):
           action_name         (string) Action to register
           command             (string) Console command to execute when
                                        triggered by action
+          long_running          (bool) Execute the action on the worker
+                                       threads for long running actions, so
+                                       that it does not hold up other work
+          thing_key           (string) Optional key of a child device to
+                                       register the action for in gateway mode
         Returns:
           STATUS_EXISTS                Action with that name already exists
           STATUS_SUCCESS               Successfully registered command
         """
 
-        return self.handler.action_register_command(action_name, command)
+        return self.handler.action_register_command(action_name, command,
+                                                    long_running, thing_key)
 
-    def alarm_publish(self, alarm_name, state, message=None, republish=False):
+    def alarm_publish(self, alarm_name, state, message=None, republish=False,
+                      thing_key=None):
         """
         Publish an alarm to the Cloud
 
@@ -310,34 +384,95 @@ class Client(object):
           alarm_name          (string) Name of alarm to publish
           state                  (int) State of publish
           message             (string) Optional message to accompany alarm
+          thing_key           (string) Optional key of the child device to
+                                       publish for in gateway mode
 
         Returns:
           STATUS_SUCCESS               Alarm has been queued for publishing
+          STATUS_FULL                  Publish queue is full and pending
+                                       publishes were dropped
         """
 
         ret = None
         if not self.offline:
             alarm = defs.PublishAlarm(alarm_name, state, message, republish)
-            self.handler.queue_publish(alarm)
-            work = defs.Work(WORK_PUBLISH, None)
-            ret =  self.handler.queue_work(work)
+            alarm.thing_key = thing_key
+            ret = self.handler.queue_publish(alarm)
+            status = self.handler.schedule_publish()
+            if ret == STATUS_SUCCESS:
+                ret = status
         return ret
 
-    def attribute_publish(self, attribute_name, value):
+    def attribute_publish(self, attribute_name, value, thing_key=None):
         """
         Publish string telemetry to the Cloud
 
         Parameters:
           attribute_name      (string) Key of the attribute to publish
           value               (string) Value to publish
+          thing_key           (string) Optional key of the child device to
+                                       publish for in gateway mode
 
         Returns:
           STATUS_SUCCESS               Attribute has been queued for publishing
+          STATUS_FULL                  Publish queue is full and pending
+                                       publishes were dropped
         """
 
         attr = defs.PublishAttribute(attribute_name, value)
+        attr.thing_key = thing_key
         return self.handler.queue_publish(attr)
 
+    def child_deregister(self, thing_key):
+        """
+        Stop receiving actions for a child device in gateway mode. Actions
+        registered for it stay registered.
+
+        Parameters:
+          thing_key           (string) Key of the child device
+
+        Returns:
+          STATUS_NOT_FOUND             Child device not registered
+          STATUS_SUCCESS               Child device deregistered
+        """
+
+        return self.handler.child_deregister(thing_key)
+
+    def child_register(self, thing_key):
+        """
+        Receive actions for a child device in gateway mode. Its mailbox is
+        checked along with the Client's own, and its action requests are
+        passed to the actions registered for it, or otherwise to those of
+        the same name registered without a thing key. Registering an action
+        with a thing key registers the child device as well.
+
+        Parameters:
+          thing_key           (string) Key of the child device
+
+        Returns:
+          STATUS_EXISTS                Child device already registered
+          STATUS_SUCCESS               Child device registered
+        """
+
+        return self.handler.child_register(thing_key)
+
+    def command_send(self, command, params=None):
+        """
+        Send a TR50 command the Client has no dedicated method for, such as
+        thing.find or diag.echo. Its reply is passed to the callback registered
+        with reply_register_callback.
+
+        Parameters:
+          command             (string) TR50 command to send
+          params                (dict) Optional parameters of the command
+
+        Returns:
+          STATUS_FULL                  Too many requests waiting for replies
+          STATUS_SUCCESS               Command has been sent
+        """
+
+        return self.handler.request_command(command, params)
+
     def connect(self, timeout=0):
         """
         Connect the Client to the Cloud
@@ -397,19 +532,28 @@ class Client(object):
         """
         return self.handler.log_level(level)
 
-    def event_publish(self, message):
+    def event_publish(self, message, thing_key=None):
         """
         Publishes an event message to the Cloud
 
         Parameters:
           message             (string) Message to publish
+          thing_key           (string) Optional key of the child device to
+                                       publish for in gateway mode.
+                                       log_rate_interval is not applied.
 
         Returns:
-          STATUS_SUCCESS               Event has been queued for publishing
+          STATUS_SUCCESS               Event has been queued for publishing,
+                                       or was dropped by log_rate_interval
         """
         ret = None
         if not self.offline:
+            if not thing_key:
+                message = self.handler.filter_log(message)
+                if message is None:
+                    return STATUS_SUCCESS
             log = defs.PublishLog(message)
+            log.thing_key = thing_key
             ret = self.handler.queue_publish(log)
         return ret
 
@@ -511,7 +655,8 @@ class Client(object):
         return self.handler.is_connected()
 
     def location_publish(self, latitude, longitude, heading=None, altitude=None,
-                         speed=None, accuracy=None, fix_type=None):
+                         speed=None, accuracy=None, fix_type=None,
+                         thing_key=None):
         """
         Publish a location metric to the Cloud
 
@@ -523,6 +668,8 @@ class Client(object):
           speed               (number) Speed
           accuracy            (number) Accuracy of fix
           fix_type            (string) Fix type
+          thing_key           (string) Optional key of the child device to
+                                       publish for in gateway mode
 
         Returns:
           STATUS_SUCCESS               Location has been queued for publishing
@@ -531,10 +678,49 @@ class Client(object):
         location = defs.PublishLocation(latitude, longitude, heading=heading,
                                         altitude=altitude, speed=speed,
                                         accuracy=accuracy, fix_type=fix_type)
+        location.thing_key = thing_key
         return self.handler.queue_publish(location)
 
+    def reply_deregister(self, command):
+        """
+        Dissociates replies to a TR50 command from their callback
+
+        Parameters:
+          command             (string) TR50 command to deregister
+
+        Returns:
+          STATUS_NOT_FOUND             No callback registered for the command
+          STATUS_SUCCESS               Callback deregistered
+        """
+
+        return self.handler.reply_deregister(command)
+
+    def reply_register_callback(self, command, callback_function,
+                                user_data=None):
+        """
+        Associate a callback function with replies to a TR50 command sent with
+        command_send
+
+        Parameters:
+          command             (string) TR50 command, such as "thing.find"
+          callback_function     (func) Function to execute when a reply to the
+                                       command is received. Callback function
+                                       must take parameters of the form
+                                       (client, reply, user_data) where reply
+                                       is the Cloud's reply as a dict.
+
+        Returns:
+          STATUS_EXISTS                Replies to the command are already
+                                       handled
+          STATUS_SUCCESS               Successfully registered callback
+        """
+
+        return self.handler.reply_register_callback(command,
+                                                    callback_function,
+                                                    user_data)
+
     def telemetry_publish(self, telemetry_name, value, cloud_response=False,
-             timestamp=None, corr_id=None, aggregate=False):
+             timestamp=None, corr_id=None, aggregate=False, thing_key=None):
         """
         Publish telemetry to the Cloud
 
@@ -547,11 +733,143 @@ class Client(object):
                                      the return status is if it was queued.
           timestamp           (string) Optional datetime format timestamp to
                                        override the timestamp applied by the API
+          aggregate           (bool/number) Add the value to an aggregation
+                                       window for this key instead of
+                                       publishing it. When the window ends,
+                                       its statistics are published as
+                                       <telemetry_name>.<statistic>. A number
+                                       sets the window length in seconds,
+                                       otherwise telemetry_aggregate_window
+                                       is used.
+          thing_key           (string) Optional key of the child device to
+                                       publish for in gateway mode. Telemetry
+                                       filters and aggregation are not
+                                       applied.
         Returns:
-          STATUS_SUCCESS             Telemetry has been queued for publishing
+          STATUS_SUCCESS             Telemetry has been queued for publishing,
+                                     or was dropped by its telemetry filter
+          STATUS_BAD_PARAMETER       Aggregated value is not a number, or
+                                     aggregate was set with thing_key
+          STATUS_FULL                Publish queue is full and pending
+                                     publishes were dropped
+        """
+
+        if thing_key:
+            if aggregate:
+                self.error("Telemetry for child devices cannot be aggregated")
+                return STATUS_BAD_PARAMETER
+            telem = defs.PublishTelemetry(telemetry_name, value, timestamp,
+                                          corr_id)
+            telem.thing_key = thing_key
+            return self.handler.request_publish(telem, cloud_response)
+        if aggregate:
+            return self.handler.aggregate_telemetry(telemetry_name, value,
+                                                    aggregate)
+        if not self.handler.filter_telemetry(telemetry_name, value):
+            return STATUS_SUCCESS
+        telem = defs.PublishTelemetry(telemetry_name, value, timestamp, corr_id, aggregate)
+        return self.handler.request_publish(telem, cloud_response)
+
+    def telemetry_filter_deregister(self, telemetry_name):
         """
+        Stop filtering samples of a telemetry key
 
-        telem = defs.PublishTelemetry(telemetry_name, value, timestamp, corr_id, aggregate)
+        Parameters:
+          telemetry_name      (string) Key of property
+
+        Returns:
+          STATUS_NOT_FOUND             No filter registered for that key
+          STATUS_SUCCESS               Filter removed
+        """
+
+        return self.handler.telemetry_filter_deregister(telemetry_name)
+
+    def telemetry_filter_register(self, telemetry_name, deadband=0,
+                                  deadband_percent=0, min_interval=0,
+                                  max_interval=0):
+        """
+        Only publish samples of a telemetry key that are meaningful changes.
+        Samples within every set deadband of the last published value, or less
+        than min_interval seconds after it, are dropped by telemetry_publish.
+        With no deadbands set, only changed values are published.
+
+        Parameters:
+          telemetry_name      (string) Key of property
+          deadband            (number) Absolute change required to publish
+          deadband_percent    (number) Change, as a percentage of the last
+                                       published value, required to publish
+          min_interval        (number) Minimum seconds between publishes
+          max_interval        (number) Republish the latest sample after this
+                                       many seconds without a publish, so the
+                                       Cloud still sees the device is alive.
+                                       0 means never.
+
+        Returns:
+          STATUS_BAD_PARAMETER         A setting is negative
+          STATUS_SUCCESS               Filter registered
+        """
+
+        return self.handler.telemetry_filter_register(telemetry_name,
+                                                      deadband,
+                                                      deadband_percent,
+                                                      min_interval,
+                                                      max_interval)
+
+    def telemetry_publish_many(self, telemetry_name, values, timestamps=None,
+                               cloud_response=False, corr_id=None,
+                               thing_key=None, sample_interval=None):
+        """
+        Publish a block of telemetry samples for one key to the Cloud. The
+        block is queued as a single publish and sent in one property batch.
+        Telemetry filters and aggregation are not applied.
+
+        Parameters:
+          telemetry_name      (string) Key of property to publish
+          values              (sequence) Values to publish. NumPy arrays are
+                                         accepted.
+          timestamps          (sequence) Optional timestamp for each value,
+                                         as datetimes, formatted strings or
+                                         seconds since the epoch
+          cloud_response      (bool) Wait for response from cloud
+          corr_id             (string) Optional correlation id for every value
+          thing_key           (string) Optional key of the child device to
+                                       publish for in gateway mode
+          sample_interval     (float) Seconds between samples, used instead of
+                                      timestamps. The last value gets the
+                                      current time. Timestamps have millisecond
+                                      resolution.
+        Returns:
+          STATUS_SUCCESS             Telemetry has been queued for publishing
+          STATUS_BAD_PARAMETER       values and timestamps lengths differ, or
+                                     several values have neither timestamps
+                                     nor a sample_interval
+          STATUS_FULL                Publish queue is full and pending
+                                     publishes were dropped
+        """
+
+        # NumPy arrays convert to lists of plain Python numbers
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+        if hasattr(timestamps, "tolist"):
+            timestamps = timestamps.tolist()
+        values = list(values)
+        if not values:
+            return STATUS_SUCCESS
+        if timestamps is not None:
+            timestamps = list(timestamps)
+            if len(timestamps) != len(values):
+                self.error("telemetry_publish_many got %d values and %d "
+                           "timestamps", len(values), len(timestamps))
+                return STATUS_BAD_PARAMETER
+        elif len(values) > 1 and not sample_interval:
+            # Samples with the same key and timestamp overwrite each other
+            self.error("telemetry_publish_many needs timestamps or a "
+                       "sample_interval for %d values", len(values))
+            return STATUS_BAD_PARAMETER
+
+        telem = defs.PublishTelemetryBatch(telemetry_name, values, timestamps,
+                                           corr_id, sample_interval or 0)
+        telem.thing_key = thing_key
         return self.handler.request_publish(telem, cloud_response)
 
     def telemetry_read_last_sample(self, telemetry_name):
@@ -607,3 +925,19 @@ class Client(object):
 
         return self.handler.handle_update_thing_details(name, description,
                                     iccid, esn, imei, meid, imsi, unset_fields)
+
+    def work_status(self):
+        """
+        Report on the worker threads handling replies, actions and publishes
+
+        Returns:
+          dict with:
+            workers              (int) Number of worker threads
+            queued               (int) Amount of pending work
+            queue_wait        (number) Seconds the oldest pending work has
+                                       been waiting
+            last_wait         (number) Seconds the most recently started work
+                                       waited
+        """
+
+        return self.handler.work_status()
@@ -0,0 +1,76 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the JSON codec used for messages sent to and received from
+the Cloud. A faster JSON library is used when one is installed, otherwise the
+standard json module.
+"""
+
+import json
+
+# orjson and ujson are optional modules. ujson before 2.0 rounds floats, so it
+# is only used from 2.0 on.
+orjson = None
+ujson = None
+try:
+    import orjson
+except ImportError:
+    try:
+        import ujson
+        if int(ujson.__version__.split(".")[0]) < 2:
+            ujson = None
+    except (ImportError, AttributeError, ValueError):
+        ujson = None
+
+if orjson:
+    NAME = "orjson"
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+elif ujson:
+    NAME = "ujson"
+else:
+    NAME = "json"
+
+
+def dumps(obj):
+    """
+    Encode an object as compact JSON bytes
+    """
+
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=ORJSON_OPTIONS)
+        except TypeError:
+            # Fall back for anything orjson cannot encode, such as integers
+            # larger than 64 bits
+            pass
+    elif ujson:
+        return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    data = json.dumps(obj, separators=(",", ":"))
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return data
+
+def loads(data):
+    """
+    Decode JSON from bytes or a string
+    """
+
+    if orjson:
+        return orjson.loads(data)
+    if ujson:
+        return ujson.loads(data)
+    if isinstance(data, bytes) and not isinstance(data, str):
+        data = data.decode("utf-8")
+    return json.loads(data)
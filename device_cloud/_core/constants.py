@@ -27,8 +27,121 @@ DEFAULT_CONFIG_FILE = "{}-connect.cfg"
 DEFAULT_KEEP_ALIVE = 0
 # Default loop time for MQTT in seconds
 DEFAULT_LOOP_TIME = 1
-# Default number of worker threads
+# Default number of worker threads, and the fewest kept when the number of
+# worker threads adapts to the work
 DEFAULT_THREAD_COUNT = 3
+# Default most worker threads started when work waits longer than
+# work_wait_target
+# 0 means the number of worker threads is fixed at thread_count
+DEFAULT_THREAD_COUNT_MAX = 0
+# Default number of seconds an extra worker thread is idle before it stops
+DEFAULT_THREAD_IDLE_TIMEOUT = 60
+# Default number of worker threads for file transfers
+# 0 means they share the other worker threads at the lowest priority
+DEFAULT_TRANSFER_THREAD_COUNT = 1
+# Default number of worker threads for actions registered with long_running
+# 0 means they share the other worker threads
+DEFAULT_ACTION_THREAD_COUNT = 1
+# Default sustained rate of requests sent to the Cloud per second
+# 0 means no limit
+DEFAULT_API_RATE = 10
+# Default number of requests that can be sent at once before being limited to
+# the sustained rate
+DEFAULT_API_BURST = 10
+# Default for packing all pending publishes into a single request per flush
+DEFAULT_PUBLISH_COMBINE = False
+# Default for only sending the latest value of each attribute and alarm state
+# transitions per flush
+DEFAULT_PUBLISH_COALESCE = False
+# Default maximum size in bytes of a combined publish request
+# 0 means no limit
+DEFAULT_PUBLISH_MAX_PAYLOAD = 0
+# Default number of seconds pending publishes wait to be batched before they
+# are flushed
+DEFAULT_PUBLISH_LINGER = 0
+# Default maximum number of event logs sent in one request
+# 0 means no limit
+DEFAULT_LOG_MAX_BATCH = 0
+# Default number of seconds an event with the same text is not published again
+# 0 means no limit
+DEFAULT_LOG_RATE_INTERVAL = 0
+# Default number of seconds action acknowledgements, progress updates and
+# thing updates wait to be combined into one request before they are sent
+DEFAULT_SEND_LINGER = 0
+# Default number of seconds between checks of the mailboxes of child devices
+# for actions. They are also checked on connecting.
+# 0 means they are only checked on connecting and when registered
+DEFAULT_CHILD_MAILBOX_INTERVAL = 30
+# Default number of seconds work can wait in the work queue before another
+# worker thread is started
+DEFAULT_WORK_WAIT_TARGET = 0.5
+# Default number of seconds to wait for a reply to a sent message before it is
+# given up on
+# 0 means wait forever
+DEFAULT_REPLY_EXPIRY = 60
+# Default maximum number of pending publishes flushed at once
+# 0 means no limit
+DEFAULT_PUBLISH_MAX_BATCH = 0
+# Default maximum number of pending publishes kept in memory
+# 0 means no limit
+DEFAULT_PUBLISH_QUEUE_MAX_COUNT = 0
+# Default maximum size in bytes of pending publishes kept in memory
+# 0 means no limit
+DEFAULT_PUBLISH_QUEUE_MAX_SIZE = 0
+# Default policy for publishes made while the publish queue is full
+DEFAULT_PUBLISH_QUEUE_POLICY = "drop_oldest"
+# Default number of seconds to wait for room in a full publish queue with the
+# block policy
+# 0 means wait forever
+DEFAULT_PUBLISH_QUEUE_TIMEOUT = 0
+# Default maximum size in bytes of pending publishes kept on disk
+# 0 means no limit
+DEFAULT_PUBLISH_STORE_MAX_SIZE = 10485760
+# Default number of writes to the publish store between commits to disk
+DEFAULT_PUBLISH_STORE_COMMIT_COUNT = 100
+# Default number of seconds telemetry published with aggregate is collected
+# before its statistics are published
+DEFAULT_TELEMETRY_AGGREGATE_WINDOW = 60
+# Default statistics published for each aggregation window
+DEFAULT_TELEMETRY_AGGREGATE_STATS = ["min", "max", "mean", "count", "last"]
+# Default percentiles published for each aggregation window
+DEFAULT_TELEMETRY_AGGREGATE_PERCENTILES = []
+
+
+# Number of seconds a blocking call waits for the Cloud to reply
+REPLY_TIMEOUT = 15
+# Highest topic number requests are sent on before numbering wraps around
+TOPIC_MAX = 9999
+
+
+# TELEMETRY AGGREGATION
+
+# Statistics that can be published for an aggregation window
+AGGREGATE_STATS = ["min", "max", "mean", "count", "last", "sum"]
+# Number of distinct event texts tracked for log_rate_interval before old
+# ones are forgotten
+LOG_RATE_TRACKED = 1024
+# Number of samples kept per aggregation window to estimate percentiles
+AGGREGATE_RESERVOIR_SIZE = 512
+
+
+# POLICIES FOR A FULL PUBLISH QUEUE
+
+# Wait for room, then drop the new publish
+PUBLISH_POLICY_BLOCK = "block"
+# Drop the oldest pending publishes
+PUBLISH_POLICY_DROP_OLDEST = "drop_oldest"
+# Drop the new publish
+PUBLISH_POLICY_DROP_NEWEST = "drop_newest"
+# Replace the pending publish for the same key
+PUBLISH_POLICY_COALESCE = "coalesce"
+
+PUBLISH_POLICIES = [
+    PUBLISH_POLICY_BLOCK,
+    PUBLISH_POLICY_DROP_OLDEST,
+    PUBLISH_POLICY_DROP_NEWEST,
+    PUBLISH_POLICY_COALESCE
+]
 
 
 # PORTS THAT REQUIRE SSL CONNECTIONS
@@ -125,6 +238,8 @@ LOG_TIME_FORMAT = "%b %d %H:%M:%S"
 
 # Time format supported by Cloud
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+# Number of formatted timestamps cached for reuse
+TIMESTAMP_CACHE_SIZE = 1024
 
 
 # TYPES OF WORK
@@ -139,3 +254,16 @@ WORK_ACTION = 2
 WORK_DOWNLOAD = 3
 # Upload a file
 WORK_UPLOAD = 4
+# Check the mailboxes of child devices for actions
+WORK_MAILBOX = 5
+
+# Lane of the work queue each type of work is placed in. Lower lanes are served
+# first.
+WORK_LANES = {
+    WORK_MESSAGE: 0,
+    WORK_ACTION: 1,
+    WORK_MAILBOX: 1,
+    WORK_PUBLISH: 2,
+    WORK_DOWNLOAD: 3,
+    WORK_UPLOAD: 3
+}
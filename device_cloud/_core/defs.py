@@ -15,27 +15,113 @@
 This module defines several helper classes for use in the device_cloud handler
 """
 
+import calendar
+import heapq
 import inspect
+import itertools
 import json
+import math
+import numbers
+import random
 import subprocess
+import threading
 from datetime import datetime
+from time import sleep
+from time import time
+
+# time.monotonic is not available in Python 2
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
 
 from device_cloud._core import constants
 
+# Formatted timestamps by epoch millisecond, and their formatted prefixes by
+# epoch second, so samples taken close together share strftime calls
+_timestamp_cache = {}
+_prefix_cache = {}
+
+def epoch_ms():
+    """
+    Return the current time in milliseconds since the epoch
+    """
+
+    return int(time() * 1000)
+
+def format_timestamp(timestamp):
+    """
+    Format a timestamp in milliseconds since the epoch for the Cloud. Anything
+    else, such as an already formatted string, is returned unchanged.
+    """
+
+    if (not isinstance(timestamp, numbers.Integral) or
+            isinstance(timestamp, bool)):
+        return timestamp
+
+    formatted = _timestamp_cache.get(timestamp)
+    if formatted is None:
+        seconds, millis = divmod(timestamp, 1000)
+        prefix = _prefix_cache.get(seconds)
+        if prefix is None:
+            if len(_prefix_cache) >= constants.TIMESTAMP_CACHE_SIZE:
+                _prefix_cache.clear()
+            prefix = datetime.utcfromtimestamp(seconds).strftime(
+                "%Y-%m-%dT%H:%M:%S.")
+            _prefix_cache[seconds] = prefix
+        formatted = "{}{:03d}000Z".format(prefix, millis)
+        if len(_timestamp_cache) >= constants.TIMESTAMP_CACHE_SIZE:
+            _timestamp_cache.clear()
+        _timestamp_cache[timestamp] = formatted
+    return formatted
+
+def to_epoch_ms(timestamp):
+    """
+    Convert a datetime (naive datetimes are UTC) or a number of seconds since
+    the epoch to milliseconds since the epoch. Anything else, such as an
+    already formatted string, is returned unchanged.
+    """
+
+    if isinstance(timestamp, datetime):
+        return (calendar.timegm(timestamp.utctimetuple()) * 1000 +
+                timestamp.microsecond // 1000)
+    if (isinstance(timestamp, numbers.Real) and
+            not isinstance(timestamp, bool)):
+        return int(round(timestamp * 1000))
+    return timestamp
+
+
+def action_key(name, thing_key=None):
+    """
+    Return the key an action is registered under, "<thing_key>/<name>" for the
+    actions of a child device in gateway mode
+    """
+
+    if thing_key:
+        return "{}/{}".format(thing_key, name)
+    return name
+
+
 class Action(object):
     """
     Holds information associating an action and a callback
     """
 
-    def __init__(self, name, callback, client, user_data=None):
+    def __init__(self, name, callback, client, user_data=None,
+                 long_running=False, thing_key=None):
         self.name = name
         self.callback = callback
         self.client = client
         self.user_data = user_data
+        self.long_running = long_running
+        # Child device the action is for in gateway mode, None for the
+        # Client's own thing
+        self.thing_key = thing_key
 
     def __str__(self):
         string = "Action {} --> Callback {}"
-        return string.format(self.name, self.callback.__name__)
+        return string.format(action_key(self.name, self.thing_key),
+                             self.callback.__name__)
 
     def execute(self, request):
         """
@@ -73,12 +159,15 @@ class ActionCommand(Action):
     Holds information associating an action and a console command
     """
 
-    def __init__(self, name, callback, client, user_data=None):
-        super(ActionCommand, self).__init__(name, None, client, user_data)
+    def __init__(self, name, callback, client, user_data=None,
+                 long_running=False, thing_key=None):
+        super(ActionCommand, self).__init__(name, None, client, user_data,
+                                            long_running, thing_key)
         self.command = callback
 
     def __str__(self):
-        return "Action {} --> Command \"{}\"".format(self.name, self.command)
+        return "Action {} --> Command \"{}\"".format(
+            action_key(self.name, self.thing_key), self.command)
 
     def execute(self, request):
         """
@@ -116,10 +205,12 @@ class ActionRequest(object):
     Holds information about action requests for execution
     """
 
-    def __init__(self, request_id, name, params):
+    def __init__(self, request_id, name, params, thing_key=None):
         self.request_id = request_id
         self.name = name
         self.params = params
+        # Child device the request is for in gateway mode
+        self.thing_key = thing_key
 
 
 class Callbacks(dict):
@@ -136,11 +227,12 @@ class Callbacks(dict):
         registered
         """
 
-        if self.__contains__(action.name):
+        key = action_key(action.name, action.thing_key)
+        if self.__contains__(key):
             raise KeyError("Action \"{}\" already has a callback".format(
-                action.name))
+                key))
         else:
-            self.__setitem__(action.name, action)
+            self.__setitem__(key, action)
 
     def execute_action(self, action_request):
         """
@@ -151,24 +243,40 @@ class Callbacks(dict):
 
         # Attempt to execute action callback if an action with the same name as
         # the request is registered
-        if action_request.name not in self:
+        action = self.find_action(action_request)
+        if action is None:
             raise KeyError("Action \"{}\" does not have a callback".format(
-                action_request.name))
+                action_key(action_request.name, action_request.thing_key)))
         else:
-            result = self[action_request.name].execute(action_request)
+            result = action.execute(action_request)
 
         return result
 
-    def remove_action(self, action_name):
+    def find_action(self, action_request):
+        """
+        Return the action registered for an action request. Requests for a
+        child device fall back to the action of the same name registered
+        without a thing key.
+        """
+
+        if action_request.thing_key:
+            action = self.get(action_key(action_request.name,
+                                         action_request.thing_key))
+            if action is not None:
+                return action
+        return self.get(action_request.name)
+
+    def remove_action(self, action_name, thing_key=None):
         """
         Remove an action callback as long as it exists
         """
 
-        if action_name not in self:
+        key = action_key(action_name, thing_key)
+        if key not in self:
             raise KeyError("Action \"{}\" does not have a callback".format(
-                action_name))
+                key))
         else:
-            del self[action_name]
+            del self[key]
 
 
 class Config(dict):
@@ -231,18 +339,64 @@ class FileTransfer(object):
         self.callback = callback
         self.file_id = file_id
         self.file_checksum = file_checksum
+        self.done = threading.Event()
+        self.done_lock = threading.Lock()
+        self.done_callbacks = []
         self.status = None
         self.resume_download = False
         self.file_size = None
         self.download_temp_path = None
 
+    @property
+    def status(self):
+        """
+        Result of the file transfer, None while it is still in progress
+        """
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        # Setting a final status wakes up any threads waiting on the transfer
+        self._status = status
+        if status is not None:
+            self.set_done()
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(transfer) once the file transfer is done, straight away
+        if it already is
+        """
+        with self.done_lock:
+            if not self.done.is_set():
+                self.done_callbacks.append(callback)
+                return
+        callback(self)
+
     def finish(self):
         """
         Run the completion callback associated with this file transfer
         """
+        self.set_done()
         if self.callback:
             self.callback(self.client, self.file_name, self.status)
 
+    def set_done(self):
+        """
+        Wake up anything waiting on the file transfer
+        """
+        with self.done_lock:
+            callbacks, self.done_callbacks = self.done_callbacks, []
+            self.done.set()
+        for callback in callbacks:
+            callback(self)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the file transfer to complete. Returns False if the wait timed
+        out.
+        """
+        return self.done.wait(timeout)
+
 
 class Message(object):
     """
@@ -257,6 +411,9 @@ class Message(object):
         return json.dumps(self.json, indent=2, sort_keys=True)
 
 
+# Command parameters kept once an OutMessage is compacted
+COMPACT_PARAMS = ("thingKey", "key", "fileName", "id")
+
 
 class OutMessage(object):
     """
@@ -264,32 +421,56 @@ class OutMessage(object):
     """
 
     def __init__(self, command, description, timestamp=None, data=None,
-                 out_id=None):
+                 out_id=None, futures=None):
         self.command = command
         self.description = description
         self.timestamp = timestamp
         self.data = data
         self.out_id = out_id
+        self.futures = futures or []
 
     def __str__(self):
         return self.description
 
+    def compact(self):
+        """
+        Drop the command payload once it has been sent. The command name and
+        the parameters identifying what it was for are kept, so that the
+        command can still be reported if it fails or expires.
+        """
+
+        params = self.command.get("params") or {}
+        summary = dict((name, params[name]) for name in COMPACT_PARAMS
+                       if name in params)
+        self.command = {"command":self.command.get("command")}
+        if summary:
+            self.command["params"] = summary
+
 
-class OutTracker(dict):
+class OutTracker(object):
     """
-    Holds all sent messages that are waiting for a reply
+    Holds all sent messages that are waiting for a reply, by the topic number
+    of the request they were sent in and then their command number, so a reply
+    can be matched with a dict lookup. Requests with a deadline are also kept
+    in a heap so that expired ones can be found without scanning every
+    message.
     """
 
-    def __init__(self):
-        super(OutTracker, self).__init__()
+    def __init__(self, topic_max=constants.TOPIC_MAX):
+        self.topics = {}
+        self.count = 0
         self.mid_tracker = {}
+        self.deadlines = []
+        self.sequence = itertools.count()
 
-    def add_message(self, message):
-        """
-        Add a message
-        """
+        # Topic numbers are handed out in order, wrapping around after
+        # topic_max, skipping any still waiting for replies
+        self.topic_max = topic_max
+        self.topic_width = len(str(topic_max))
+        self.next_num = 1
 
-        self[message.out_id] = message
+    def __len__(self):
+        return self.count
 
     def add_mid(self, mid, topic):
         """
@@ -298,18 +479,84 @@ class OutTracker(dict):
 
         self.mid_tracker[mid] = topic
 
-    def pop_message(self, topic_num, cmd_num):
+    def add_request(self, topic_num, messages, expires=None):
         """
-        Remove a single message
+        Add the messages sent in one request, optionally with the monotonic
+        time their replies are due by
         """
 
-        out_id = "{}-{}".format(topic_num, cmd_num)
-        try:
-            message = self.pop(out_id)
-        except KeyError:
-            raise KeyError("Message {} not found. May be a duplicate "
-                           "reply".format(out_id))
-        return message
+        commands = {}
+        for num, message in enumerate(messages, 1):
+            message.out_id = "{}-{}".format(topic_num, num)
+            commands[str(num)] = message
+        self.topics[topic_num] = commands
+        self.count += len(commands)
+        if expires is not None:
+            heapq.heappush(self.deadlines, (expires, next(self.sequence),
+                                            topic_num, commands))
+
+    def items(self):
+        """
+        Return (out_id, message) for every message waiting for a reply
+        """
+
+        return [(message.out_id, message)
+                for commands in list(self.topics.values())
+                for message in list(commands.values())]
+
+    def next_topic(self):
+        """
+        Return an unused topic number, or None if every topic number is
+        waiting for replies
+        """
+
+        for _ in range(self.topic_max):
+            num = self.next_num
+            self.next_num = num % self.topic_max + 1
+            topic_num = str(num).zfill(self.topic_width)
+            if topic_num not in self.topics:
+                return topic_num
+        return None
+
+    def pop_expired(self, now=None):
+        """
+        Remove and return every message whose reply is overdue
+        """
+
+        if now is None:
+            now = monotonic()
+
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, _, topic_num, commands = heapq.heappop(self.deadlines)
+            # Skip requests that were already replied to
+            if self.topics.get(topic_num) is commands:
+                del self.topics[topic_num]
+                self.count -= len(commands)
+                expired.extend(commands.values())
+        return expired
+
+    def pop_messages(self, topic_num, cmd_nums):
+        """
+        Remove every message of a reply at once. Returns a list of (cmd_num,
+        message) pairs and a list of the cmd_nums that were not found.
+        """
+
+        found = []
+        missing = []
+        commands = self.topics.get(topic_num)
+        if commands is None:
+            return found, list(cmd_nums)
+        for cmd_num in cmd_nums:
+            message = commands.pop(cmd_num, None)
+            if message is None:
+                missing.append(cmd_num)
+            else:
+                found.append((cmd_num, message))
+        if not commands:
+            del self.topics[topic_num]
+        self.count -= len(found)
+        return found, missing
 
     def pop_mid(self, mid):
         """
@@ -323,12 +570,68 @@ class OutTracker(dict):
 
 class Publish(object):
     """
-    Super Class for holding information about a pending publish
+    Super Class for holding information about a pending publish. Publishes can
+    be buffered by the thousand while offline, so they use __slots__ instead
+    of a per-instance __dict__.
     """
 
+    __slots__ = ("timestamp", "thing_key", "future", "store_id")
+
+    # Data field names of each publish class, in declaration order
+    _field_names = {}
+
     def __init__(self):
-        self.timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
-        self.type = self.__class__.__name__
+        # Milliseconds since the epoch. Formatted only when sent.
+        self.timestamp = epoch_ms()
+        # Child device the publish is for in gateway mode, None for the
+        # Client's own thing
+        self.thing_key = None
+        self.future = None
+        # Row id of the publish in the publish store, if it was taken from one
+        self.store_id = None
+
+    @property
+    def type(self):
+        """
+        Name of the publish class
+        """
+
+        return self.__class__.__name__
+
+    @classmethod
+    def field_names(cls):
+        """
+        Return the names of the data fields of this publish class
+        """
+
+        names = Publish._field_names.get(cls)
+        if names is None:
+            names = tuple(name for klass in reversed(cls.__mro__)
+                          for name in getattr(klass, "__slots__", ())
+                          if name not in ("future", "store_id"))
+            Publish._field_names[cls] = names
+        return names
+
+    @classmethod
+    def from_fields(cls, fields):
+        """
+        Rebuild a publish from the dict returned by fields()
+        """
+
+        pub = cls.__new__(cls)
+        pub.future = None
+        pub.store_id = None
+        for name in cls.field_names():
+            setattr(pub, name, fields.get(name))
+        return pub
+
+    def fields(self):
+        """
+        Return a dict of the data fields of the publish
+        """
+
+        return dict((name, getattr(self, name, None))
+                    for name in self.field_names())
 
 
 class PublishAlarm(Publish):
@@ -336,6 +639,8 @@ class PublishAlarm(Publish):
     Holds information about an alarm
     """
 
+    __slots__ = ("name", "state", "message", "republish")
+
     def __init__(self, name, state, message=None, republish=False):
         super(PublishAlarm, self).__init__()
         self.name = name
@@ -349,6 +654,8 @@ class PublishAttribute(Publish):
     Holds information about an attribute that is to be published
     """
 
+    __slots__ = ("name", "value")
+
     def __init__(self, name, value):
         super(PublishAttribute, self).__init__()
         self.name = name
@@ -360,6 +667,9 @@ class PublishLocation(Publish):
     Holds location information
     """
 
+    __slots__ = ("latitude", "longitude", "heading", "altitude", "speed",
+                 "accuracy", "fix_type")
+
     def __init__(self, latitude, longitude, heading=None, altitude=None,
                  speed=None, accuracy=None, fix_type=None):
         super(PublishLocation, self).__init__()
@@ -392,6 +702,8 @@ class PublishLog(Publish):
     Holds a log message to be sent to the Cloud
     """
 
+    __slots__ = ("message",)
+
     def __init__(self, message):
         super(PublishLog, self).__init__()
         self.message = message
@@ -402,16 +714,293 @@ class PublishTelemetry(Publish):
     Holds information about telemetry that is to be published
     """
 
+    __slots__ = ("name", "value", "corr_id", "aggregate")
+
     def __init__(self, name, value, timestamp=None, corr_id=None, aggregate=None):
         super(PublishTelemetry, self).__init__()
         if type(timestamp) is datetime:
-            self.timestamp = timestamp.strftime(constants.TIME_FORMAT)
+            self.timestamp = to_epoch_ms(timestamp)
         self.name = name
         self.value = value
         self.corr_id = corr_id
         self.aggregate = aggregate
 
 
+class PublishTelemetryBatch(Publish):
+    """
+    Holds a block of samples for one telemetry key that is to be published.
+    Without timestamps, samples are spaced sample_interval seconds apart,
+    the last one at the current time.
+    """
+
+    __slots__ = ("name", "values", "timestamps", "corr_id")
+
+    def __init__(self, name, values, timestamps=None, corr_id=None,
+                 sample_interval=0):
+        super(PublishTelemetryBatch, self).__init__()
+        self.name = name
+        self.values = list(values)
+        if timestamps is None:
+            last = len(self.values) - 1
+            self.timestamps = [
+                self.timestamp - int(round((last - num) * sample_interval *
+                                           1000))
+                for num in range(len(self.values))]
+        else:
+            self.timestamps = [to_epoch_ms(timestamp)
+                               for timestamp in timestamps]
+        self.corr_id = corr_id
+
+
+class ReplyFuture(object):
+    """
+    Holds the reply for a sent message so that the thread that sent it can wait
+    for it independently of any other pending replies
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.reply = None
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) once the reply is set, straight away if it
+        already is
+        """
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_reply(self, reply):
+        """
+        Store the reply and wake up any waiting threads. A reply of None means
+        no reply will ever arrive.
+        """
+
+        with self.lock:
+            self.reply = reply
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def success(self):
+        """
+        Return whether the Cloud reported success for the message
+        """
+
+        return bool(self.reply and self.reply.get("success"))
+
+    def wait(self, timeout=None):
+        """
+        Wait for the reply. Returns False if the wait timed out.
+        """
+
+        return self.event.wait(timeout)
+
+
+class TelemetryFilter(object):
+    """
+    Decides which samples of a telemetry key are worth publishing. A sample is
+    published when it differs from the last published value by more than every
+    configured deadband, and at least min_interval seconds have passed since
+    the last publish. With no deadbands set, only changed values are
+    published. If max_interval is set, the latest sample is republished when
+    nothing has been published for that many seconds.
+    """
+
+    def __init__(self, deadband=0, deadband_percent=0, min_interval=0,
+                 max_interval=0):
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        # Last published value and when it was published, and the latest
+        # sample for heartbeats
+        self.last_value = None
+        self.last_sent = None
+        self.latest = None
+        self.lock = threading.Lock()
+
+    def accept(self, value, now=None):
+        """
+        Record a sample. Returns whether it should be published.
+        """
+
+        if now is None:
+            now = monotonic()
+
+        with self.lock:
+            self.latest = value
+            if self.last_sent is not None:
+                if (self.min_interval and
+                        now - self.last_sent < self.min_interval):
+                    return False
+                if not self.changed(value):
+                    return False
+            self.last_value = value
+            self.last_sent = now
+        return True
+
+    def changed(self, value):
+        """
+        Return whether a value is outside the deadbands around the last
+        published value
+        """
+
+        try:
+            diff = abs(value - self.last_value)
+        except TypeError:
+            return value != self.last_value
+
+        if not self.deadband and not self.deadband_percent:
+            return diff != 0
+        if self.deadband and diff <= self.deadband:
+            return False
+        if (self.deadband_percent and
+                diff <= abs(self.last_value) * self.deadband_percent / 100.0):
+            return False
+        return True
+
+    def heartbeat(self, now=None):
+        """
+        Return (True, value) if the latest sample is due to be republished,
+        otherwise (False, None)
+        """
+
+        if now is None:
+            now = monotonic()
+
+        with self.lock:
+            if (not self.max_interval or self.last_sent is None or
+                    now - self.last_sent < self.max_interval):
+                return (False, None)
+            self.last_value = self.latest
+            self.last_sent = now
+            return (True, self.latest)
+
+
+class TelemetryWindow(object):
+    """
+    Collects samples of a telemetry key over a window of length seconds and
+    computes statistics about them. Percentiles are estimated from a uniform
+    random sample of at most AGGREGATE_RESERVOIR_SIZE values.
+    """
+
+    def __init__(self, length, stats, percentiles=None, start=None):
+        self.length = length
+        self.stats = stats
+        self.percentiles = percentiles or []
+        self.start = monotonic() if start is None else start
+
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.reservoir = []
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        """
+        Add a sample to the window
+        """
+
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            self.last = value
+
+            if self.percentiles:
+                if len(self.reservoir) < constants.AGGREGATE_RESERVOIR_SIZE:
+                    self.reservoir.append(value)
+                else:
+                    num = random.randint(0, self.count - 1)
+                    if num < len(self.reservoir):
+                        self.reservoir[num] = value
+
+    def expired(self, now=None):
+        """
+        Return whether the window has ended
+        """
+
+        if now is None:
+            now = monotonic()
+        return now - self.start >= self.length
+
+    def results(self):
+        """
+        Return a list of (statistic name, value) for the window. Percentiles
+        are named p<percentile>, for example p95.
+        """
+
+        with self.lock:
+            values = {
+                "min":self.min,
+                "max":self.max,
+                "mean":float(self.sum) / self.count if self.count else None,
+                "count":self.count,
+                "last":self.last,
+                "sum":self.sum
+            }
+            results = [(stat, values[stat]) for stat in self.stats
+                       if stat in values]
+
+            ordered = sorted(self.reservoir)
+            for percentile in self.percentiles:
+                if ordered:
+                    rank = int(math.ceil(percentile / 100.0 * len(ordered)))
+                    value = ordered[min(max(rank, 1), len(ordered)) - 1]
+                    results.append(("p{:g}".format(percentile), value))
+        return results
+
+
+class TokenBucket(object):
+    """
+    Rate limiter that lets up to burst messages through at once, then refills at
+    rate messages per second. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate or 0)
+        self.burst = max(int(burst or 0), 1)
+        self.tokens = float(self.burst)
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """
+        Take tokens, sleeping until they are available. Tokens are reserved
+        before sleeping so concurrent callers are delayed in turn. Returns the
+        number of seconds waited.
+        """
+
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= count
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay:
+            sleep(delay)
+        return delay
+
+
 class Work(object):
     """
     Holds information about work that needs to be completed
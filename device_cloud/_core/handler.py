@@ -15,6 +15,7 @@
 This module handles all the underlying functionality of the Client
 """
 
+import functools
 import json
 import logging
 import logging.handlers
@@ -34,18 +35,25 @@ import sys
 import threading
 from binascii import crc32
 from datetime import datetime
-from datetime import timedelta
 from time import sleep
 import requests
 
+# time.monotonic is not available in Python 2
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 # for debugging only, uncomment the following two lines
 #import httplib
 #httplib.HTTPConnection.debuglevel = 1
 
 import paho.mqtt.client as mqttlib
 
+from device_cloud._core import codec
 from device_cloud._core import constants
 from device_cloud._core import defs
+from device_cloud._core import store
 from device_cloud._core import tr50
 from device_cloud._core.tr50 import TR50Command
 
@@ -56,6 +64,26 @@ if sys.version_info.major == 2:
 else:
     import queue
 
+# Publish types in the order their commands are written in a request
+PUBLISH_TYPES = [
+    "PublishLog",
+    "PublishAlarm",
+    "PublishAttribute",
+    "PublishLocation",
+    "PublishTelemetry"
+]
+
+# TR50 commands whose replies are handled by the library itself
+BUILTIN_REPLY_HANDLERS = [
+    TR50Command.attribute_current,
+    TR50Command.diag_ping,
+    TR50Command.diag_time,
+    TR50Command.file_get,
+    TR50Command.file_put,
+    TR50Command.mailbox_check,
+    TR50Command.property_current
+]
+
 def status_string(error_code):
     """
     Return a string describing the error code
@@ -63,6 +91,24 @@ def status_string(error_code):
 
     return constants.STATUS_STRINGS[error_code]
 
+def deadline(timeout):
+    """
+    Return the monotonic time at which a timeout expires, or None if the timeout
+    is 0 (wait forever)
+    """
+
+    return monotonic() + timeout if timeout else None
+
+def time_remaining(end_time):
+    """
+    Return the number of seconds left until a deadline, or None if there is no
+    deadline
+    """
+
+    if end_time is None:
+        return None
+    return max(end_time - monotonic(), 0)
+
 def is_valid_status(error_code):
     """
     Check if passed object is a valid status code
@@ -117,6 +163,7 @@ class Handler(object):
 
         # Print configuration
         self.logger.debug("CONFIG:\n%s", self.config)
+        self.logger.debug("Using %s for JSON", codec.NAME)
 
         # Ensure the paho socket pair is not using proxy sockets
         # Save the original socket so that class members can use it,
@@ -171,46 +218,137 @@ class Handler(object):
         # data
         self.callbacks = defs.Callbacks()
 
-        # Connection state of the Client
+        # Thing keys of the child devices this Client is a gateway for, whose
+        # mailboxes are checked for actions on connecting and every
+        # child_mailbox_interval seconds. The Cloud does not notify this
+        # Client of mailbox activity for them. None until the first check
+        # after connecting.
+        self.children = []
+        self.child_check_time = None
+
+        # Connection state of the Client, and a condition to notify any threads
+        # waiting for it to change
         self.state = constants.STATE_DISCONNECTED
+        self.state_condition = threading.Condition()
 
         # Track last time the app was connected so keep alive can time out
-        self.last_connected = datetime.utcnow()
+        self.last_connected = monotonic()
 
-        # Lock for thread safety
+        # Lock for thread safety. Threads waiting for all replies to be
+        # received wait on reply_condition.
         self.lock = threading.Lock()
-
-        # Queue for any pending publishes (number, string, location, etc.)
-        self.publish_queue = queue.Queue()
+        self.reply_condition = threading.Condition(self.lock)
+
+        # Queue for any pending publishes (number, string, location, etc.).
+        # Optionally kept on disk so that publishes survive restarts and long
+        # periods offline.
+        self.publish_store = None
+        if self.config.publish_store_file:
+            self.publish_store = store.PublishStore(
+                self.config.publish_store_file,
+                max_size=self.config.publish_store_max_size or 0,
+                commit_count=self.config.publish_store_commit_count or 1)
+            self.publish_queue = self.publish_store
+        else:
+            policy = self.config.publish_queue_policy
+            if policy not in constants.PUBLISH_POLICIES:
+                if policy:
+                    self.logger.warning("publish_queue_policy invalid, %s "
+                                        "used as default",
+                                        constants.DEFAULT_PUBLISH_QUEUE_POLICY)
+                policy = constants.DEFAULT_PUBLISH_QUEUE_POLICY
+            self.publish_queue = store.PublishQueue(
+                max_count=self.config.publish_queue_max_count or 0,
+                max_size=self.config.publish_queue_max_size or 0,
+                policy=policy,
+                timeout=self.config.publish_queue_timeout or 0)
+
+        # Flag set while a publish is scheduled, so that at most one is
+        # waiting at a time, and when the oldest pending publish started to
+        # linger. Once connected, a single publisher thread does all the
+        # batching and sending of publishes, woken through publish_condition.
+        # Until then publishes are scheduled on the work queue.
+        self.publish_lock = threading.Lock()
+        self.publish_condition = threading.Condition(self.publish_lock)
+        self.publish_pending = False
+        self.publish_busy = False
+        self.publish_linger_start = None
+        self.publish_thread = None
+
+        # Commands waiting for send_linger to be combined into one request,
+        # and the timer that sends them
+        self.send_lock = threading.Lock()
+        self.send_pending = []
+        self.send_timer = None
+
+        # When each event text was last published and how many times it has
+        # been dropped since, for log_rate_interval
+        self.log_lock = threading.Lock()
+        self.log_history = {}
+
+        # Filters deciding which telemetry samples are published, by telemetry
+        # name
+        self.telemetry_filters = {}
+
+        # Open aggregation windows for telemetry published with aggregate, by
+        # telemetry name
+        self.telemetry_windows = {}
+        self.aggregate_lock = threading.Lock()
 
         # Dicts to track which messages sent out have not received replies. Also
         # stores any actions to be taken when the reply is received.
         self.reply_tracker = defs.OutTracker()
         self.no_reply = []
 
-        # Counter to allow every message to be sent on a unique topic
-        self.topic_counter = 1
+        # Handlers for replies to sent messages, by TR50 command. Applications
+        # can register callbacks for commands the library does not handle.
+        self.reply_handlers = {
+            TR50Command.attribute_current: self.reply_current,
+            TR50Command.diag_ping: self.reply_diag_ping,
+            TR50Command.diag_time: self.reply_diag_time,
+            TR50Command.file_get: self.reply_file_get,
+            TR50Command.file_put: self.reply_file_put,
+            TR50Command.mailbox_check: self.reply_mailbox_check,
+            TR50Command.property_current: self.reply_current
+        }
+
+        # Limit outgoing messages to the Cloud's API/s quota
+        self.rate_limiter = defs.TokenBucket(self.config.api_rate,
+                                             self.config.api_burst)
 
         # Flag for notifying client to exit
         self.to_quit = True
 
-        # Telemetry Response Flag
-        self.pub_wait = self.pub_response = False
-        self.pub_topic = '0000'
-
         # Thread trackers. Main thread for handling MQTT loop, and worker
         # threads for everything else.
         self.main_thread = None
         self.worker_threads = []
 
-        # Queue to track any pending work (parsing messages, actions,
-        # publishing, file transfer, etc.)
-        self.work_queue = queue.Queue()
-
-        # store any requested data here
-        self.response = {}
-
-    def action_deregister(self, action_name):
+        # Number of worker threads serving the work queue, which grows up to
+        # thread_count_max while work waits longer than work_wait_target and
+        # shrinks back to thread_count after idle periods
+        self.worker_lock = threading.Lock()
+        self.worker_count = 0
+
+        # Queues to track any pending work (parsing messages, actions,
+        # publishing, file transfer, etc.), served in priority order. File
+        # transfers and long running actions each have their own worker
+        # threads when transfer_thread_count and action_thread_count are set,
+        # so that they cannot hold up replies and actions. They are kept apart
+        # so that a long running action waiting on a file transfer never holds
+        # the only thread that could run it.
+        self.work_queue = store.WorkQueue()
+        self.transfer_queue = self.work_queue
+        if self.config.transfer_thread_count:
+            self.transfer_queue = store.WorkQueue()
+        self.long_action_queue = self.work_queue
+        if self.config.action_thread_count:
+            self.long_action_queue = store.WorkQueue()
+
+        # Notified whenever a worker thread takes work from the work queue
+        self.work_condition = threading.Condition()
+
+    def action_deregister(self, action_name, thing_key=None):
         """
         Disassociate any function or command from an action in the Cloud
         """
@@ -218,7 +356,7 @@ class Handler(object):
         status = constants.STATUS_SUCCESS
 
         try:
-            self.callbacks.remove_action(action_name)
+            self.callbacks.remove_action(action_name, thing_key)
         except KeyError as error:
             self.logger.error(str(error))
             status = constants.STATUS_NOT_FOUND
@@ -235,7 +373,7 @@ class Handler(object):
                                        "{} {}: \"{}\"".format(request_id,
                                                               error_code,
                                                               error_message))
-        return self.send(message)
+        return self.queue_send(message)
 
     def action_progress_update(self, request_id, message):
         """
@@ -245,43 +383,133 @@ class Handler(object):
         cmd = tr50.create_mailbox_update(request_id, message)
         message = defs.OutMessage(cmd, "Update Action Progress "
                                   "{} \"{}\"".format(request_id, message))
-        return self.send(message)
+        return self.queue_send(message)
 
     def action_register_callback(self, action_name, callback_function,
-                                 user_data=None):
+                                 user_data=None, long_running=False,
+                                 thing_key=None):
         """
         Associate a callback function with an action in the Cloud
         """
-        status = constants.STATUS_SUCCESS
         action = defs.Action(action_name, callback_function, self.client,
-                             user_data=user_data)
+                             user_data=user_data, long_running=long_running,
+                             thing_key=thing_key)
+        return self.action_register(action)
+
+    def action_register_command(self, action_name, command,
+                                long_running=False, thing_key=None):
+        """
+        Associate a console command with an action in the Cloud
+        """
+
+        action = defs.ActionCommand(action_name, command, self.client,
+                                    long_running=long_running,
+                                    thing_key=thing_key)
+        return self.action_register(action)
+
+    def action_register(self, action):
+        """
+        Register an action with its callback function or console command.
+        Actions of a child device also register the child.
+        """
+
+        status = constants.STATUS_SUCCESS
         try:
             self.callbacks.add_action(action)
-            self.logger.info("Registered action \"%s\" with function \"%s\"",
-                             action_name, callback_function.__name__)
+            self.logger.info("Registered %s", action)
+            if action.thing_key:
+                self.child_register(action.thing_key)
         except KeyError as error:
             self.logger.error("Failed to register action. %s", str(error))
             status = constants.STATUS_EXISTS
 
         return status
 
-    def action_register_command(self, action_name, command):
+    def child_deregister(self, thing_key):
         """
-        Associate a console command with an action in the Cloud
+        Stop checking the mailbox of a child device
         """
 
-        status = constants.STATUS_SUCCESS
-        action = defs.ActionCommand(action_name, command, self.client)
         try:
-            self.callbacks.add_action(action)
-            self.logger.info("Registered action \"%s\" with command \"%s\"",
-                             action_name, command)
-        except KeyError as error:
-            self.logger.error("Failed to register action. %s", str(error))
-            status = constants.STATUS_EXISTS
+            self.children.remove(thing_key)
+        except ValueError:
+            self.logger.error("Child %s not registered", thing_key)
+            return constants.STATUS_NOT_FOUND
+        return constants.STATUS_SUCCESS
+
+    def child_register(self, thing_key):
+        """
+        Check the mailbox of a child device for actions along with the
+        Client's own
+        """
+
+        if thing_key in self.children:
+            return constants.STATUS_EXISTS
+        self.children.append(thing_key)
+        self.logger.info("Registered child %s", thing_key)
+        if self.is_connected():
+            self.queue_work(defs.Work(constants.WORK_MAILBOX, [thing_key]))
+        return constants.STATUS_SUCCESS
 
+    def check_child_mailboxes(self, thing_keys=None):
+        """
+        Check the mailboxes of child devices, all of them by default, in as few
+        requests as fit publish_max_payload
+        """
+
+        if thing_keys is None:
+            thing_keys = list(self.children)
+        to_send = []
+        for thing_key in thing_keys:
+            mailbox_check = tr50.create_mailbox_check(auto_complete=False,
+                                                      thing_key=thing_key)
+            to_send.append(defs.OutMessage(
+                mailbox_check, "Mailbox Check {}".format(thing_key),
+                data=thing_key))
+
+        status = constants.STATUS_SUCCESS
+        commands = [message.command for message in to_send]
+        for request in tr50.split_requests(
+                commands, self.config.publish_max_payload or 0):
+            status = self.send([to_send[num] for num in request])
         return status
 
+    def coalesce_publishes(self, to_publish, futures):
+        """
+        Reduce a flush of pending publishes to the latest value for each
+        attribute and the state transitions for each alarm within the flush.
+        Futures of superseded publishes are added to futures, so they are
+        resolved by the reply to the publish that replaced them.
+        """
+
+        latest = {}
+        alarm_states = {}
+        for num, pub in enumerate(to_publish):
+            key = (pub.thing_key, getattr(pub, "name", None))
+            if pub.type == "PublishAttribute":
+                if key in latest:
+                    old_pub = to_publish[latest[key]]
+                    if old_pub.future:
+                        futures[old_pub.type].append(old_pub.future)
+                    to_publish[latest[key]] = None
+                latest[key] = num
+
+            elif pub.type == "PublishAlarm":
+                if (not pub.republish and key in alarm_states and
+                        alarm_states[key] == pub.state):
+                    # An earlier alarm in this flush already sends this state
+                    if pub.future:
+                        futures[pub.type].append(pub.future)
+                    to_publish[num] = None
+                else:
+                    alarm_states[key] = pub.state
+
+        coalesced = [pub for pub in to_publish if pub]
+        if len(coalesced) < len(to_publish):
+            self.logger.debug("Coalesced %d publishes into %d",
+                              len(to_publish), len(coalesced))
+        return coalesced
+
     def connect(self, timeout=0):
         """
         Connect to MQTT and start main thread
@@ -297,9 +525,8 @@ class Handler(object):
             status = constants.STATUS_BAD_PARAMETER
 
         else:
-            current_time = datetime.utcnow()
-            end_time = current_time + timedelta(seconds=timeout)
-            self.state = constants.STATE_CONNECTING
+            end_time = deadline(timeout)
+            self.set_state(constants.STATE_CONNECTING)
 
             # Add network check and poll here while it is not
             # available.  Otherwise, the service will exit which is
@@ -346,7 +573,7 @@ class Handler(object):
                                                self.config.cloud.port, 60)
                 except Exception as error:
                     # socket.gaierror or ssl.SSLError
-                    self.state = constants.STATE_DISCONNECTED
+                    self.set_state(constants.STATE_DISCONNECTED)
                     self.logger.error(str(error))
 
         if result == 0:
@@ -359,10 +586,12 @@ class Handler(object):
             self.main_thread.start()
 
             # Wait for cloud connection
-            while ((timeout == 0 or current_time < end_time) and
-                   self.state == constants.STATE_CONNECTING):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            with self.state_condition:
+                while self.state == constants.STATE_CONNECTING:
+                    remaining = time_remaining(end_time)
+                    if remaining == 0:
+                        break
+                    self.state_condition.wait(remaining)
 
             # Still connecting, timed out
             if self.state == constants.STATE_CONNECTING:
@@ -374,17 +603,21 @@ class Handler(object):
             status = constants.STATUS_SUCCESS
 
             # Start worker threads if we have successfully connected
+            self.start_publisher()
             for _ in range(self.config.thread_count):
-                self.worker_threads.append(threading.Thread(
-                    target=self.handle_work_loop))
-            for thread in self.worker_threads:
-                thread.start()
+                self.start_worker()
+            if self.transfer_queue is not self.work_queue:
+                for _ in range(self.config.transfer_thread_count):
+                    self.start_worker(self.transfer_queue)
+            if self.long_action_queue is not self.work_queue:
+                for _ in range(self.config.action_thread_count):
+                    self.start_worker(self.long_action_queue)
 
         else:
             # Not connected. Stop main loop.
             self.logger.error("Failed to connect")
             self.to_quit = True
-            self.state = constants.STATE_DISCONNECTED
+            self.set_state(constants.STATE_DISCONNECTED)
             if self.main_thread:
                 self.main_thread.join()
                 self.main_thread = None
@@ -397,27 +630,36 @@ class Handler(object):
         Stop threads and shut down MQTT client
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        end_time = deadline(timeout)
 
-        # Publish any data that was queued before disconnecting
+        # Send anything waiting to be combined
+        self.flush_sends()
+
+        # Publish any data that was queued before disconnecting, including
+        # partial aggregation windows
+        if self.telemetry_windows:
+            self.check_telemetry_windows(flush=True)
         if not self.publish_queue.empty():
-            self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+            self.schedule_publish()
 
         # Wait for pending work that has not been dealt with
         self.logger.info("Disconnecting...")
-        while ((timeout == 0 or current_time < end_time) and
-               not self.work_queue.empty()):
-            sleep(0.1)
-            current_time = datetime.utcnow()
+        with self.work_condition:
+            while self.work_pending():
+                remaining = time_remaining(end_time)
+                if remaining == 0:
+                    break
+                self.work_condition.wait(remaining)
 
         # Optionally wait for any outstanding replies.
         if wait_for_replies and self.is_connected():
             self.logger.info("Waiting for replies...")
-            while ((timeout == 0 or current_time < end_time) and
-                   len(self.reply_tracker) != 0):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            with self.reply_condition:
+                while len(self.reply_tracker) != 0:
+                    remaining = time_remaining(end_time)
+                    if remaining == 0:
+                        break
+                    self.reply_condition.wait(remaining)
 
         self.to_quit = True
         #TODO: Kill any hanging threads
@@ -433,23 +675,45 @@ class Handler(object):
         Handle action execution requests from Cloud
         """
 
-        result_code = -1
-        result_args = {"mail_id":action_request.request_id}
-        action_result = None
-        action_failed = False
-
         try:
             # Execute callback
             action_result = self.callbacks.execute_action(action_request)
-
         except Exception as error:
+            return self.complete_action(action_request, error=error)
+
+        if hasattr(action_result, "add_done_callback"):
+            # The result is deferred, such as a coroutine running on an event
+            # loop. Report the action as invoked until it is done.
+            def complete(result):
+                error = result.exception()
+                if error is not None:
+                    self.complete_action(action_request, error=error)
+                else:
+                    self.complete_action(action_request, result.result())
+            status = self.complete_action(action_request,
+                                          constants.STATUS_INVOKED)
+            action_result.add_done_callback(complete)
+            return status
+        return self.complete_action(action_request, action_result)
+
+    def complete_action(self, action_request, action_result=None, error=None):
+        """
+        Report the result of executing an action, or the error it raised, to
+        the Cloud
+        """
+
+        result_code = -1
+        result_args = {"mail_id":action_request.request_id}
+        action_failed = False
+
+        if error is not None:
             # Error with action execution. Might not have been registered.
             action_failed = True
             self.logger.error("Action %s execution failed", action_request.name)
             self.logger.error(".... %s", str(error))
             result_code = constants.STATUS_FAILURE
             result_args["error_message"] = "ERROR: {}".format(str(error))
-            if action_request.name not in self.callbacks:
+            if self.callbacks.find_action(action_request) is None:
                 result_code = constants.STATUS_NOT_FOUND
             else:
                 self.logger.exception("Exception:")
@@ -494,36 +758,17 @@ class Handler(object):
         if result_args.get("params"):
             message_desc += " \"{}\"".format(str(result_args["params"]))
         message = defs.OutMessage(mailbox_ack, message_desc)
-        status = self.send(message)
+        status = self.queue_send(message)
         return status
 
-    def handle_attribute_get(self, attribute_name ):
+    def handle_attribute_get(self, attribute_name):
+        """
+        Read the current value of an attribute from the Cloud
+        """
+
         command = tr50.create_attribute_current(self.config.key, attribute_name)
         message_desc = "Reading current attribute..."
-        message = defs.OutMessage(command, message_desc)
-
-        self.pub_wait = True
-        status = self.send(message)
-        value = None
-        timestamp = None
-
-        # Wait for response from sending to cloud
-        while self.pub_wait:
-            sleep(0.5)
-        # Convert to return codes
-        if self.pub_response:
-            ret = constants.STATUS_SUCCESS
-        else:
-            ret = constants.STATUS_FAILURE
-
-        # make sure the key exists or there will be a KeyError
-        # exception
-        if 'attribute_current_value' in self.response.keys():
-            value = self.response['attribute_current_value']
-
-        if 'attribute_current_timestamp' in self.response.keys():
-            timestamp = self.response['attribute_current_timestamp']
-        return ret, value, timestamp
+        return self.request_current(command, message_desc)
 
     def calc_file_checksum(self, file_name):
         """
@@ -800,32 +1045,29 @@ class Handler(object):
         if "notify/" in mqtt_message.topic:
             # Received a notification
             if mqtt_message.topic[len("notify/"):] == "mailbox_activity":
-                # Mailbox activity, send a request to check the mailbox
+                # Mailbox activity, send a request to check the mailbox. It
+                # is only ever for this Client's own mailbox.
                 self.logger.info("Recevied notification of mailbox activity")
                 mailbox_check = tr50.create_mailbox_check(auto_complete=False)
-                to_send = defs.OutMessage(mailbox_check, "Mailbox Check")
-                self.send(to_send)
+                self.send(defs.OutMessage(mailbox_check, "Mailbox Check"))
                 status = constants.STATUS_SUCCESS
 
         elif "reply/" in mqtt_message.topic:
-            # Received a reply to a previous message
+            # Received a reply to a previous message. Retrieve every sent
+            # message it answers at once, removing them from being tracked.
             topic_num = mqtt_message.topic[len("reply/"):]
-            for command_num in msg_json:
+            with self.lock:
+                replied, missing = self.reply_tracker.pop_messages(topic_num,
+                                                                   msg_json)
+                if len(self.reply_tracker) == 0:
+                    self.reply_condition.notify_all()
+            for command_num in missing:
+                self.logger.error("Message %s-%s not found. May be a "
+                                  "duplicate reply", topic_num, command_num)
+
+            for command_num, sent_message in replied:
                 reply = msg_json[command_num]
 
-                # Retrieve the sent message that this is a reply for, removing
-                # it from being tracked
-                self.lock.acquire()
-                try:
-                    sent_message = self.reply_tracker.pop_message(topic_num,
-                                                                  command_num)
-                except KeyError as error:
-                    self.logger.error(error.message)
-                    continue
-                finally:
-                    self.lock.release()
-                sent_command_type = sent_message.command.get("command")
-
                 # Log success status of reply
                 if reply.get("success"):
                     self.logger.info("Received success for %s-%s - %s",
@@ -841,111 +1083,156 @@ class Handler(object):
                         sent_message,
                         str(reply))
 
-                # Return "success" status
-                if self.pub_wait:
-                    if self.pub_topic == topic_num:
-                        self.pub_response = reply.get("success")
-                        self.pub_wait = False
-                    else:
-                        self.pub_wait = self.pub_response = False
-
-                # Check what kind of message this is a reply to
-                if sent_command_type == TR50Command.file_get:
-                    # Recevied a reply for a file download request
-                    if reply.get("success"):
-                        file_id = reply["params"].get("fileId")
-                        file_checksum = reply["params"].get("crc32")
-                        file_size = reply["params"].get("fileSize")
-                        file_transfer = sent_message.data
-                        file_transfer.file_id = file_id
-                        file_transfer.file_checksum = file_checksum
-                        file_transfer.file_size = file_size
-                        work = defs.Work(constants.WORK_DOWNLOAD, file_transfer)
-                        self.queue_work(work)
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.file_put:
-                    # Received a reply for a file upload request
-                    if reply.get("success"):
-                        file_id = reply["params"].get("fileId")
-                        file_transfer = sent_message.data
-                        file_transfer.file_id = file_id
-                        work = defs.Work(constants.WORK_UPLOAD, file_transfer)
-                        self.queue_work(work)
-                    else:
-                        sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.mailbox_check:
-                    # Received a reply for a mailbox check
-                    if reply.get("success"):
-                        try:
-                            for mail in reply["params"]["messages"]:
-                                mail_command = mail.get("command")
-                                if mail_command == "method.exec":
-                                    # Action execute request in mailbox
-                                    mail_id = mail.get("id")
-                                    action_name = mail["params"].get("method")
-                                    action_params = mail["params"].get("params")
-                                    action_request = defs.ActionRequest(mail_id,
-                                                                        action_name,
-                                                                        action_params)
-                                    work = defs.Work(constants.WORK_ACTION,
-                                                     action_request)
-                                    self.queue_work(work)
-                        except:
-                            pass
-                elif sent_command_type == TR50Command.diag_time:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                        mill = reply["params"].get("time")
-                        print (datetime.fromtimestamp(mill/1000.0))
+                # Wake up any threads waiting on this reply
+                for future in sent_message.futures:
+                    future.set_reply(reply)
 
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        else:
-                            sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.diag_ping:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       print ('*Connection Okay* \n')
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        else:
-                            sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.property_current:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       params = reply.get("params")
-                       self.response['telemetry_current_value'] = params.get("value")
-                       self.response['telemetry_current_timestamp'] = params.get("ts")
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
-                elif sent_command_type == TR50Command.attribute_current:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       params = reply.get("params")
-                       self.response['attribute_current_value']  = params.get("value")
-                       self.response['attribute_current_timestamp']  = params.get("ts")
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif  sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
+                # Call the handler for the kind of message this is a reply to
+                reply_handler = self.reply_handlers.get(
+                    sent_message.command.get("command"))
+                if reply_handler:
+                    reply_handler(sent_message, reply)
             status = constants.STATUS_SUCCESS
 
         return status
 
+    def reply_failed(self, sent_message, reply):
+        """
+        Set the status of anything waiting on a sent message that failed
+        """
+
+        if sent_message.data is None:
+            return
+        if -90008 in reply.get("errorCodes", []):
+            sent_message.data.status = constants.STATUS_NOT_FOUND
+        else:
+            sent_message.data.status = constants.STATUS_FAILURE
+
+    def reply_callback(self, callback_function, user_data, sent_message,
+                       reply):
+        """
+        Pass a reply to a command registered by the application on to its
+        callback
+        """
+
+        try:
+            callback_function(self.client, reply, user_data)
+        except Exception:
+            self.logger.exception("Exception in reply callback for %s:",
+                                  sent_message)
+
+    def reply_current(self, sent_message, reply):
+        """
+        Received a reply for a current value request. The value is returned to
+        the requester through its reply future.
+        """
+
+        if not reply.get("success"):
+            self.reply_failed(sent_message, reply)
+
+    def reply_diag_ping(self, sent_message, reply):
+        """
+        Received a reply for a ping request
+        """
+
+        if reply.get("success"):
+            print ('*Connection Okay* \n')
+        else:
+            self.reply_failed(sent_message, reply)
+
+    def reply_diag_time(self, sent_message, reply):
+        """
+        Received a reply for a time request
+        """
+
+        if reply.get("success"):
+            mill = reply["params"].get("time")
+            print (datetime.fromtimestamp(mill/1000.0))
+        else:
+            self.reply_failed(sent_message, reply)
+
+    def reply_file_get(self, sent_message, reply):
+        """
+        Received a reply for a file download request
+        """
+
+        if reply.get("success"):
+            file_transfer = sent_message.data
+            file_transfer.file_id = reply["params"].get("fileId")
+            file_transfer.file_checksum = reply["params"].get("crc32")
+            file_transfer.file_size = reply["params"].get("fileSize")
+            work = defs.Work(constants.WORK_DOWNLOAD, file_transfer)
+            self.queue_work(work)
+        else:
+            self.reply_failed(sent_message, reply)
+
+    def reply_file_put(self, sent_message, reply):
+        """
+        Received a reply for a file upload request
+        """
+
+        if reply.get("success"):
+            file_transfer = sent_message.data
+            file_transfer.file_id = reply["params"].get("fileId")
+            work = defs.Work(constants.WORK_UPLOAD, file_transfer)
+            self.queue_work(work)
+        elif sent_message.data is not None:
+            sent_message.data.status = constants.STATUS_FAILURE
+
+    def reply_mailbox_check(self, sent_message, reply):
+        """
+        Received a reply for a mailbox check. Queue any action execute
+        requests in the mailbox. The data of mailbox checks for a child device
+        is its thing key.
+        """
+
+        if reply.get("success"):
+            try:
+                for mail in reply["params"]["messages"]:
+                    if mail.get("command") == "method.exec":
+                        mail_id = mail.get("id")
+                        action_name = mail["params"].get("method")
+                        action_params = mail["params"].get("params")
+                        action_request = defs.ActionRequest(
+                            mail_id, action_name, action_params,
+                            thing_key=sent_message.data)
+                        work = defs.Work(constants.WORK_ACTION,
+                                         action_request)
+                        self.queue_work(work)
+            except:
+                pass
+
+    def reply_deregister(self, command):
+        """
+        Disassociate a callback function from replies to a TR50 command
+        """
+
+        status = constants.STATUS_SUCCESS
+        if command in BUILTIN_REPLY_HANDLERS or \
+           self.reply_handlers.pop(command, None) is None:
+            self.logger.error("No reply callback registered for %s", command)
+            status = constants.STATUS_NOT_FOUND
+        return status
+
+    def reply_register_callback(self, command, callback_function,
+                                user_data=None):
+        """
+        Associate a callback function with replies to a TR50 command
+        """
+
+        status = constants.STATUS_SUCCESS
+        if command in self.reply_handlers:
+            self.logger.error("Failed to register reply callback. Replies to "
+                              "%s are already handled", command)
+            status = constants.STATUS_EXISTS
+        else:
+            self.reply_handlers[command] = functools.partial(
+                self.reply_callback, callback_function, user_data)
+            self.logger.info("Registered reply callback for \"%s\" with "
+                             "function \"%s\"", command,
+                             callback_function.__name__)
+        return status
+
     def handle_publish(self):
         """
         Publish any pending publishes in the publish queue, or the cloud logger
@@ -953,170 +1240,327 @@ class Handler(object):
 
         status = constants.STATUS_SUCCESS
 
-        # Collect all pending publishes in publish queue
+        # Allow another publish to be scheduled for anything queued from now on
+        with self.publish_lock:
+            self.publish_pending = False
+
+        # Leave publishes queued while offline. They are flushed in order once
+        # the connection is re-established.
+        if not self.is_connected():
+            return constants.STATUS_SUCCESS
+
+        # Collect pending publishes in publish queue, up to the maximum batch
+        # size
+        max_batch = self.config.publish_max_batch
         to_publish = []
-        while not self.publish_queue.empty():
+        while not max_batch or len(to_publish) < max_batch:
             try:
-                to_publish.append(self.publish_queue.get())
+                to_publish.append(self.publish_queue.get_nowait())
             except queue.Empty:
                 break
 
+        # Flush anything left over straight away
+        if max_batch and not self.publish_queue.empty():
+            self.schedule_publish()
+
         if to_publish:
-            # If pending publishes are found, parse into list for sending
-            messages = []
-            batch = {}
-            batch['PublishAlarm'] = []
-            batch['PublishAttribute'] = []
-            batch['PublishTelemetry'] = []
-            batch['PublishLocation'] = []
-            batch['PublishLog'] = []
+            # Publishes from the publish store stay on disk until sent
+            taken = list(to_publish)
+            if self.config.publish_coalesce:
+                futures = dict((pub_type, []) for pub_type in PUBLISH_TYPES)
+                to_publish = self.coalesce_publishes(to_publish, futures)
+            else:
+                futures = None
+
+            # Group pending publishes by the command they are sent in, and in
+            # gateway mode by the thing they are for, the Client's own first.
+            # Blocks of telemetry are sent in the same batch as single samples.
+            pending = dict((pub_type, {}) for pub_type in PUBLISH_TYPES)
             for pub in to_publish:
-                message = None
-                # ------------------
-                # Alarms
-                # ------------------
-                if pub.type == "PublishAlarm":
-                    batch[pub.type].append(
-                        tr50.create_alarm_batch_item(
-                            pub.name,
-                            pub.state,
-                            pub.timestamp,
-                            pub.message,
-                            pub.republish))
-
-                # ------------------
-                # Attributes
-                # ------------------
-                elif pub.type == "PublishAttribute":
-                    batch[pub.type].append(
-                        tr50.create_attribute_batch_item(
-                            pub.name,
-                            pub.value,
-                            pub.timestamp))
-
-                elif pub.type == "PublishTelemetry":
-                    batch[pub.type].append(
-                        tr50.create_property_batch_item(
-                            pub.name,
-                            pub.value,
-                            pub.timestamp,
-                            corr_id=pub.corr_id))
-
-                # ------------------
-                # Location
-                # ------------------
-                elif pub.type == "PublishLocation":
-                    batch[pub.type].append(
-                        tr50.create_location_batch_item(
-                            pub.latitude,
-                            pub.longitude,
-                            pub.heading,
-                            pub.altitude,
-                            pub.speed,
-                            pub.accuracy,
-                            pub.fix_type,
-                            pub.timestamp))
-
-                # ------------------
-                # Event logs
-                # ------------------
-                elif pub.type == "PublishLog":
-                    command = tr50.create_log_publish(self.config.key,
-                                                      pub.message,
-                                                      timestamp=pub.timestamp)
-                    message_desc = "Log Publish {}".format(pub.message)
-                    message = defs.OutMessage(command, message_desc)
-
-                if message:
-                    messages.append(message)
-
-            # Send all publishes
-            if messages:
-                status = self.send(messages)
-
-            # send out batches
-            if batch['PublishAlarm']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_alarm_publish(self.config.key,
-                                                    "alarm_batch",
-                                                    "Alarm Batch",
+                if pub.type == "PublishTelemetryBatch":
+                    pub_type = "PublishTelemetry"
+                else:
+                    pub_type = pub.type
+                pending[pub_type].setdefault(pub.thing_key, []).append(pub)
+
+            # Write requests straight to bytes, starting a new request
+            # whenever the maximum payload size would be exceeded. Unless
+            # publishes are combined, event logs share one request and each
+            # publish type gets its own, with a batch command per thing.
+            writer = tr50.RequestWriter(self.config.publish_max_payload or 0)
+            out_requests = []
+            log_max_batch = self.config.log_max_batch
+            logs = [pub for pubs in self.by_thing(pending["PublishLog"])
+                    for pub in pubs]
+            for num, pub in enumerate(logs):
+                if log_max_batch and num and num % log_max_batch == 0:
+                    out_requests.extend(writer.finish())
+                log_time = defs.format_timestamp(pub.timestamp)
+                command = tr50.create_log_publish(
+                    pub.thing_key or self.config.key, pub.message,
+                    timestamp=log_time)
+                message_desc = "Log Publish {}".format(pub.message)
+                writer.add_command(command, (command, message_desc),
+                                   [pub.future] if pub.future else None)
+
+            timestamp = defs.format_timestamp(defs.epoch_ms())
+            for pub_type in PUBLISH_TYPES[1:]:
+                if not pending[pub_type]:
+                    continue
+                if not self.config.publish_combine:
+                    out_requests.extend(writer.finish())
+                for pubs in self.by_thing(pending[pub_type]):
+                    command, message_desc = self.batch_header(
+                        pub_type, timestamp, pubs[0].thing_key)
+                    writer.begin_batch(command["command"], command["params"],
+                                       (command, message_desc))
+                    for pub in pubs:
+                        self.write_batch_items(writer, pub)
+                if futures and futures[pub_type]:
+                    # Superseded publishes resolve with the last part
+                    writer.parts[-1][2].extend(futures[pub_type])
+            out_requests.extend(writer.finish())
+
+            # Send all publishes. Publishes from the publish store stay on disk
+            # until every request they were sent in has been replied to.
+            replies = []
+            if self.publish_store:
+                replies = [defs.ReplyFuture() for _ in out_requests]
+                self.track_stored(taken, replies)
+            unsent = list(replies)
+            try:
+                for num, (payload, parts) in enumerate(out_requests):
+                    messages = [defs.OutMessage(command, message_desc,
+                                                futures=part_futures)
+                                for (command, message_desc), _, part_futures
+                                in parts]
+                    if replies:
+                        messages[0].futures.append(replies[num])
+                    status = self.send(messages, payload)
+                    if replies and status == constants.STATUS_SUCCESS:
+                        unsent.remove(replies[num])
+            finally:
+                # Requests that were not sent will never be replied to
+                for reply in unsent:
+                    reply.set_reply(None)
+
+        return status
+
+    def track_stored(self, pubs, replies):
+        """
+        Remove publishes taken from the publish store once the Cloud has
+        replied to every request they were sent in, or return them to the
+        store to be sent again if any request gets no reply
+        """
+
+        lock = threading.Lock()
+        remaining = [len(replies)]
+        failed = [False]
+
+        def done(reply):
+            with lock:
+                remaining[0] -= 1
+                if reply.reply is None:
+                    failed[0] = True
+                if remaining[0]:
+                    return
+            if failed[0]:
+                # The main loop flushes them again
+                self.publish_store.requeue(pubs)
+            else:
+                self.publish_store.sent(pubs)
+
+        if not replies:
+            self.publish_store.sent(pubs)
+        for reply in replies:
+            reply.add_done_callback(done)
+
+    def by_thing(self, pending):
+        """
+        Return the lists of publishes for each thing key in a dict of them,
+        the Client's own first
+        """
+
+        own = pending.get(None)
+        others = [pubs for thing_key, pubs in pending.items() if thing_key]
+        return [own] + others if own else others
+
+    def batch_header(self, pub_type, timestamp, thing_key=None):
+        """
+        Return the batch command, without its data, that publishes of a type
+        are sent in, and a description of it. Batches for a child device in
+        gateway mode are sent with its thing key.
+        """
+
+        key = thing_key or self.config.key
+
+        if pub_type == "PublishAlarm":
+            command = tr50.create_alarm_publish(key,
+                                                "alarm_batch",
+                                                "Alarm Batch",
+                                                timestamp=timestamp,
+                                                republish=False,
+                                                batch=True)
+            command['params']['state'] = 0
+            message_desc = "Alarm Publish {}".format("alarm_batch")
+            message_desc += " : \"{}\"".format("Alarm Batch")
+        elif pub_type == "PublishAttribute":
+            command = tr50.create_attribute_publish(key,
+                                                    "attribute_batch",
+                                                    "Attribute Batch",
                                                     timestamp=timestamp,
-                                                    republish=False,
                                                     batch=True)
-                message_desc = "Alarm Publish {}".format("alarm_batch")
-                message_desc += " : \"{}\"".format("Alarm Batch")
-                batch_msg = defs.OutMessage(command, message_desc)
-                batch_msg.command['params']['state'] = 0
-                batch_msg.command['params']['data'] = batch['PublishAlarm']
-                status = self.send(batch_msg)
-
-            if batch['PublishAttribute']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_attribute_publish(self.config.key,
-                                                        "attribute_batch",
-                                                        "Attribute Batch",
-                                                        timestamp=timestamp,
-                                                        batch=True)
-                message_desc = "Attribute Publish {}".format("attribute_batch")
-                message_desc += " : \"{}\"".format("Attribute Batch")
-                batch_msg = defs.OutMessage(command, message_desc)
-                batch_msg.command['params']['data'] = batch['PublishAttribute']
-                status = self.send(batch_msg)
-
-            if batch['PublishLocation']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_location_publish(self.config.key,
-                                                        "location_batch",
-                                                        "Location Batch",
-                                                        timestamp=timestamp,
-                                                        batch=True)
-                message_desc = "Location Publish {}".format("location_batch")
-                message_desc += " : \"{}\"".format("Location Batch")
-                batch_msg = defs.OutMessage(command, message_desc)
-                batch_msg.command['params']['data'] = batch['PublishLocation']
-                status = self.send(batch_msg)
-
-            if batch['PublishTelemetry']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_property_publish(self.config.key,
-                                                        "property_batch",
-                                                        "Property Batch",
-                                                        corr_id=timestamp,
-                                                        timestamp=timestamp,
-                                                        batch=True)
-                message_desc = "Property Publish {}".format("property_batch")
-                message_desc += " : \"{}\"".format("Property Batch")
-                batch_msgs = defs.OutMessage(command, message_desc)
-                batch_msgs.command['params']['data'] =  batch['PublishTelemetry']
-                status = self.send(batch_msgs)
+            message_desc = "Attribute Publish {}".format("attribute_batch")
+            message_desc += " : \"{}\"".format("Attribute Batch")
+        elif pub_type == "PublishLocation":
+            command = tr50.create_location_publish(key,
+                                                   "location_batch",
+                                                   "Location Batch",
+                                                   timestamp=timestamp,
+                                                   batch=True)
+            message_desc = "Location Publish {}".format("location_batch")
+            message_desc += " : \"{}\"".format("Location Batch")
+        else:
+            command = tr50.create_property_publish(key,
+                                                   "property_batch",
+                                                   "Property Batch",
+                                                   corr_id=timestamp,
+                                                   timestamp=timestamp,
+                                                   batch=True)
+            message_desc = "Property Publish {}".format("property_batch")
+            message_desc += " : \"{}\"".format("Property Batch")
+        return command, message_desc
 
-        return status
+    def write_batch_items(self, writer, pub):
+        """
+        Write the batch items for a publish
+        """
+
+        if pub.type == "PublishTelemetryBatch":
+            # Every sample has its own timestamp. The future resolves with the
+            # part holding the last sample.
+            last = len(pub.values) - 1
+            for num, value in enumerate(pub.values):
+                writer.add_item(tr50.encode_property_batch_item(
+                    pub.name, value,
+                    defs.format_timestamp(pub.timestamps[num]),
+                    pub.corr_id), pub.future if num == last else None)
+            return
+
+        timestamp = defs.format_timestamp(pub.timestamp)
+        if pub.type == "PublishTelemetry":
+            writer.add_item(tr50.encode_property_batch_item(
+                pub.name, pub.value, timestamp, pub.corr_id), pub.future)
+
+        elif pub.type == "PublishAlarm":
+            writer.add_item(codec.dumps(tr50.create_alarm_batch_item(
+                pub.name, pub.state, timestamp, pub.message,
+                pub.republish)), pub.future)
+
+        elif pub.type == "PublishAttribute":
+            writer.add_item(codec.dumps(tr50.create_attribute_batch_item(
+                pub.name, pub.value, timestamp)), pub.future)
 
-    def handle_work_loop(self):
+        elif pub.type == "PublishLocation":
+            writer.add_item(codec.dumps(tr50.create_location_batch_item(
+                pub.latitude, pub.longitude, pub.heading, pub.altitude,
+                pub.speed, pub.accuracy, pub.fix_type, timestamp)),
+                            pub.future)
+
+
+    def handle_publish_loop(self):
         """
-        Loop for worker threads to handle any items put on the work queue
+        Loop for the publisher thread, the only thread publishing once
+        connected, so that pending publishes are sent in whole batches and in
+        order
         """
 
+        while not self.to_quit:
+            with self.publish_condition:
+                if not self.publish_pending or self.publish_busy:
+                    self.publish_condition.wait(self.config.loop_time)
+                if not self.publish_pending or self.publish_busy:
+                    continue
+                self.publish_busy = True
+            try:
+                self.handle_publish()
+            except Exception:
+                # Print traceback, but don't kill thread
+                self.logger.exception("Exception:")
+            finally:
+                with self.publish_lock:
+                    self.publish_busy = False
+                with self.work_condition:
+                    self.work_condition.notify_all()
+
+        return constants.STATUS_SUCCESS
+
+    def handle_publish_work(self):
+        """
+        Publish from a worker thread, one at a time. Once the publisher thread
+        is running, publish work still on the work queue is handed to it
+        instead.
+        """
+
+        with self.publish_condition:
+            while self.publish_busy and not self.publish_thread:
+                self.publish_condition.wait(self.config.loop_time)
+            if self.publish_thread:
+                self.publish_pending = True
+                self.publish_condition.notify_all()
+                return constants.STATUS_SUCCESS
+            self.publish_busy = True
+        try:
+            return self.handle_publish()
+        finally:
+            with self.publish_condition:
+                self.publish_busy = False
+                self.publish_condition.notify_all()
+            with self.work_condition:
+                self.work_condition.notify_all()
+
+    def handle_work_loop(self, work_queue=None):
+        """
+        Loop for worker threads to handle any items put on the work queue, or
+        on another queue such as the transfer queue
+        """
+
+        if work_queue is None:
+            work_queue = self.work_queue
+        idle_start = monotonic()
+
         # Continuously loop while connected
         while not self.to_quit:
             work = None
             try:
-                work = self.work_queue.get(timeout=self.config.loop_time)
+                work = work_queue.get(timeout=self.config.loop_time)
+                with self.work_condition:
+                    self.work_condition.notify_all()
             except queue.Empty:
                 pass
+            if work:
+                idle_start = None
+            elif idle_start is None:
+                idle_start = monotonic()
+            elif (work_queue is self.work_queue and
+                  monotonic() - idle_start >= self.config.thread_idle_timeout
+                  and self.stop_worker()):
+                break
             # If work is retrieved from the queue, handle it based on type
             if work:
                 try:
                     if work.type == constants.WORK_MESSAGE:
                         self.handle_message(work.data)
                     elif work.type == constants.WORK_PUBLISH:
-                        self.handle_publish()
+                        self.handle_publish_work()
                     elif work.type == constants.WORK_ACTION:
                         self.handle_action(work.data)
                     elif work.type == constants.WORK_DOWNLOAD:
                         self.handle_file_download(work.data)
                     elif work.type == constants.WORK_UPLOAD:
                         self.handle_file_upload(work.data)
+                    elif work.type == constants.WORK_MAILBOX:
+                        self.check_child_mailboxes(work.data)
                 except Exception:
                     # Print traceback, but don't kill thread
                     self.logger.exception("Exception:")
@@ -1163,7 +1607,7 @@ class Handler(object):
                             unset)
             message_desc = "Update Thing Details"
             message = defs.OutMessage(command, message_desc)
-            status = self.send(message)
+            status = self.queue_send(message)
         return status
 
     def handle_time(self):
@@ -1176,37 +1620,184 @@ class Handler(object):
         status = self.send(message)
         return constants.STATUS_SUCCESS
 
-    def handle_telemetry_get(self, telem_name ):
+    def aggregate_telemetry(self, telem_name, value, window=True):
+        """
+        Add a telemetry sample to the aggregation window for its key. Windows
+        last window seconds, or telemetry_aggregate_window if window is True.
+        """
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            self.logger.error("Only numbers can be aggregated, not %s for %s",
+                              type(value).__name__, telem_name)
+            return constants.STATUS_BAD_PARAMETER
+
+        with self.aggregate_lock:
+            telem_window = self.telemetry_windows.get(telem_name)
+            if telem_window is None:
+                if window is True:
+                    window = self.config.telemetry_aggregate_window
+                if window is True or window is None:
+                    window = constants.DEFAULT_TELEMETRY_AGGREGATE_WINDOW
+                stats = self.config.telemetry_aggregate_stats
+                if stats is None:
+                    stats = constants.DEFAULT_TELEMETRY_AGGREGATE_STATS
+                telem_window = defs.TelemetryWindow(
+                    window, stats, self.config.telemetry_aggregate_percentiles)
+                self.telemetry_windows[telem_name] = telem_window
+            telem_window.add(value)
+        return constants.STATUS_SUCCESS
+
+    def check_telemetry_windows(self, flush=False):
         """
-        Add data to publish queue and wait for cloud response
+        Publish the statistics of aggregation windows that have ended, or of
+        every open window if flush is set. Each statistic is published as
+        telemetry named <telemetry name>.<statistic>.
+        """
+
+        with self.aggregate_lock:
+            ended = [(name, telem_window) for name, telem_window
+                     in self.telemetry_windows.items()
+                     if flush or telem_window.expired()]
+            for name, _ in ended:
+                del self.telemetry_windows[name]
+
+        # Called from the main loop, which must not wait for room in the
+        # publish queue: only the main loop schedules the flushes that free it
+        for name, telem_window in ended:
+            for stat, value in telem_window.results():
+                self.queue_publish(defs.PublishTelemetry(
+                    "{}.{}".format(name, stat), value), block=False)
+
+    def check_telemetry_heartbeats(self):
+        """
+        Republish the latest sample of any filtered telemetry that has not been
+        published for its max_interval
+        """
+
+        for name, telem_filter in list(self.telemetry_filters.items()):
+            due, value = telem_filter.heartbeat()
+            if due:
+                self.logger.debug("Telemetry heartbeat for %s", name)
+                self.queue_publish(defs.PublishTelemetry(name, value),
+                                   block=False)
+
+    def filter_telemetry(self, telem_name, value):
         """
+        Return whether a telemetry sample passes its filter, if any
+        """
+
+        telem_filter = self.telemetry_filters.get(telem_name)
+        return telem_filter is None or telem_filter.accept(value)
+
+    def expire_replies(self):
+        """
+        Stop waiting for replies that are overdue, failing anything waiting on
+        them
+        """
+
+        with self.lock:
+            expired = self.reply_tracker.pop_expired()
+            if expired and len(self.reply_tracker) == 0:
+                self.reply_condition.notify_all()
+
+        for message in expired:
+            self.logger.error("No reply received for %s - %s (%s)",
+                              message.out_id, message,
+                              json.dumps(message.command, sort_keys=True))
+            self.fail_unreplied(message, constants.STATUS_TIMED_OUT)
+        return len(expired)
+
+    def fail_unreplied(self, message, status):
+        """
+        Release anything waiting on a message that will never get a reply
+        """
+
+        for future in message.futures:
+            future.set_reply(None)
+        if (isinstance(message.data, defs.FileTransfer) and
+                message.data.status is None):
+            message.data.status = status
+
+    def filter_log(self, message):
+        """
+        Apply log_rate_interval to an event. Returns the text to publish, or
+        None if the event should be dropped.
+        """
+
+        interval = self.config.log_rate_interval
+        if not interval:
+            return message
+
+        now = monotonic()
+        with self.log_lock:
+            last_sent, dropped = self.log_history.get(message, (None, 0))
+            if last_sent is not None and now - last_sent < interval:
+                self.log_history[message] = (last_sent, dropped + 1)
+                return None
+
+            if len(self.log_history) >= constants.LOG_RATE_TRACKED:
+                # Forget events that are no longer being limited
+                self.log_history = dict(
+                    (text, entry) for text, entry in self.log_history.items()
+                    if now - entry[0] < interval)
+                if len(self.log_history) >= constants.LOG_RATE_TRACKED:
+                    self.log_history = {}
+            self.log_history[message] = (now, 0)
+
+        if dropped:
+            message = "{} (repeated {} more times)".format(message, dropped)
+        return message
+
+    def flush_sends(self):
+        """
+        Send every command waiting for send_linger, in order, split into
+        requests that fit the maximum payload size
+        """
+
+        with self.send_lock:
+            pending = self.send_pending
+            self.send_pending = []
+            if self.send_timer:
+                self.send_timer.cancel()
+                self.send_timer = None
+
+        status = constants.STATUS_SUCCESS
+        if pending:
+            commands = [message.command for message in pending]
+            for request in tr50.split_requests(
+                    commands, self.config.publish_max_payload or 0):
+                status = self.send([pending[num] for num in request])
+        return status
+
+    def handle_telemetry_get(self, telem_name):
+        """
+        Read the current value of a telemetry property from the Cloud
+        """
+
         command = tr50.create_property_get_current(self.config.key, telem_name)
         message_desc = "Reading current property..."
-        message = defs.OutMessage(command, message_desc)
+        return self.request_current(command, message_desc)
 
-        self.pub_wait = True
-        status = self.send(message)
-        value = None
-        timestamp = None
-
-        # Wait for response from sending to cloud
-        while self.pub_wait:
-            sleep(0.5)
-        # Convert to return codes
-        if self.pub_response:
-            ret = constants.STATUS_SUCCESS
-        else:
-            ret = constants.STATUS_FAILURE
+    def work_pending(self):
+        """
+        Return whether any work is queued or a publish is in progress
+        """
 
-        # make sure the key exists or there will be a KeyError
-        # exception
-        if 'telemetry_current_value' in self.response.keys():
-            value = self.response['telemetry_current_value']
+        return bool(self.publish_pending or self.publish_busy or
+                    not self.work_queue.empty() or
+                    not self.transfer_queue.empty() or
+                    not self.long_action_queue.empty())
 
-        if 'telemetry_current_timestamp' in self.response.keys():
-            timestamp = self.response['telemetry_current_timestamp']
-        return ret, value, timestamp
+    def work_status(self):
+        """
+        Return the number of worker threads serving the work queue and how
+        long work waits in it
+        """
 
+        return {"workers":self.worker_count,
+                "queued":self.work_queue.qsize(),
+                "queue_wait":self.work_queue.wait_time(),
+                "last_wait":self.work_queue.last_wait}
 
     def is_connected(self):
         """
@@ -1258,14 +1849,13 @@ class Handler(object):
             # If disconnected, attempt to reestablish connection
             if self.state == constants.STATE_DISCONNECTED:
                 max_time = self.config.keep_alive
-                elapsed_time = (datetime.utcnow() -
-                                self.last_connected).total_seconds()
+                elapsed_time = monotonic() - self.last_connected
                 if max_time == 0 or elapsed_time < max_time:
                     try:
                         result = self.mqtt.reconnect()
                         if result == 0:
                             self.logger.debug("Reconnecting...")
-                            self.state = constants.STATE_CONNECTING
+                            self.set_state(constants.STATE_CONNECTING)
                     except Exception:
                         sleep(self.config.loop_time)
                 else:
@@ -1277,9 +1867,27 @@ class Handler(object):
 
             self.mqtt.loop(timeout=self.config.loop_time)
 
-            # Make a work item to publish anything that's pending
-            if not self.publish_queue.empty():
-                self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+            # Make a work item to publish anything that's pending once the
+            # oldest pending publish has waited for the linger time
+            if self.publish_store:
+                self.publish_store.commit()
+            self.expire_replies()
+            if self.config.thread_count_max:
+                self.scale_workers()
+            if self.telemetry_windows:
+                self.check_telemetry_windows()
+            if self.telemetry_filters and self.is_connected():
+                self.check_telemetry_heartbeats()
+            if self.children and self.is_connected():
+                self.schedule_child_check()
+            if not self.publish_queue.empty() and self.is_connected():
+                current_time = monotonic()
+                if self.publish_linger_start is None:
+                    self.publish_linger_start = current_time
+                linger = self.config.publish_linger or 0
+                if current_time - self.publish_linger_start >= linger:
+                    self.publish_linger_start = None
+                    self.schedule_publish()
 
         # One last loop to send out any pending messages
         self.mqtt.loop(timeout=0.1)
@@ -1288,9 +1896,22 @@ class Handler(object):
         self.mqtt.disconnect()
 
         # Wait for worker threads to finish.
-        for thread in self.worker_threads:
+        if self.publish_thread:
+            with self.publish_condition:
+                self.publish_condition.notify_all()
+            self.publish_thread.join()
+            self.publish_thread = None
+        with self.worker_lock:
+            worker_threads = list(self.worker_threads)
+        for thread in worker_threads:
             thread.join()
         self.worker_threads = []
+        self.worker_count = 0
+
+        # Write anything still pending to disk for the next connection, and
+        # close the publish store. It is reopened if it is used again.
+        if self.publish_store:
+            self.publish_store.close()
 
         # On disconnect, show all messages that never received replies
         if len(self.reply_tracker) > 0:
@@ -1298,6 +1919,7 @@ class Handler(object):
             for mid, message in self.reply_tracker.items():
                 self.logger.error(".... %s - %s", mid,
                                   message.description)
+                self.fail_unreplied(message, constants.STATUS_FAILURE)
 
         return constants.STATUS_SUCCESS
 
@@ -1317,10 +1939,12 @@ class Handler(object):
         # Check connection result from MQTT
         self.logger.info("MQTT connected: %s", mqttlib.connack_string(rc))
         if rc == 0:
-            self.state = constants.STATE_CONNECTED
+            # Check child mailboxes for anything that arrived while offline
+            self.child_check_time = None
+            self.set_state(constants.STATE_CONNECTED)
         else:
-            self.state = constants.STATE_DISCONNECTED
-            self.last_connected = datetime.utcnow()
+            self.last_connected = monotonic()
+            self.set_state(constants.STATE_DISCONNECTED)
 
     def on_disconnect(self, mqtt, userdata, rc):
         """
@@ -1331,15 +1955,15 @@ class Handler(object):
             self.logger.info("MQTT disconnected")
         else:
             self.logger.error("MQTT connection lost. Attempting to reconnect...")
-            self.last_connected = datetime.utcnow()
-        self.state = constants.STATE_DISCONNECTED
+            self.last_connected = monotonic()
+        self.set_state(constants.STATE_DISCONNECTED)
 
     def on_message(self, mqtt, userdata, msg):
         """
         Callback when MQTT Client receives a message
         """
 
-        message = defs.Message(msg.topic, json.loads(msg.payload.decode()))
+        message = defs.Message(msg.topic, codec.loads(msg.payload))
         self.logger.debug("Received message on topic \"%s\"\n%s", msg.topic,
                           message)
 
@@ -1352,10 +1976,68 @@ class Handler(object):
         """
         Notify that a message has been published
         """
-        if self.reply_tracker != {}:
+        if self.reply_tracker.mid_tracker:
             topic_num = self.reply_tracker.pop_mid(mid)
             self.logger.debug("MQTT sent %s", topic_num)
 
+    def schedule_publish(self):
+        """
+        Wake the publisher thread to publish pending publishes, or queue work
+        to do so if it is not running, unless a publish is already waiting
+        """
+
+        with self.publish_condition:
+            if self.publish_pending:
+                return constants.STATUS_SUCCESS
+            self.publish_pending = True
+            if self.publish_thread:
+                self.publish_condition.notify()
+                return constants.STATUS_SUCCESS
+        return self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+
+    def schedule_child_check(self):
+        """
+        Make a work item to check the mailboxes of child devices if they have
+        not been checked since connecting, or for child_mailbox_interval
+        seconds
+        """
+
+        current_time = monotonic()
+        interval = self.config.child_mailbox_interval
+        if self.child_check_time is not None and \
+           (not interval or current_time - self.child_check_time < interval):
+            return False
+        self.child_check_time = current_time
+        self.queue_work(defs.Work(constants.WORK_MAILBOX, None))
+        return True
+
+    def scale_workers(self):
+        """
+        Start another worker thread if the oldest pending work has waited
+        longer than work_wait_target, up to thread_count_max worker threads
+        """
+
+        wait_time = self.work_queue.wait_time()
+        if wait_time <= self.config.work_wait_target:
+            return False
+        with self.worker_lock:
+            if self.worker_count >= self.config.thread_count_max:
+                return False
+        self.logger.debug("Work waited %.2fs, starting worker thread %d",
+                          wait_time, self.worker_count + 1)
+        self.start_worker()
+        return True
+
+    def set_state(self, state):
+        """
+        Update the connection state and wake any threads waiting for it to
+        change
+        """
+
+        with self.state_condition:
+            self.state = state
+            self.state_condition.notify_all()
+
     def qos_level(self, qos_level=None):
         """
         Set QoS Level
@@ -1368,58 +2050,146 @@ class Handler(object):
             self.logger.warning("qos_level invalid or not set, 1 used as default")
             self.qos_level = 1
 
-    def queue_publish(self, pub):
+    def queue_publish(self, pub, block=True):
         """
-        Place pub in the publish queue
+        Place pub in the publish queue. With block unset, a full queue drops
+        its oldest publishes instead of waiting for room, whatever the
+        publish_queue_policy.
         """
 
-        self.publish_queue.put(pub)
+        status = constants.STATUS_SUCCESS
+        dropped = self.publish_queue.put(pub, block)
+        if dropped:
+            self.logger.warning("Publish queue full. Dropped %d publishes",
+                                dropped)
+            status = constants.STATUS_FULL
+
+        # Don't wait for the linger time once a full batch is pending
+        max_batch = self.config.publish_max_batch
+        if max_batch and self.publish_queue.qsize() >= max_batch:
+            self.schedule_publish()
+        return status
+
+    def queue_send(self, message):
+        """
+        Send a command, first waiting up to send_linger seconds to combine it
+        with any others sent in the meantime
+        """
+
+        linger = self.config.send_linger
+        if not linger:
+            return self.send(message)
+
+        with self.send_lock:
+            self.send_pending.append(message)
+            if not self.send_timer:
+                self.send_timer = threading.Timer(linger, self.flush_sends)
+                self.send_timer.daemon = True
+                self.send_timer.start()
         return constants.STATUS_SUCCESS
 
     def queue_work(self, work):
         """
-        Place work in the work queue
+        Place work in the work queue. File transfers are placed in the
+        transfer queue, and long running actions in the long action queue.
         """
 
-        self.work_queue.put(work)
+        work_queue = self.work_queue
+        if work.type in (constants.WORK_DOWNLOAD, constants.WORK_UPLOAD):
+            work_queue = self.transfer_queue
+        elif work.type == constants.WORK_ACTION:
+            action = self.callbacks.find_action(work.data)
+            if action and action.long_running:
+                work_queue = self.long_action_queue
+        work_queue.put(work)
         return constants.STATUS_SUCCESS
 
+    def request_current(self, command, message_desc):
+        """
+        Send a request for a current value and wait for the Cloud's reply
+        """
+
+        value = None
+        timestamp = None
+
+        status, future = self.send_current(command, message_desc)
+        if status == constants.STATUS_SUCCESS:
+            # Wait for response from sending to cloud
+            if not future.wait(constants.REPLY_TIMEOUT):
+                status = constants.STATUS_TIMED_OUT
+            else:
+                status, value, timestamp = self.current_result(future)
+        return status, value, timestamp
+
+    def send_current(self, command, message_desc):
+        """
+        Send a request for a current value without waiting for the reply.
+        Returns the send status and the future the reply is set on.
+        """
+
+        future = defs.ReplyFuture()
+        message = defs.OutMessage(command, message_desc, futures=[future])
+        return self.send(message), future
+
+    def current_result(self, future):
+        """
+        Return the status, value and timestamp from the reply to a request for
+        a current value
+        """
+
+        if not future.success():
+            return constants.STATUS_FAILURE, None, None
+        params = future.reply.get("params", {})
+        return constants.STATUS_SUCCESS, params.get("value"), params.get("ts")
+
+    def request_command(self, command, params=None):
+        """
+        Send any TR50 command. Its reply is passed to the callback registered
+        for the command, if any.
+        """
+
+        cmd = {"command":command}
+        if params is not None:
+            cmd["params"] = params
+        message = defs.OutMessage(cmd, "Command {}".format(command))
+        return self.send(message)
+
     def request_publish(self, data, cloud_response):
         """
         Add data to publish queue and wait for cloud response
         """
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=15)
-        timeout = False
 
-        self.pub_wait = cloud_response
+        if cloud_response:
+            data.future = defs.ReplyFuture()
         status = self.queue_publish(data)
         if cloud_response:
-            status = constants.STATUS_FAILURE
             # Wait for response from sending to cloud
-            while self.pub_wait and not self.to_quit:
-                current_time = datetime.utcnow()
-                if (current_time > end_time):
-                    timeout = True
-                    break
-                else:
-                    sleep(0.5)
-
-            # Convert to return codes
-            if self.pub_response:
-                status = constants.STATUS_SUCCESS
-            elif timeout:
+            if not data.future.wait(constants.REPLY_TIMEOUT):
                 status = constants.STATUS_TIMED_OUT
+            else:
+                status = self.publish_status(data.future, status)
         return status
 
-    def request_download(self, file_name, file_dest, blocking=False,
-                         callback=None, timeout=0, file_global=False):
+    def publish_status(self, future, status):
         """
-        Request a C2D file transfer
+        Return the status of a publish from the Cloud's reply to it, given the
+        status it was queued with. Data dropped from a full publish queue is
+        reported even if the publish itself succeeded.
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        if status == constants.STATUS_FULL:
+            return status
+        if future.success():
+            return constants.STATUS_SUCCESS
+        return constants.STATUS_FAILURE
+
+    def request_download(self, file_name, file_dest, blocking=False,
+                         callback=None, timeout=0, file_global=False,
+                         on_done=None):
+        """
+        Request a C2D file transfer. on_done(transfer) is called once the file
+        transfer is done, whether it succeeded or not.
+        """
 
         self.logger.info("Request download of %s", file_name)
 
@@ -1430,6 +2200,8 @@ class Handler(object):
         # File Transfer object for tracking progress
         transfer = defs.FileTransfer(file_name, file_dest, self.client,
                                      callback=callback)
+        if on_done:
+            transfer.add_done_callback(on_done)
 
         # Generate and send message to request file transfer
         command = tr50.create_file_get(self.config.key, file_name, file_global)
@@ -1439,12 +2211,7 @@ class Handler(object):
 
         # If blocking is set, wait for result of file transfer
         if status == constants.STATUS_SUCCESS and blocking:
-            while ((timeout == 0 or current_time < end_time) and
-                   transfer.status is None):
-                sleep(0.1)
-                current_time = datetime.utcnow()
-
-            if transfer.status is None:
+            if not transfer.wait(timeout or None):
                 status = constants.STATUS_TIMED_OUT
             else:
                 status = transfer.status
@@ -1452,14 +2219,14 @@ class Handler(object):
         return status
 
     def request_upload(self, file_path, upload_name=None, blocking=False,
-                       callback=None, timeout=0, file_global=False):
+                       callback=None, timeout=0, file_global=False,
+                       on_done=None):
         """
-        Request a D2C file transfer
+        Request a D2C file transfer. on_done(transfer) is called once the file
+        transfer is done, whether it succeeded or not.
         """
 
         status = constants.STATUS_SUCCESS
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
         transfer = None
 
         self.logger.info("Request upload of %s", file_path)
@@ -1493,6 +2260,8 @@ class Handler(object):
                 transfer = defs.FileTransfer(upload_name, file_path,
                                              self.client,
                                              callback=callback)
+                if on_done:
+                    transfer.add_done_callback(on_done)
 
                 # Generate and send message to request file transfer
                 command = tr50.create_file_put(self.config.key, upload_name,
@@ -1506,21 +2275,83 @@ class Handler(object):
 
                 # If blocking is set, wait for result of file transfer
                 if status == constants.STATUS_SUCCESS and blocking:
-                    while ((timeout == 0 or current_time < end_time) and
-                           not self.to_quit and transfer.status is None):
-                        sleep(0.1)
-                        current_time = datetime.utcnow()
-
-                    if transfer.status is None:
+                    if not transfer.wait(timeout or None):
                         status = constants.STATUS_TIMED_OUT
                     else:
                         status = transfer.status
 
         return status
 
-    def send(self, messages):
+    def start_publisher(self):
         """
-        Send commands to the Cloud, and track them to wait for replies
+        Start the publisher thread. Publish work already scheduled on the work
+        queue is handed to it.
+        """
+
+        if not self.publish_thread:
+            self.publish_thread = threading.Thread(
+                target=self.handle_publish_loop)
+            self.publish_thread.start()
+
+    def start_worker(self, work_queue=None):
+        """
+        Start a worker thread for the work queue, or for another queue such as
+        the transfer queue
+        """
+
+        thread = threading.Thread(target=self.handle_work_loop,
+                                  args=(work_queue,))
+        with self.worker_lock:
+            self.worker_threads.append(thread)
+            if work_queue is None:
+                self.worker_count += 1
+        thread.start()
+
+    def stop_worker(self):
+        """
+        Let the calling idle worker thread stop if there are more than
+        thread_count worker threads. Returns whether it should stop.
+        """
+
+        with self.worker_lock:
+            if self.worker_count <= self.config.thread_count:
+                return False
+            self.worker_count -= 1
+            self.worker_threads.remove(threading.current_thread())
+        self.logger.debug("Worker thread idle, %d left", self.worker_count)
+        return True
+
+    def telemetry_filter_deregister(self, telem_name):
+        """
+        Stop filtering samples of a telemetry key
+        """
+
+        if self.telemetry_filters.pop(telem_name, None) is None:
+            self.logger.error("No filter registered for %s", telem_name)
+            return constants.STATUS_NOT_FOUND
+        return constants.STATUS_SUCCESS
+
+    def telemetry_filter_register(self, telem_name, deadband=0,
+                                  deadband_percent=0, min_interval=0,
+                                  max_interval=0):
+        """
+        Filter samples of a telemetry key before they are queued
+        """
+
+        if (deadband < 0 or deadband_percent < 0 or min_interval < 0 or
+                max_interval < 0):
+            self.logger.error("Telemetry filter settings cannot be negative")
+            return constants.STATUS_BAD_PARAMETER
+
+        self.telemetry_filters[telem_name] = defs.TelemetryFilter(
+            deadband, deadband_percent, min_interval, max_interval)
+        return constants.STATUS_SUCCESS
+
+    def send(self, messages, payload=None):
+        """
+        Send commands to the Cloud, and track them to wait for replies. The
+        request payload is generated from the commands unless it has already
+        been written.
         """
         status = constants.STATUS_FAILURE
 
@@ -1529,44 +2360,46 @@ class Handler(object):
             message_list = [messages]
 
         # Generate final request string
-        payload = tr50.generate_request([x.command for x in message_list])
+        if payload is None:
+            payload = tr50.generate_request([x.command for x in message_list])
+
+        # Wait for the rate limiter before taking the lock so that throttling
+        # outgoing messages never delays handling of replies
+        self.rate_limiter.acquire()
 
         # Lock to ensure all outgoing messages are tracked before handling
         # received messages
         self.lock.acquire()
         try:
             # Obtain new unused topic number
-            while True:
-                topic_num = "{:0>4}".format(self.topic_counter)
-                self.topic_counter += 1
-                if topic_num not in self.reply_tracker:
-                    break
-            self.pub_topic = topic_num
-            # -----------------------------------------------------
+            topic_num = self.reply_tracker.next_topic()
+            if topic_num is None:
+                self.logger.error("Too many requests waiting for replies")
+                return constants.STATUS_FULL
+
             # Send payload over MQTT
-            # Add small delay here so that we don't cross the API/s
-            # threshold
-            # -----------------------------------------------------
-            sleep(self.client.idle_sleep)
             result, mid = self.mqtt.publish("api/{}".format(topic_num),
                                             payload, qos = self.qos_level)
 
             # Track the topic this message will send on
             self.reply_tracker.add_mid(mid, topic_num)
 
-            # Current timestamp to mark when message was sent
+            # Current timestamp to mark when message was sent, and when its
+            # reply is due
             current_time = datetime.utcnow()
+            expires = None
+            if self.config.reply_expiry:
+                expires = monotonic() + self.config.reply_expiry
 
             # Track each message
+            self.reply_tracker.add_request(topic_num, message_list, expires)
             for num, msg in enumerate(message_list):
-                # Add timestamps and ids
+                # Add timestamps
                 msg.timestamp = current_time
-                msg.out_id = "{}-{}".format(topic_num, num+1)
-
-                self.reply_tracker.add_message(msg)
                 self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num, num+1,
                                  msg, json.dumps(msg.command, indent=2,
                                                  sort_keys=True))
+                msg.compact()
             status = constants.STATUS_SUCCESS
 
         finally:
@@ -0,0 +1,534 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the queues used to hold pending work, and pending
+publishes either bounded in memory or persistent on disk so that they survive
+restarts and long periods without a connection
+"""
+
+import json
+import sqlite3
+import sys
+import threading
+from collections import deque
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+# Number of rows read from disk at a time
+READ_AHEAD = 100
+
+
+def publish_key(pub):
+    """
+    Return the key identifying what a publish updates, so that newer publishes
+    can replace older ones
+    """
+
+    return (pub.type, pub.thing_key,
+            getattr(pub, "name", getattr(pub, "message", None)))
+
+def publish_size(pub):
+    """
+    Return an estimate of the memory used by a publish in bytes
+    """
+
+    size = sys.getsizeof(pub)
+    for value in pub.fields().values():
+        size += sys.getsizeof(value)
+        if isinstance(value, list):
+            size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class PublishQueue(object):
+    """
+    In-memory FIFO queue of pending publishes. The queue can be bounded by the
+    number of publishes and their estimated size in bytes, with a policy
+    deciding what happens to publishes made while it is full:
+      block              Wait up to timeout seconds (0 is forever) for room,
+                         then drop the new publish
+      drop_oldest        Drop the oldest publishes to make room
+      drop_newest        Drop the new publish
+      coalesce           Replace the newest pending publish for the same key
+                         (telemetry/attribute/alarm name), otherwise drop the
+                         oldest publishes
+    """
+
+    def __init__(self, max_count=0, max_size=0,
+                 policy=constants.PUBLISH_POLICY_DROP_OLDEST, timeout=0):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.policy = policy
+        self.timeout = timeout
+
+        self.items = deque()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        # Number of publishes dropped because the queue was full
+        self.dropped = 0
+
+    def empty(self):
+        """
+        Return whether there are no pending publishes
+        """
+
+        return not self.items
+
+    def full(self, extra_size=0):
+        """
+        Return whether the queue has no room for a publish of extra_size bytes
+        """
+
+        return bool((self.max_count and len(self.items) >= self.max_count) or
+                    (self.max_size and self.items and
+                     self.size + extra_size > self.max_size))
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the oldest pending publish
+        """
+
+        with self.not_empty:
+            if block:
+                while not self.items:
+                    self.not_empty.wait(timeout)
+                    if timeout is not None:
+                        break
+            if not self.items:
+                raise queue.Empty
+            pub, size = self.items.popleft()
+            self.size -= size
+            self.not_full.notify()
+        return pub
+
+    def get_nowait(self):
+        """
+        Remove and return the oldest pending publish without blocking
+        """
+
+        return self.get(block=False)
+
+    def put(self, pub, block=True):
+        """
+        Add a publish to the queue. Returns the number of publishes that were
+        dropped, including the new publish, because the queue was full. With
+        block unset, the block policy drops the oldest publishes instead of
+        waiting for room.
+        """
+
+        # Estimating the size is only worth it when the queue is bounded by it
+        size = publish_size(pub) if self.max_size else 0
+        dropped = []
+
+        with self.not_full:
+            if self.full(size):
+                if self.policy == constants.PUBLISH_POLICY_BLOCK and block:
+                    if self.timeout:
+                        end_time = defs.monotonic() + self.timeout
+                    while self.full(size):
+                        if not self.timeout:
+                            self.not_full.wait()
+                            continue
+                        remaining = end_time - defs.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.not_full.wait(remaining)
+                    if self.full(size):
+                        dropped.append(pub)
+
+                elif self.policy == constants.PUBLISH_POLICY_DROP_NEWEST:
+                    dropped.append(pub)
+
+                elif (self.policy == constants.PUBLISH_POLICY_COALESCE and
+                      self._replace(pub, size, dropped)):
+                    pub = None
+
+            if pub and not dropped:
+                # Make room by dropping the oldest publishes
+                while self.items and self.full(size):
+                    old_pub, old_size = self.items.popleft()
+                    self.size -= old_size
+                    dropped.append(old_pub)
+                self.items.append((pub, size))
+                self.size += size
+                self.not_empty.notify()
+
+            self.dropped += len(dropped)
+
+        # Nothing will ever reply to dropped publishes
+        for old_pub in dropped:
+            if old_pub.future:
+                old_pub.future.set_reply(None)
+        return len(dropped)
+
+    def qsize(self):
+        """
+        Return the number of pending publishes
+        """
+
+        return len(self.items)
+
+    def _replace(self, pub, size, dropped):
+        # Replace the newest pending publish with the same key. Blocks of
+        # samples are never replaced, as that would lose the earlier samples.
+        if pub.type == "PublishTelemetryBatch":
+            return False
+        key = publish_key(pub)
+        for num in range(len(self.items) - 1, -1, -1):
+            old_pub, old_size = self.items[num]
+            if publish_key(old_pub) == key:
+                self.items[num] = (pub, size)
+                self.size += size - old_size
+                dropped.append(old_pub)
+                return True
+        return False
+
+
+class PublishStore(object):
+    """
+    Disk backed FIFO queue of pending publishes. It can be used in place of the
+    in-memory publish queue. Writes are committed in batches, and the oldest
+    publishes are dropped when the store grows beyond max_size bytes.
+    Publishes taken from the store stay on disk until they are marked as sent,
+    so a crash replays, rather than loses, publishes that were in flight.
+    Publishes that failed to send can be returned to the store to be taken
+    again. A closed store is opened again when it is next used.
+    """
+
+    def __init__(self, path, max_size=0, commit_count=1):
+        self.path = path
+        self.max_size = max_size
+        self.commit_count = max(commit_count, 1)
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.db = None
+
+        # Number of publishes dropped because the store was full
+        self.dropped = 0
+
+        # Futures cannot be stored on disk. Keep them in memory for publishes
+        # made by this process.
+        self.futures = {}
+
+        with self.lock:
+            self._open()
+
+    def close(self):
+        """
+        Commit any pending writes and close the store. Publishes taken but
+        not yet sent are returned again once it is reopened.
+        """
+
+        with self.lock:
+            if self.db:
+                self._commit()
+                row = self.db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) "
+                    "FROM publishes").fetchone()
+                self.count = row[0]
+                self.size = row[1]
+                self.in_flight = {}
+                self.retry = []
+                self.db.close()
+                self.db = None
+
+    def commit(self):
+        """
+        Commit any pending writes to disk
+        """
+
+        with self.lock:
+            if self.db:
+                self._commit()
+
+    def empty(self):
+        """
+        Return whether there are no pending publishes
+        """
+
+        return self.count == 0
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the oldest pending publish
+        """
+
+        with self.not_empty:
+            if block:
+                while self.count == 0:
+                    self.not_empty.wait(timeout)
+                    if timeout is not None:
+                        break
+            if self.count == 0:
+                raise queue.Empty
+
+            self._open()
+            if self.retry:
+                # Publishes returned to the store come first
+                row_id = self.retry.pop(0)
+                pub_type, data = self.db.execute(
+                    "SELECT type, data FROM publishes WHERE id = ?",
+                    (row_id,)).fetchone()
+            else:
+                if not self.read_ahead:
+                    self.read_ahead.extend(self.db.execute(
+                        "SELECT id, type, data FROM publishes WHERE id > ? "
+                        "ORDER BY id LIMIT ?", (self.last_taken, READ_AHEAD)))
+                row_id, pub_type, data = self.read_ahead.popleft()
+                self.last_taken = row_id
+
+            self.count -= 1
+            self.size -= len(data)
+            self.in_flight[row_id] = len(data)
+            pub = self._load(row_id, pub_type, data)
+
+        return pub
+
+    def get_nowait(self):
+        """
+        Remove and return the oldest pending publish without blocking
+        """
+
+        return self.get(block=False)
+
+    def put(self, pub, block=True):
+        """
+        Add a publish to the store. Returns the number of older publishes that
+        were dropped to make room for it. The store never blocks.
+        """
+
+        data = json.dumps(pub.fields(), separators=(",", ":"), default=str)
+
+        with self.not_empty:
+            self._open()
+            cursor = self.db.execute("INSERT INTO publishes (type, data) "
+                                     "VALUES (?, ?)", (pub.type, data))
+            if pub.future:
+                self.futures[cursor.lastrowid] = pub.future
+            self.count += 1
+            self.size += len(data)
+
+            dropped = 0
+            if self.max_size and self.size > self.max_size:
+                dropped = self._drop_oldest()
+
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_count:
+                self._commit()
+            self.not_empty.notify()
+
+        return dropped
+
+    def qsize(self):
+        """
+        Return the number of pending publishes
+        """
+
+        return self.count
+
+    def requeue(self, pubs):
+        """
+        Return publishes taken from the store that failed to send, so that
+        they are taken again before any others
+        """
+
+        with self.not_empty:
+            rows = [pub.store_id for pub in pubs
+                    if pub.store_id in self.in_flight]
+            for row_id in rows:
+                self.count += 1
+                self.size += self.in_flight.pop(row_id)
+            if rows:
+                self.retry = sorted(self.retry + rows)
+                self.not_empty.notify()
+
+    def sent(self, pubs):
+        """
+        Mark publishes taken from the store as sent, removing them from disk
+        on the next commit
+        """
+
+        with self.lock:
+            rows = [(pub.store_id,) for pub in pubs
+                    if self.in_flight.pop(pub.store_id, None) is not None]
+            if rows:
+                self.db.executemany("DELETE FROM publishes WHERE id = ?",
+                                    rows)
+                self.uncommitted += len(rows)
+                if self.uncommitted >= self.commit_count:
+                    self._commit()
+
+    def _commit(self):
+        # Write everything to disk
+        self.db.commit()
+        self.uncommitted = 0
+
+    def _open(self):
+        # Open the database if it is closed. Anything taken but not sent
+        # before it was closed is read again.
+        if self.db:
+            return
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS publishes ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "type TEXT NOT NULL, "
+                        "data TEXT NOT NULL)")
+        self.db.commit()
+
+        row = self.db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) "
+                              "FROM publishes").fetchone()
+        self.count = row[0]
+        self.size = row[1]
+
+        # Uncommitted changes, the highest row id that has been read from
+        # the store, the sizes of publishes taken but not yet sent by row id,
+        # row ids of publishes returned to the store, and rows read ahead from
+        # disk
+        self.uncommitted = 0
+        self.last_taken = 0
+        self.in_flight = {}
+        self.retry = []
+        self.read_ahead = deque()
+
+    def _drop_oldest(self):
+        # Drop the oldest publishes until the store fits within max_size
+        # again. Publishes already taken are left alone.
+        dropped = 0
+        cutoff = self.last_taken
+        rows = self.db.execute("SELECT id, LENGTH(data) FROM publishes "
+                               "WHERE id > ? ORDER BY id", (self.last_taken,))
+        for row_id, length in rows:
+            if self.size <= self.max_size or self.count <= 1:
+                break
+            cutoff = row_id
+            self.count -= 1
+            self.size -= length
+            future = self.futures.pop(row_id, None)
+            if future:
+                future.set_reply(None)
+            dropped += 1
+        rows.close()
+
+        if dropped:
+            self.db.execute("DELETE FROM publishes WHERE id > ? AND id <= ?",
+                            (self.last_taken, cutoff))
+            self.last_taken = cutoff
+            while self.read_ahead and self.read_ahead[0][0] <= cutoff:
+                self.read_ahead.popleft()
+            self.dropped += dropped
+        return dropped
+
+    def _load(self, row_id, pub_type, data):
+        # Rebuild a publish object from its stored fields
+        pub = getattr(defs, pub_type).from_fields(json.loads(data))
+        pub.future = self.futures.pop(row_id, None)
+        pub.store_id = row_id
+        return pub
+
+
+class WorkQueue(object):
+    """
+    In-memory queue of pending work with a lane per priority. Work is taken
+    from the highest priority lane that has any, in FIFO order within a lane,
+    so that a backlog of lower priority work does not delay replies and
+    actions. The time work spends waiting in the queue is tracked so that the
+    number of worker threads can follow it.
+    """
+
+    def __init__(self, lanes=None):
+        self.lanes = lanes or constants.WORK_LANES
+        self.items = [deque() for _ in range(max(self.lanes.values()) + 1)]
+        self.count = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+
+        # Seconds the most recently taken work waited in the queue
+        self.last_wait = 0.0
+
+    def empty(self):
+        """
+        Return whether there is no pending work
+        """
+
+        return self.count == 0
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the oldest work of the highest priority
+        """
+
+        with self.not_empty:
+            if block:
+                while self.count == 0:
+                    self.not_empty.wait(timeout)
+                    if timeout is not None:
+                        break
+            if self.count == 0:
+                raise queue.Empty
+            for lane in self.items:
+                if lane:
+                    queued, work = lane.popleft()
+                    self.count -= 1
+                    self.last_wait = defs.monotonic() - queued
+                    return work
+
+    def get_nowait(self):
+        """
+        Remove and return the oldest work of the highest priority without
+        blocking
+        """
+
+        return self.get(block=False)
+
+    def put(self, work):
+        """
+        Add work to the lane for its type. Unknown types get the lowest
+        priority.
+        """
+
+        lane = self.lanes.get(work.type, len(self.items) - 1)
+        with self.not_empty:
+            self.items[lane].append((defs.monotonic(), work))
+            self.count += 1
+            self.not_empty.notify()
+
+    def qsize(self):
+        """
+        Return the amount of pending work
+        """
+
+        return self.count
+
+    def wait_time(self):
+        """
+        Return how many seconds the oldest pending work has been waiting
+        """
+
+        with self.lock:
+            oldest = [lane[0][0] for lane in self.items if lane]
+        if not oldest:
+            return 0.0
+        return defs.monotonic() - min(oldest)
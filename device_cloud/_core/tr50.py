@@ -16,11 +16,17 @@ This module contains functions for generating TR50 messages relevent to the
 Client application
 """
 
-import json
-
+from device_cloud._core import codec
 from device_cloud._core import constants
 
 
+# Number of encoded property keys kept for reuse by encode_property_batch_item
+KEY_FRAGMENT_CACHE_SIZE = 1024
+_key_fragments = {}
+
+# Closes the data list, params and command of a batch command
+BATCH_FOOTER = b"]}}"
+
 CLOUD_ERROR_CODES = {
     constants.STATUS_SUCCESS:0,
     constants.STATUS_INVOKED:constants.STATUS_INVOKED,
@@ -317,14 +323,16 @@ def create_mailbox_ack(mail_id, error_code=None, error_message=None,
     cmd["params"] = _generate_params(kwargs)
     return cmd
 
-def create_mailbox_check(auto_complete, limit=None):
+def create_mailbox_check(auto_complete, limit=None, thing_key=None):
     """
-    Generate a TR50 JSON request for checking the mailbox in the Cloud
+    Generate a TR50 JSON request for checking the mailbox in the Cloud, by
+    default of the thing the session belongs to
     """
 
     kwargs = {
         "autoComplete":auto_complete,
-        "limit":limit
+        "limit":limit,
+        "thingKey":thing_key
     }
     cmd = {"command":TR50Command.mailbox_check}
     params = _generate_params(kwargs)
@@ -424,7 +432,8 @@ def create_thing_update(key, name, description, iccid, esn, imei,
 
 def generate_request(commands):
     """
-    Generate a final TR50 request string out of multiple commands
+    Generate the final TR50 request payload, as JSON bytes, out of multiple
+    commands
     """
 
     request = {}
@@ -438,7 +447,57 @@ def generate_request(commands):
     for num, val in enumerate(command_list):
         request[str(num+1)] = val
 
-    return json.dumps(request, separators=(",", ":"))
+    return codec.dumps(request)
+
+def encode_property_batch_item(key, value, timestamp=None, corr_id=None):
+    """
+    Encode a property.batch item straight to JSON bytes
+    """
+
+    key_bytes = _key_fragments.get(key)
+    if key_bytes is None:
+        if len(_key_fragments) >= KEY_FRAGMENT_CACHE_SIZE:
+            _key_fragments.clear()
+        key_bytes = b'{"key":' + codec.dumps(key)
+        _key_fragments[key] = key_bytes
+
+    parts = [key_bytes, b',"value":', codec.dumps(value), b',"ts":',
+             codec.dumps(timestamp)]
+    if corr_id is not None:
+        parts.append(b',"corrid":')
+        parts.append(codec.dumps(corr_id))
+    parts.append(b"}")
+    return b"".join(parts)
+
+def split_requests(commands, max_size=0):
+    """
+    Group commands, in order, into TR50 requests that each stay under max_size
+    bytes. A request is started whenever the next command does not fit in the
+    current one, so commands are never sent ahead of earlier ones. A command
+    that is larger than max_size on its own is placed in a request by itself.
+    A max_size of 0 means no limit. Returns a list of requests, each a list of
+    indexes into commands.
+    """
+
+    if not max_size:
+        return [list(range(len(commands)))] if commands else []
+
+    requests = []
+    request_size = 0
+    for index, cmd in enumerate(commands):
+        # Size of '"N":{...}' plus a separating comma
+        cmd_size = len(codec.dumps(cmd)) + 4
+
+        if requests:
+            size = cmd_size + len(str(len(requests[-1]) + 1))
+            if request_size + size <= max_size:
+                request_size += size
+                requests[-1].append(index)
+                continue
+        requests.append([index])
+        request_size = 2 + cmd_size + 1
+
+    return requests
 
 def translate_error_code(error_code):
     """
@@ -447,3 +506,133 @@ def translate_error_code(error_code):
 
     return (CLOUD_ERROR_CODES.get(error_code) if error_code in
             CLOUD_ERROR_CODES else error_code)
+
+
+class RequestWriter(object):
+    """
+    Writes TR50 requests straight to JSON bytes, one command or batch item at a
+    time, instead of building each request as nested dicts first. A request is
+    closed and a new one started whenever the next command or batch item would
+    take it over max_size bytes (0 means no limit). A batch command that is
+    split this way continues in the next request.
+
+    Each command written is recorded as a part, [tag, item count, futures], so
+    that replies can be matched to what was sent. finish() returns a list of
+    (payload, parts) for each request.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.requests = []
+        self.batch_header = None
+        self.batch_tag = None
+        self._start_request()
+
+    def add_command(self, command, tag=None, futures=None):
+        """
+        Write a complete command
+        """
+
+        self.end_batch()
+        data = codec.dumps(command)
+        self._make_room(len(self._entry_prefix()) + len(data))
+        entry = self._entry_prefix() + data
+        self.chunks.append(entry)
+        self.size += len(entry)
+        self.parts.append([tag, 1, list(futures or [])])
+
+    def add_item(self, item, future=None):
+        """
+        Write an item, as JSON bytes, into the current batch command
+        """
+
+        if self.batch_open:
+            if self._make_room(len(item) + 1):
+                self.chunks.append(b",")
+                self.size += 1
+        if not self.batch_open:
+            self._open_batch(len(item))
+        self.chunks.append(item)
+        self.size += len(item)
+        part = self.parts[-1]
+        part[1] += 1
+        if future:
+            part[2].append(future)
+
+    def begin_batch(self, command, params=None, tag=None):
+        """
+        Start a batch command. Its items are added with add_item.
+        """
+
+        self.end_batch()
+        header = b'{"command":' + codec.dumps(command) + b',"params":{'
+        if params:
+            header += codec.dumps(params)[1:-1] + b","
+        self.batch_header = header + b'"data":['
+        self.batch_tag = tag
+
+    def end_batch(self):
+        """
+        Finish the current batch command
+        """
+
+        if self.batch_open:
+            self.chunks.append(BATCH_FOOTER)
+            self.batch_open = False
+        self.batch_header = None
+        self.batch_tag = None
+
+    def finish(self):
+        """
+        Close the last request and return every request written
+        """
+
+        self.end_batch()
+        if self.parts:
+            self._close_request()
+        requests = self.requests
+        self.requests = []
+        return requests
+
+    def _close_request(self):
+        # Finish the open batch, if any, and the request itself
+        if self.batch_open:
+            self.chunks.append(BATCH_FOOTER)
+            self.batch_open = False
+        self.chunks.append(b"}")
+        self.requests.append((b"".join(self.chunks), self.parts))
+        self._start_request()
+
+    def _entry_prefix(self):
+        # '"N":' for the next command, after a comma if it is not the first
+        num = len(self.parts) + 1
+        prefix = '"{}":'.format(num).encode("ascii")
+        if num > 1:
+            prefix = b"," + prefix
+        return prefix
+
+    def _make_room(self, size):
+        # Start a new request if size more bytes do not fit in this one.
+        # Returns whether the current request was kept.
+        if (self.max_size and self.parts and
+                self.size + size > self.max_size):
+            self._close_request()
+            return False
+        return True
+
+    def _open_batch(self, item_size):
+        # Write the batch header, reserving room for its footer
+        prefix = self._entry_prefix()
+        size = len(prefix) + len(self.batch_header) + len(BATCH_FOOTER)
+        if not self._make_room(size + item_size):
+            prefix = self._entry_prefix()
+        self.chunks.append(prefix + self.batch_header)
+        self.size += len(prefix) + len(self.batch_header) + len(BATCH_FOOTER)
+        self.parts.append([self.batch_tag, 0, []])
+        self.batch_open = True
+
+    def _start_request(self):
+        self.chunks = [b"{"]
+        self.size = 2
+        self.parts = []
+        self.batch_open = False
@@ -21,9 +21,12 @@ import mock
 from mock import MagicMock
 import platform
 import re
+import shutil
 import socket
 import ssl
 import sys
+import tempfile
+import threading
 
 # yocto supports websockets, not websocket, so check for that
 try:
@@ -278,8 +281,8 @@ class ClientAlarmPublish(unittest.TestCase):
         assert pub.state == 5
         assert pub.message == "alarm message"
         assert pub.republish == False
-        work = self.client.handler.work_queue.get()
-        assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        # Publish is already scheduled, no more work queued
+        assert self.client.handler.work_queue.empty()
 
         # Queue alarm for publishing
         # default republish=True
@@ -293,8 +296,8 @@ class ClientAlarmPublish(unittest.TestCase):
         assert pub.state == 6
         assert pub.message == "alarm message"
         assert pub.republish == True
-        work = self.client.handler.work_queue.get()
-        assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        # Publish is already scheduled, no more work queued
+        assert self.client.handler.work_queue.empty()
 
     def setUp(self):
         # Configuration to be 'read' from config file
@@ -2623,3 +2626,1715 @@ class ClientThingUpdate(unittest.TestCase):
     def setUp(self):
         # Configuration to be 'read' from config file
         self.config_args = helpers.config_file_default()
+
+class HandlePublishCombined(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "publish_combine":True}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        self.client.handler.state = device_cloud._core.constants.STATE_CONNECTED
+        mqtt = self.client.handler.mqtt
+
+        # Queue one of each publish type
+        self.client.alarm_publish("alarm_key", 1, message="alarm message")
+        self.client.attribute_publish("attribute_key", "attribute string")
+        self.client.location_publish(11.11, 22.22)
+        self.client.event_publish("Event Message")
+        self.client.telemetry_publish("property_key", 12.34)
+
+        # Flush publishes into a single request
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        assert mqtt.publish.call_count == 1
+        args = mqtt.publish.call_args_list[0][0]
+        assert args[0] == "api/0001"
+        jload = json.loads(args[1])
+        commands = [jload[str(num)]["command"] for num in range(1, 6)]
+        assert commands == ["log.publish", "alarm.batch", "attribute.batch",
+                            "location.batch", "property.batch"]
+        assert len(self.client.handler.reply_tracker) == 5
+
+        # Limit the payload size so the request must be split
+        mqtt.publish.reset_mock()
+        self.client.handler.config.publish_max_payload = 450
+        self.client.event_publish("Event Message")
+        self.client.telemetry_publish("property_key", 12.34)
+        self.client.telemetry_publish("property_key", 56.78)
+        self.client.handler.handle_publish()
+        assert mqtt.publish.call_count == 2
+        for call in mqtt.publish.call_args_list:
+            assert len(call[0][1]) <= 450
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class TR50SplitRequests(unittest.TestCase):
+    def runTest(self):
+        commands = [device_cloud._core.tr50.create_diag_echo({"text":"a" * 40})
+                    for _ in range(5)]
+        size = len(device_cloud._core.tr50.generate_request(commands[0]))
+
+        # No limit keeps every command in one request
+        result = device_cloud._core.tr50.split_requests(commands)
+        assert result == [[0, 1, 2, 3, 4]]
+
+        # Each request stays under the limit
+        result = device_cloud._core.tr50.split_requests(commands, size * 2 + 4)
+        assert result == [[0, 1], [2, 3], [4]]
+        for request in result:
+            payload = device_cloud._core.tr50.generate_request(
+                [commands[num] for num in request])
+            assert len(payload) <= size * 2 + 4
+
+        # Oversized commands are sent on their own
+        result = device_cloud._core.tr50.split_requests(commands, 10)
+        assert result == [[0], [1], [2], [3], [4]]
+        assert device_cloud._core.tr50.split_requests([], 10) == []
+
+        # Later commands are never moved ahead of earlier ones
+        update = device_cloud._core.tr50.create_mailbox_update("id", "x" * 80)
+        ack = device_cloud._core.tr50.create_mailbox_ack("id", 0)
+        result = device_cloud._core.tr50.split_requests([update, update, ack],
+                                                        260)
+        assert result == [[0], [1, 2]]
+
+class HandleReplyFutures(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        self.client.handler.state = device_cloud._core.constants.STATE_CONNECTED
+        handler = self.client.handler
+        results = {}
+
+        def publish(name, value):
+            results[name] = self.client.telemetry_publish(name, value,
+                                                          cloud_response=True)
+        def read(name):
+            results[name] = self.client.telemetry_read_last_sample(name)
+
+        def wait_for(check):
+            for _ in range(50):
+                if check():
+                    return
+                sleep(0.1)
+            assert False
+
+        # Two confirmed publishes in flight on separate topics
+        thread_1 = threading.Thread(target=publish, args=("prop_1", 1))
+        thread_1.start()
+        wait_for(lambda: handler.publish_queue.qsize() == 1)
+        handler.handle_publish()
+        thread_2 = threading.Thread(target=publish, args=("prop_2", 2))
+        thread_2.start()
+        wait_for(lambda: handler.publish_queue.qsize() == 1)
+        handler.handle_publish()
+
+        # A read of the last sample in flight at the same time
+        thread_3 = threading.Thread(target=read, args=("prop_3",))
+        thread_3.start()
+        wait_for(lambda: len(handler.reply_tracker) == 3)
+
+        # Replies arrive out of order and only wake their own waiter
+        reply = {"1":{"success":True, "params":{"value":3, "ts":"now"}}}
+        handler.handle_message(device_cloud._core.defs.Message("reply/0003",
+                                                               reply))
+        thread_3.join(5)
+        assert results["prop_3"] == (device_cloud.STATUS_SUCCESS, 3, "now")
+        assert "prop_1" not in results and "prop_2" not in results
+
+        reply = {"1":{"success":False}}
+        handler.handle_message(device_cloud._core.defs.Message("reply/0002",
+                                                               reply))
+        thread_2.join(5)
+        assert results["prop_2"] == device_cloud.STATUS_FAILURE
+        assert "prop_1" not in results
+
+        reply = {"1":{"success":True}}
+        handler.handle_message(device_cloud._core.defs.Message("reply/0001",
+                                                               reply))
+        thread_1.join(5)
+        assert results["prop_1"] == device_cloud.STATUS_SUCCESS
+        assert len(handler.reply_tracker) == 0
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class FileTransferWait(unittest.TestCase):
+    def runTest(self):
+        callback = mock.Mock()
+        transfer = device_cloud._core.defs.FileTransfer("file", "/path/file",
+                                                        None, callback=callback)
+
+        # Times out while the transfer is in progress
+        assert transfer.wait(0.1) is False
+
+        # Failure reported from a reply wakes waiters without a callback
+        waiter = threading.Thread(target=transfer.wait)
+        waiter.start()
+        transfer.status = device_cloud.STATUS_FAILURE
+        waiter.join(5)
+        assert not waiter.is_alive()
+        callback.assert_not_called()
+
+        # Completion wakes waiters and runs the callback
+        transfer = device_cloud._core.defs.FileTransfer("file", "/path/file",
+                                                        None, callback=callback)
+        transfer.status = None
+        assert transfer.wait(0) is False
+        transfer.status = device_cloud.STATUS_SUCCESS
+        transfer.finish()
+        assert transfer.wait(0) is True
+        callback.assert_called_once_with(None, "file",
+                                         device_cloud.STATUS_SUCCESS)
+
+class TokenBucketAcquire(unittest.TestCase):
+    @mock.patch("device_cloud._core.defs.sleep")
+    @mock.patch("device_cloud._core.defs.monotonic")
+    def runTest(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100.0
+        bucket = device_cloud._core.defs.TokenBucket(10, 3)
+
+        # Burst goes out without waiting
+        for _ in range(3):
+            assert bucket.acquire() == 0
+        mock_sleep.assert_not_called()
+
+        # Further requests are spaced out at the sustained rate
+        assert abs(bucket.acquire() - 0.1) < 1e-9
+        assert abs(bucket.acquire() - 0.2) < 1e-9
+        assert mock_sleep.call_count == 2
+
+        # Tokens refill over time, up to the burst size
+        mock_monotonic.return_value = 200.0
+        mock_sleep.reset_mock()
+        for _ in range(3):
+            assert bucket.acquire() == 0
+        assert bucket.acquire() > 0
+
+        # A rate of 0 is unlimited
+        bucket = device_cloud._core.defs.TokenBucket(0)
+        for _ in range(100):
+            assert bucket.acquire() == 0
+
+class HandlePublishSchedule(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "publish_max_batch":2}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        self.client.handler.state = device_cloud._core.constants.STATE_CONNECTED
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Only one publish is scheduled however many are requested
+        for _ in range(5):
+            handler.schedule_publish()
+        assert handler.work_queue.qsize() == 1
+        handler.work_queue.get()
+        handler.handle_publish()
+        mqtt.publish.assert_not_called()
+
+        # A full batch schedules a publish without waiting for the main loop
+        self.client.telemetry_publish("property_key", 1)
+        assert handler.work_queue.empty()
+        self.client.telemetry_publish("property_key", 2)
+        self.client.telemetry_publish("property_key", 3)
+        assert handler.work_queue.qsize() == 1
+        handler.work_queue.get()
+
+        # Each flush takes at most a batch and schedules the rest
+        handler.handle_publish()
+        assert handler.publish_queue.qsize() == 1
+        assert handler.work_queue.qsize() == 1
+        handler.work_queue.get()
+        handler.handle_publish()
+        assert handler.publish_queue.empty()
+        assert handler.work_queue.empty()
+        data = [json.loads(call[0][1])["1"]["params"]["data"]
+                for call in mqtt.publish.call_args_list]
+        assert [len(batch) for batch in data] == [2, 1]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class PublishStoreReplay(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        PublishStore = device_cloud._core.store.PublishStore
+        path = os.path.join(self.temp_dir, "publish.db")
+
+        # Publishes are kept across restarts and returned in order
+        pub_store = PublishStore(path, commit_count=2)
+        assert pub_store.empty()
+        pub_store.put(defs.PublishTelemetry("property_key", 1))
+        pub_store.put(defs.PublishAttribute("attribute_key", "value"))
+        pub_store.put(defs.PublishLog("Event Message"))
+        assert pub_store.qsize() == 3
+        assert pub_store.get_nowait().value == 1
+        pub_store.close()
+
+        # Publishes taken but not marked as sent are replayed
+        pub_store = PublishStore(path)
+        assert pub_store.qsize() == 3
+        pub = pub_store.get_nowait()
+        assert pub.value == 1
+        pub_store.sent([pub])
+        pub_store.close()
+
+        pub_store = PublishStore(path)
+        assert pub_store.qsize() == 2
+        attr = pub_store.get_nowait()
+        assert isinstance(attr, defs.PublishAttribute)
+        assert attr.name == "attribute_key"
+        assert attr.value == "value"
+        assert attr.future is None
+        log = pub_store.get_nowait()
+        assert isinstance(log, defs.PublishLog)
+        assert log.message == "Event Message"
+        assert pub_store.empty()
+        self.assertRaises(device_cloud._core.store.queue.Empty,
+                          pub_store.get_nowait)
+
+        # A closed store reopens when used, returning what was not sent
+        pub_store.sent([attr])
+        pub_store.close()
+        assert pub_store.qsize() == 1
+        pub_store.put(defs.PublishTelemetry("property_key", 2))
+        log = pub_store.get_nowait()
+        assert log.message == "Event Message"
+        telem = pub_store.get_nowait()
+        assert telem.value == 2
+        pub_store.sent([log, telem])
+        pub_store.close()
+
+        # The oldest publishes are dropped when the store is full
+        pub_store = PublishStore(path, max_size=300)
+        future = defs.ReplyFuture()
+        pub = defs.PublishTelemetry("property_key", 0)
+        pub.future = future
+        pub_store.put(pub)
+        dropped = 0
+        for value in range(1, 10):
+            dropped += pub_store.put(defs.PublishTelemetry("property_key",
+                                                           value))
+        assert dropped > 0
+        assert pub_store.qsize() == 10 - dropped
+        assert pub_store.size <= 300
+        assert future.wait(0) and not future.success()
+        assert pub_store.get_nowait().value == dropped
+        pub_store.close()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+class HandlePublishStoreSent(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        path = os.path.join(self.temp_dir, "publish.db")
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "publish_store_file":path}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.state = device_cloud._core.constants.STATE_CONNECTED
+        PublishStore = device_cloud._core.store.PublishStore
+        defs = device_cloud._core.defs
+
+        def reply_to_last():
+            topic = mqtt.publish.call_args[0][0][len("api/"):]
+            handler.handle_message(defs.Message(
+                "reply/" + topic, {"1":{"success":True}}))
+
+        # A publish that failed to send is returned to the store and sent
+        # again, while later publishes are sent and removed once replied to
+        mqtt = handler.mqtt
+        self.client.telemetry_publish("property_key", 0)
+        with mock.patch.object(mqtt, "publish",
+                               side_effect=RuntimeError("failed")):
+            self.assertRaises(RuntimeError, handler.handle_publish)
+        assert handler.publish_store.qsize() == 1
+        for value in range(1, 21):
+            self.client.telemetry_publish("property_key", value)
+            handler.handle_publish()
+            reply_to_last()
+        data = [json.loads(call[0][1])["1"]["params"]["data"]
+                for call in mqtt.publish.call_args_list]
+        assert [item["value"] for item in data[0]] == [0, 1]
+        handler.publish_store.commit()
+        assert handler.publish_store.empty()
+        assert not handler.publish_store.in_flight
+        handler.publish_store.close()
+        pub_store = PublishStore(path)
+        assert pub_store.empty()
+        pub_store.close()
+
+        # A publish that was sent stays on disk until it is replied to
+        self.client.telemetry_publish("property_key", 21)
+        handler.handle_publish()
+        handler.publish_store.close()
+        pub_store = PublishStore(path)
+        assert pub_store.qsize() == 1
+        pub_store.close()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+class PublishQueuePolicies(unittest.TestCase):
+    def runTest(self):
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        PublishQueue = device_cloud._core.store.PublishQueue
+
+        # Unbounded queue never drops
+        pub_queue = PublishQueue()
+        for value in range(5):
+            assert pub_queue.put(defs.PublishTelemetry("property_key",
+                                                       value)) == 0
+        assert pub_queue.qsize() == 5
+        assert pub_queue.get_nowait().value == 0
+        assert pub_queue.size == 0
+
+        # Drop oldest
+        pub_queue = PublishQueue(max_count=2)
+        future = defs.ReplyFuture()
+        pub = defs.PublishTelemetry("property_key", 0)
+        pub.future = future
+        pub_queue.put(pub)
+        pub_queue.put(defs.PublishTelemetry("property_key", 1))
+        assert pub_queue.put(defs.PublishTelemetry("property_key", 2)) == 1
+        assert future.wait(0) and not future.success()
+        assert [pub_queue.get_nowait().value for _ in range(2)] == [1, 2]
+        assert pub_queue.empty()
+
+        # Drop newest
+        pub_queue = PublishQueue(max_count=2,
+                                 policy=constants.PUBLISH_POLICY_DROP_NEWEST)
+        for value in range(3):
+            pub_queue.put(defs.PublishTelemetry("property_key", value))
+        assert pub_queue.dropped == 1
+        assert [pub_queue.get_nowait().value for _ in range(2)] == [0, 1]
+
+        # Coalesce replaces the pending publish with the same name in place
+        pub_queue = PublishQueue(max_count=2,
+                                 policy=constants.PUBLISH_POLICY_COALESCE)
+        pub_queue.put(defs.PublishTelemetry("property_a", 0))
+        pub_queue.put(defs.PublishTelemetry("property_b", 1))
+        assert pub_queue.put(defs.PublishTelemetry("property_a", 2)) == 1
+        pub = pub_queue.get_nowait()
+        assert pub.name == "property_a" and pub.value == 2
+        assert pub_queue.get_nowait().name == "property_b"
+
+        # Blocks of samples are never coalesced, the oldest is dropped
+        pub_queue = PublishQueue(max_count=2,
+                                 policy=constants.PUBLISH_POLICY_COALESCE)
+        pub_queue.put(defs.PublishTelemetryBatch("property_a", [0, 1],
+                                                 sample_interval=1))
+        pub_queue.put(defs.PublishTelemetry("property_b", 2))
+        pub_queue.put(defs.PublishTelemetryBatch("property_a", [3, 4],
+                                                 sample_interval=1))
+        assert pub_queue.get_nowait().name == "property_b"
+        assert pub_queue.get_nowait().values == [3, 4]
+
+        # Block waits for room, then drops the new publish
+        pub_queue = PublishQueue(max_count=1, timeout=0.1,
+                                 policy=constants.PUBLISH_POLICY_BLOCK)
+        pub_queue.put(defs.PublishTelemetry("property_key", 0))
+        assert pub_queue.put(defs.PublishTelemetry("property_key", 1)) == 1
+        assert pub_queue.qsize() == 1
+
+        # Unless told not to block, then it drops the oldest
+        pub_queue = PublishQueue(max_count=1,
+                                 policy=constants.PUBLISH_POLICY_BLOCK)
+        pub_queue.put(defs.PublishTelemetry("property_key", 0))
+        assert pub_queue.put(defs.PublishTelemetry("property_key", 1),
+                             block=False) == 1
+        assert pub_queue.get_nowait().value == 1
+
+        # Size limit
+        pub = defs.PublishTelemetry("property_key", 0)
+        size = device_cloud._core.store.publish_size(pub)
+        pub_queue = PublishQueue(max_size=size * 2)
+        for value in range(4):
+            pub_queue.put(defs.PublishTelemetry("property_key", value))
+        assert pub_queue.qsize() == 2
+        assert pub_queue.size <= size * 2
+
+class ClientTelemetryPublishFull(unittest.TestCase):
+    @mock.patch(builtin+".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a queue that holds a single publish
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "publish_queue_max_count":1,
+                  "publish_queue_policy":"drop_newest"}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        assert self.client.telemetry_publish("property_key", 1) == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", 2) == \
+            device_cloud.STATUS_FULL
+        assert self.client.attribute_publish("attribute_key", "value") == \
+            device_cloud.STATUS_FULL
+        assert self.client.alarm_publish("alarm_key", 1) == \
+            device_cloud.STATUS_FULL
+        assert self.client.handler.publish_queue.get().value == 1
+
+        # Shedding is reported even when the Cloud accepts the publish
+        future = device_cloud._core.defs.ReplyFuture()
+        future.set_reply({"success":True})
+        handler = self.client.handler
+        assert handler.publish_status(future, device_cloud.STATUS_FULL) == \
+            device_cloud.STATUS_FULL
+        assert handler.publish_status(future, device_cloud.STATUS_SUCCESS) == \
+            device_cloud.STATUS_SUCCESS
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishCoalesce(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "publish_coalesce":True}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        self.client.handler.state = device_cloud._core.constants.STATE_CONNECTED
+        mqtt = self.client.handler.mqtt
+
+        # Only the latest value of each attribute is sent
+        self.client.attribute_publish("attribute_a", "1")
+        self.client.attribute_publish("attribute_b", "2")
+        self.client.attribute_publish("attribute_a", "3")
+        self.client.alarm_publish("alarm_key", 1)
+        self.client.alarm_publish("alarm_key", 1)
+        self.client.alarm_publish("alarm_key", 2)
+        self.client.handler.handle_publish()
+        payloads = [json.loads(call[0][1])["1"]["params"]["data"]
+                    for call in mqtt.publish.call_args_list]
+        assert [item["state"] for item in payloads[0]] == [1, 2]
+        assert sorted((item["key"], item["value"])
+                      for item in payloads[1]) == [("attribute_a", "3"),
+                                                   ("attribute_b", "2")]
+
+        # Only duplicates within a flush are dropped, so a state the Cloud
+        # rejected is sent again by the next flush
+        mqtt.publish.reset_mock()
+        self.client.alarm_publish("alarm_key", 2)
+        self.client.alarm_publish("alarm_key", 2, republish=True)
+        self.client.handler.handle_publish()
+        assert mqtt.publish.call_count == 1
+        data = json.loads(mqtt.publish.call_args[0][1])["1"]["params"]["data"]
+        assert [item["state"] for item in data] == [2, 2]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class TelemetryFilterDeadband(unittest.TestCase):
+    def runTest(self):
+        TelemetryFilter = device_cloud._core.defs.TelemetryFilter
+
+        # Change only
+        telem_filter = TelemetryFilter()
+        assert telem_filter.accept(1, now=0)
+        assert not telem_filter.accept(1, now=1)
+        assert telem_filter.accept(2, now=2)
+        assert telem_filter.accept("on", now=3)
+        assert not telem_filter.accept("on", now=4)
+
+        # Absolute and percent deadbands must both be exceeded
+        telem_filter = TelemetryFilter(deadband=1, deadband_percent=10)
+        assert telem_filter.accept(20.0, now=0)
+        assert not telem_filter.accept(20.9, now=1)
+        assert not telem_filter.accept(21.5, now=2)
+        assert telem_filter.accept(22.5, now=3)
+
+        # Minimum interval
+        telem_filter = TelemetryFilter(min_interval=5)
+        assert telem_filter.accept(1, now=0)
+        assert not telem_filter.accept(2, now=4)
+        assert telem_filter.accept(3, now=5)
+
+        # Heartbeat republishes the latest sample
+        telem_filter = TelemetryFilter(deadband=10, max_interval=60)
+        assert telem_filter.heartbeat(now=0) == (False, None)
+        assert telem_filter.accept(1, now=0)
+        assert not telem_filter.accept(2, now=30)
+        assert telem_filter.heartbeat(now=59) == (False, None)
+        assert telem_filter.heartbeat(now=60) == (True, 2)
+        assert telem_filter.heartbeat(now=61) == (False, None)
+
+class ClientTelemetryFilter(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        assert self.client.telemetry_filter_register("property_key",
+                                                     deadband=-1) == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.telemetry_filter_register("property_key",
+                                                     deadband=0.5) == \
+            device_cloud.STATUS_SUCCESS
+
+        # Samples within the deadband never reach the publish queue
+        for value in [1.0, 1.2, 1.4, 2.0, 2.1]:
+            assert self.client.telemetry_publish("property_key", value) == \
+                device_cloud.STATUS_SUCCESS
+        assert [handler.publish_queue.get().value
+                for _ in range(handler.publish_queue.qsize())] == [1.0, 2.0]
+
+        # Other keys are not filtered
+        self.client.telemetry_publish("other_key", 1.0)
+        self.client.telemetry_publish("other_key", 1.0)
+        assert handler.publish_queue.qsize() == 2
+
+        assert self.client.telemetry_filter_deregister("property_key") == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_filter_deregister("property_key") == \
+            device_cloud.STATUS_NOT_FOUND
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class TelemetryWindowResults(unittest.TestCase):
+    def runTest(self):
+        TelemetryWindow = device_cloud._core.defs.TelemetryWindow
+
+        telem_window = TelemetryWindow(60, ["min", "max", "mean", "count",
+                                            "last"], [50, 100], start=0)
+        for value in [4, 1, 3, 2]:
+            telem_window.add(value)
+        assert not telem_window.expired(now=59)
+        assert telem_window.expired(now=60)
+        assert telem_window.results() == [("min", 1), ("max", 4),
+                                          ("mean", 2.5), ("count", 4),
+                                          ("last", 2), ("p50", 2),
+                                          ("p100", 4)]
+
+        # The percentile sample is bounded
+        size = device_cloud._core.constants.AGGREGATE_RESERVOIR_SIZE
+        telem_window = TelemetryWindow(60, ["count"], [50])
+        for value in range(size * 4):
+            telem_window.add(value)
+        assert len(telem_window.reservoir) == size
+        assert telem_window.results()[0] == ("count", size * 4)
+
+class ClientTelemetryAggregate(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "telemetry_aggregate_stats":["min", "max", "count"]}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Aggregated samples are held in a window, not queued
+        for value in range(10):
+            assert self.client.telemetry_publish("property_key", value,
+                                                 aggregate=True) == \
+                device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", "text",
+                                             aggregate=True) == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert handler.publish_queue.empty()
+        assert handler.telemetry_windows["property_key"].length == 60
+
+        # Nothing is published until the window ends
+        handler.check_telemetry_windows()
+        assert handler.publish_queue.empty()
+        handler.telemetry_windows["property_key"].start -= 60
+        handler.check_telemetry_windows()
+        published = [(pub.name, pub.value) for pub in
+                     [handler.publish_queue.get() for _ in range(3)]]
+        assert published == [("property_key.min", 0),
+                             ("property_key.max", 9),
+                             ("property_key.count", 10)]
+        assert not handler.telemetry_windows
+
+        # Windows can have their own length, and are flushed on demand
+        self.client.telemetry_publish("other_key", 1.5, aggregate=5)
+        assert handler.telemetry_windows["other_key"].length == 5
+        handler.check_telemetry_windows(flush=True)
+        assert handler.publish_queue.qsize() == 3
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryAggregateFullQueue(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a full queue that blocks forever
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "publish_queue_max_count":1,
+                  "publish_queue_policy":"block",
+                  "telemetry_aggregate_stats":["count"]}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        self.client.telemetry_publish("property_key", 0)
+        self.client.telemetry_publish("aggregate_key", 1, aggregate=True)
+        self.client.telemetry_filter_register("filtered_key", max_interval=1)
+        assert handler.filter_telemetry("filtered_key", 2)
+        handler.telemetry_filters["filtered_key"].last_sent -= 2
+
+        # The main loop publishes ended windows and heartbeats without
+        # waiting for room, dropping the oldest publishes instead
+        def check():
+            handler.telemetry_windows["aggregate_key"].start -= 60
+            handler.check_telemetry_windows()
+            handler.check_telemetry_heartbeats()
+        thread = threading.Thread(target=check)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert handler.publish_queue.qsize() == 1
+        assert handler.publish_queue.get_nowait().name == "filtered_key"
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryPublishMany(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        self.client.handler.state = device_cloud._core.constants.STATE_CONNECTED
+        mqtt = self.client.handler.mqtt
+
+        assert self.client.telemetry_publish_many("property_key", [1, 2],
+                                                  [0.0]) == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.telemetry_publish_many("property_key", []) == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish_many("property_key", [1, 2]) == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.handler.publish_queue.empty()
+
+        # Without timestamps, samples are spaced by sample_interval, the last
+        # at the current time
+        assert self.client.telemetry_publish_many("property_key", [1, 2, 3],
+                                                  sample_interval=0.001) == \
+            device_cloud.STATUS_SUCCESS
+        telem = self.client.handler.publish_queue.get()
+        assert telem.timestamps == [telem.timestamp - 2, telem.timestamp - 1,
+                                    telem.timestamp]
+
+        # A block is queued as one publish and sent with single samples
+        timestamps = [1500000000.0, 1500000000.001, 1500000001.5]
+        assert self.client.telemetry_publish_many("property_key", [1, 2, 3],
+                                                  timestamps) == \
+            device_cloud.STATUS_SUCCESS
+        self.client.telemetry_publish("property_key", 4)
+        assert self.client.handler.publish_queue.qsize() == 2
+        self.client.handler.handle_publish()
+        assert mqtt.publish.call_count == 1
+        jload = json.loads(mqtt.publish.call_args[0][1])
+        assert jload["1"]["command"] == "property.batch"
+        data = jload["1"]["params"]["data"]
+        assert [item["value"] for item in data] == [1, 2, 3, 4]
+        assert [item["ts"] for item in data[:3]] == [
+            "2017-07-14T02:40:00.000000Z", "2017-07-14T02:40:00.001000Z",
+            "2017-07-14T02:40:01.500000Z"]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class PublishSlots(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+
+        pub = defs.PublishTelemetry("property_key", 1.5, corr_id="id")
+        assert not hasattr(pub, "__dict__")
+        assert pub.type == "PublishTelemetry"
+        self.assertRaises(AttributeError, setattr, pub, "other", 1)
+
+        fields = pub.fields()
+        assert sorted(fields) == ["aggregate", "corr_id", "name",
+                                  "thing_key", "timestamp", "value"]
+        copy = defs.PublishTelemetry.from_fields(fields)
+        assert copy.fields() == fields
+        assert copy.future is None
+
+        pub = defs.PublishLocation(11.11, 22.22, heading=90)
+        assert defs.PublishLocation.from_fields(pub.fields()).heading == 90
+
+class PublishTimestampFormat(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        from datetime import datetime
+
+        # Publishes keep epoch milliseconds until they are sent
+        pub = defs.PublishAttribute("attribute_key", "value")
+        assert isinstance(pub.timestamp, int)
+
+        assert defs.format_timestamp(1500000000123) == \
+            "2017-07-14T02:40:00.123000Z"
+        assert defs.format_timestamp(1500000000123) is \
+            defs.format_timestamp(1500000000123)
+        assert defs.format_timestamp("2017-07-14T02:40:00.123000Z") == \
+            "2017-07-14T02:40:00.123000Z"
+        assert defs.format_timestamp(None) is None
+
+        assert defs.to_epoch_ms(1500000000.5) == 1500000000500
+        assert defs.to_epoch_ms(datetime(2017, 7, 14, 2, 40, 0, 123456)) == \
+            1500000000123
+        assert defs.to_epoch_ms("text") == "text"
+
+        pub = defs.PublishTelemetry("property_key", 1,
+                                    timestamp=datetime(2017, 7, 14, 2, 40))
+        assert defs.format_timestamp(pub.timestamp) == \
+            "2017-07-14T02:40:00.000000Z"
+
+class CodecRoundTrip(unittest.TestCase):
+    def runTest(self):
+        codec = device_cloud._core.codec
+        request = {"1":{"command":"property.publish",
+                        "params":{"key":"property_key", "value":0.1 + 0.2}}}
+
+        # Whichever library is used, payloads are compact bytes
+        payload = codec.dumps(request)
+        assert isinstance(payload, bytes)
+        assert b" " not in payload
+        assert codec.loads(payload) == request
+        assert codec.loads(payload.decode()) == request
+
+        # Standard json module fallback
+        with mock.patch.object(codec, "orjson", None), \
+                mock.patch.object(codec, "ujson", None):
+            payload = codec.dumps(request)
+            assert isinstance(payload, bytes)
+            assert json.loads(payload.decode()) == request
+            assert codec.loads(payload) == request
+
+class TR50RequestWriter(unittest.TestCase):
+    def runTest(self):
+        tr50 = device_cloud._core.tr50
+
+        # Without a limit everything is written to one request
+        writer = tr50.RequestWriter()
+        writer.add_command(tr50.create_diag_ping(), "ping")
+        writer.begin_batch("property.batch", {"thingKey":"thing"}, "batch")
+        for value in range(3):
+            writer.add_item(tr50.encode_property_batch_item(
+                "property_key", value, "2017-07-14T02:40:00.000000Z"))
+        requests = writer.finish()
+        assert len(requests) == 1
+        payload, parts = requests[0]
+        assert [part[:2] for part in parts] == [["ping", 1], ["batch", 3]]
+        jload = json.loads(payload.decode())
+        assert jload["1"] == tr50.create_diag_ping()
+        assert jload["2"]["params"]["thingKey"] == "thing"
+        assert [item["value"] for item in jload["2"]["params"]["data"]] == \
+            [0, 1, 2]
+        assert "corrid" not in jload["2"]["params"]["data"][0]
+
+        # Batches continue in a new request when the limit is reached, and
+        # futures stay with the part holding their item
+        futures = [device_cloud._core.defs.ReplyFuture() for _ in range(20)]
+        writer = tr50.RequestWriter(300)
+        writer.begin_batch("property.batch", {"thingKey":"thing"}, "batch")
+        for value in range(20):
+            writer.add_item(tr50.encode_property_batch_item(
+                "property_key", value, "2017-07-14T02:40:00.000000Z"),
+                            futures[value])
+        requests = writer.finish()
+        assert len(requests) > 1
+        values = []
+        for payload, parts in requests:
+            assert len(payload) <= 300
+            data = json.loads(payload.decode())["1"]["params"]["data"]
+            assert len(parts) == 1 and parts[0][1] == len(data)
+            assert parts[0][2] == [futures[item["value"]] for item in data]
+            values.extend(item["value"] for item in data)
+        assert values == list(range(20))
+        assert writer.finish() == []
+
+class HandleSendLinger(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "send_linger":60}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Commands wait to be combined
+        assert self.client.action_progress_update("request-id", "Step 1") == \
+            device_cloud.STATUS_SUCCESS
+        self.client.action_progress_update("request-id", "Step 2")
+        self.client.action_acknowledge("request-id", 0, "Done")
+        assert mqtt.publish.call_count == 0
+        assert handler.send_timer is not None
+
+        # And are sent in one request
+        assert handler.flush_sends() == device_cloud.STATUS_SUCCESS
+        assert handler.send_timer is None
+        assert mqtt.publish.call_count == 1
+        jload = json.loads(mqtt.publish.call_args[0][1])
+        assert [jload[str(num)]["command"] for num in range(1, 4)] == \
+            ["mailbox.update", "mailbox.update", "mailbox.ack"]
+        assert len(handler.reply_tracker) == 3
+
+        # Nothing left to send
+        handler.flush_sends()
+        assert mqtt.publish.call_count == 1
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientEventPublishLimits(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "log_max_batch":2,
+                  "log_rate_interval":60}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        self.client.handler.state = device_cloud._core.constants.STATE_CONNECTED
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Repeated events are dropped within the interval
+        for _ in range(3):
+            assert self.client.event_publish("Same Message") == \
+                device_cloud.STATUS_SUCCESS
+        for num in range(4):
+            self.client.event_publish("Message {}".format(num))
+        assert handler.publish_queue.qsize() == 5
+
+        # Bursts are split into requests of at most log_max_batch events
+        handler.handle_publish()
+        counts = [len(json.loads(call[0][1])) for call in
+                  mqtt.publish.call_args_list]
+        assert counts == [2, 2, 1]
+
+        # Once the interval passes the event is published with a count of
+        # what was dropped
+        last_sent, dropped = handler.log_history["Same Message"]
+        assert dropped == 2
+        handler.log_history["Same Message"] = (last_sent - 60, dropped)
+        self.client.event_publish("Same Message")
+        assert handler.publish_queue.get().message == \
+            "Same Message (repeated 2 more times)"
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleReplyExpiry(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "reply_expiry":30}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        defs = device_cloud._core.defs
+
+        # Send a download request and an attribute, and reply to the attribute
+        transfer = defs.FileTransfer("file", "/tmp/file", self.client)
+        command = device_cloud._core.tr50.create_file_get(handler.config.key,
+                                                          "file")
+        handler.send(defs.OutMessage(command, "Download file", data=transfer))
+        future = defs.ReplyFuture()
+        command = device_cloud._core.tr50.create_attribute_publish(
+            handler.config.key, "attribute_key", "value")
+        handler.send(defs.OutMessage(command, "Attribute", futures=[future]))
+        assert len(handler.reply_tracker) == 2
+
+        # Only the command name and what it was for are kept once sent
+        message = handler.reply_tracker.topics["0002"]["1"]
+        assert message.command == {"command":"attribute.publish",
+                                   "params":{"thingKey":handler.config.key,
+                                             "key":"attribute_key"}}
+
+        handler.handle_message(defs.Message("reply/0002",
+                                            {"1":{"success":True}}))
+        assert future.success()
+
+        # Nothing is due yet
+        assert handler.expire_replies() == 0
+        assert transfer.status is None
+
+        # Overdue replies stop being tracked and fail their transfer
+        now = device_cloud._core.defs.monotonic() + 30
+        expired = handler.reply_tracker.pop_expired(now)
+        assert [msg.out_id for msg in expired] == ["0001-1"]
+        assert len(handler.reply_tracker) == 0
+        assert handler.reply_tracker.deadlines == []
+        handler.fail_unreplied(expired[0], device_cloud.STATUS_TIMED_OUT)
+        assert transfer.status == device_cloud.STATUS_TIMED_OUT
+        assert transfer.wait(0)
+
+        # A late reply is ignored
+        handler.handle_message(defs.Message("reply/0001",
+                                            {"1":{"success":True}}))
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class OutTrackerTopics(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        tracker = defs.OutTracker(topic_max=3)
+
+        # Topic numbers wrap around and skip any waiting for replies
+        assert tracker.next_topic() == "1"
+        messages = [defs.OutMessage({"command":"diag.ping"}, "Ping")
+                    for _ in range(2)]
+        tracker.add_request("2", messages)
+        assert messages[1].out_id == "2-2"
+        assert len(tracker) == 2
+        assert tracker.next_topic() == "3"
+        assert tracker.next_topic() == "1"
+        assert tracker.next_topic() == "3"
+
+        # Replies are matched by topic and command number
+        assert tracker.pop_messages("2", ["2"]) == ([("2", messages[1])], [])
+        assert tracker.pop_messages("2", ["2", "1"]) == \
+            ([("1", messages[0])], ["2"])
+        assert len(tracker) == 0
+        assert tracker.topics == {}
+
+        # No topic is handed out while all are in use
+        for topic_num in ["1", "2", "3"]:
+            tracker.add_request(topic_num, [defs.OutMessage({}, "Message")])
+        assert tracker.next_topic() is None
+        assert sorted(out_id for out_id, _ in tracker.items()) == \
+            ["1-1", "2-1", "3-1"]
+
+        # Default topics stay four digits
+        assert defs.OutTracker().next_topic() == "0001"
+
+class HandleReplyCallbacks(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        defs = device_cloud._core.defs
+
+        replies = []
+        def callback(client, reply, user_data):
+            replies.append((reply, user_data))
+
+        # Replies the library handles itself cannot be taken over
+        assert self.client.reply_register_callback("diag.ping", callback) == \
+               device_cloud.STATUS_EXISTS
+        assert self.client.reply_deregister("diag.ping") == \
+               device_cloud.STATUS_NOT_FOUND
+        assert self.client.reply_register_callback("diag.echo", callback,
+                                                   "data") == \
+               device_cloud.STATUS_SUCCESS
+        assert self.client.command_send("diag.echo", {"a":1}) == \
+               device_cloud.STATUS_SUCCESS
+        assert handler.reply_tracker.topics["0001"]["1"].command == \
+               {"command":"diag.echo"}
+        handler.handle_message(defs.Message("reply/0001",
+                                            {"1":{"success":True,
+                                                  "params":{"a":1}}}))
+        assert replies == [({"success":True, "params":{"a":1}}, "data")]
+
+        # Every command of a large request is handled from one reply
+        messages = [defs.OutMessage({"command":"diag.echo"}, "Echo")
+                    for _ in range(500)]
+        handler.send(messages)
+        assert len(handler.reply_tracker) == 500
+        reply = dict((str(num), {"success":True}) for num in range(1, 501))
+        reply["501"] = {"success":True}
+        handler.handle_message(defs.Message("reply/0002", reply))
+        assert len(handler.reply_tracker) == 0
+        assert handler.reply_tracker.topics == {}
+        assert len(replies) == 501
+
+        assert self.client.reply_deregister("diag.echo") == \
+               device_cloud.STATUS_SUCCESS
+        assert self.client.reply_deregister("diag.echo") == \
+               device_cloud.STATUS_NOT_FOUND
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class WorkQueueLanes(unittest.TestCase):
+    def runTest(self):
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        work_queue = device_cloud._core.store.WorkQueue()
+
+        for work_type in (constants.WORK_DOWNLOAD, constants.WORK_PUBLISH,
+                          constants.WORK_ACTION, constants.WORK_MESSAGE,
+                          constants.WORK_UPLOAD, constants.WORK_MESSAGE):
+            work_queue.put(defs.Work(work_type, None))
+        assert work_queue.qsize() == 6
+
+        # Highest priority first, in order within a lane
+        order = [work_queue.get().type for _ in range(6)]
+        assert order == [constants.WORK_MESSAGE, constants.WORK_MESSAGE,
+                         constants.WORK_ACTION, constants.WORK_PUBLISH,
+                         constants.WORK_DOWNLOAD, constants.WORK_UPLOAD]
+        assert work_queue.empty()
+        self.assertRaises(device_cloud._core.store.queue.Empty,
+                          work_queue.get, timeout=0)
+
+class HandleWorkTransferQueue(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        assert handler.config.transfer_thread_count == 1
+        assert handler.transfer_queue is not handler.work_queue
+
+        def callback(client, params):
+            return device_cloud.STATUS_SUCCESS
+        self.client.action_register_callback("quick", callback)
+        self.client.action_register_callback("slow", callback,
+                                             long_running=True)
+
+        # File transfers and long running actions do not wait behind other work
+        transfer = defs.FileTransfer("file", "/tmp/file", self.client)
+        handler.queue_work(defs.Work(constants.WORK_DOWNLOAD, transfer))
+        handler.queue_work(defs.Work(constants.WORK_ACTION,
+                                     defs.ActionRequest("1", "slow", None)))
+        handler.queue_work(defs.Work(constants.WORK_ACTION,
+                                     defs.ActionRequest("2", "quick", None)))
+        handler.queue_work(defs.Work(constants.WORK_ACTION,
+                                     defs.ActionRequest("3", "unknown", None)))
+        assert handler.transfer_queue.qsize() == 1
+        assert handler.long_action_queue.qsize() == 1
+        assert handler.long_action_queue is not handler.transfer_queue
+        assert handler.work_queue.qsize() == 2
+        assert handler.work_queue.get().data.name == "quick"
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleLongActionBlockingDownload(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("device_cloud._core.defs.inspect")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_inspect, mock_sleep, mock_exists,
+                mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_inspect.getargspec.return_value.args.__len__.return_value = 2
+        mock_inspect.ismethod.return_value = False
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+
+        # The Cloud replies to the file.get straight away, and the download
+        # succeeds once a transfer worker thread runs it
+        def send(messages, payload=None):
+            if messages.command["command"] == "file.get":
+                handler.queue_work(defs.Work(constants.WORK_DOWNLOAD,
+                                             messages.data))
+            return constants.STATUS_SUCCESS
+        def handle_file_download(transfer):
+            transfer.status = constants.STATUS_SUCCESS
+
+        results = []
+        done = threading.Event()
+        def callback(client, params):
+            results.append(client.file_download("file", "/tmp/file",
+                                                blocking=True, timeout=5))
+            done.set()
+            return device_cloud.STATUS_SUCCESS
+        self.client.action_register_callback("ota", callback,
+                                             long_running=True)
+
+        with mock.patch.object(handler, "send", side_effect=send), \
+             mock.patch.object(handler, "handle_file_download",
+                               side_effect=handle_file_download):
+            handler.to_quit = False
+            handler.start_worker(handler.transfer_queue)
+            handler.start_worker(handler.long_action_queue)
+            try:
+                # A long running action waiting on a download does not hold
+                # the thread that runs the download
+                handler.queue_work(defs.Work(constants.WORK_ACTION,
+                                             defs.ActionRequest("1", "ota",
+                                                                None)))
+                assert done.wait(10)
+                assert results == [device_cloud.STATUS_SUCCESS]
+            finally:
+                handler.to_quit = True
+                for thread in handler.worker_threads:
+                    thread.join()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleWorkerScaling(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "thread_count_max":1,
+                  "work_wait_target":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+
+        # Nothing waiting, no worker thread needed
+        assert handler.scale_workers() is False
+        assert self.client.work_status()["workers"] == 0
+
+        # Work waiting longer than the target starts worker threads up to
+        # thread_count_max
+        handler.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+        handler.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+        with mock.patch.object(handler, "start_worker") as mock_start:
+            assert handler.scale_workers() is True
+            mock_start.assert_called_once_with()
+        handler.worker_count = 1
+        assert handler.scale_workers() is False
+        status = self.client.work_status()
+        assert status["workers"] == 1
+        assert status["queued"] == 2
+        assert status["queue_wait"] >= 0
+
+        # An idle extra worker thread stops, but not below thread_count
+        handler.worker_threads.append(threading.current_thread())
+        assert handler.stop_worker() is True
+        assert handler.worker_count == 0
+        assert handler.worker_threads == []
+        assert handler.stop_worker() is False
+
+        handler.work_queue.get()
+        assert handler.work_queue.last_wait >= 0
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublisherThread(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        published = threading.Event()
+        publish_threads = []
+        def handle_publish():
+            with handler.publish_lock:
+                handler.publish_pending = False
+            publish_threads.append(threading.current_thread())
+            published.set()
+
+        with mock.patch.object(handler, "handle_publish",
+                               side_effect=handle_publish):
+            handler.to_quit = False
+            handler.start_publisher()
+            try:
+                # Publishes are handed to the publisher thread instead of the
+                # work queue
+                assert self.client.telemetry_publish("key", 1) == \
+                       device_cloud.STATUS_SUCCESS
+                assert handler.schedule_publish() == \
+                       device_cloud.STATUS_SUCCESS
+                assert published.wait(5)
+                assert handler.work_queue.empty()
+
+                # Publish work queued before the publisher started is handed
+                # to it rather than run by a worker thread
+                published.clear()
+                assert handler.handle_publish_work() == \
+                       device_cloud.STATUS_SUCCESS
+                assert published.wait(5)
+                assert publish_threads == [handler.publish_thread] * 2
+            finally:
+                handler.to_quit = True
+                handler.publish_thread.join()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+@unittest.skipIf(sys.version_info < (3, 5), "AsyncClient requires Python 3.5")
+class AsyncClientAwaitables(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("device_cloud._core.defs.inspect")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_inspect, mock_sleep, mock_exists,
+                mock_open):
+        import asyncio
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True] * 2
+        read_strings = [json.dumps(self.config_args), helpers.uuid] * 2
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_inspect.getargspec.return_value.args.__len__.return_value = 2
+        mock_inspect.ismethod.return_value = False
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client. Without a loop, it takes the running loop.
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        kwargs = {"loop_time":1, "thread_count":0}
+        created = loop.create_future()
+        loop.call_soon(lambda: created.set_result(
+            device_cloud.AsyncClient("testing-client", kwargs)))
+        self.client = loop.run_until_complete(created)
+        assert self.client.loop is loop
+        self.client.initialize()
+        handler = self.client.handler
+        defs = device_cloud._core.defs
+
+        # Requests are sent from the client's send thread, never the loop's
+        send_threads = []
+        send = handler.send
+        def record_send(*args, **kwargs):
+            send_threads.append(threading.current_thread())
+            return send(*args, **kwargs)
+        handler.send = record_send
+
+        def reply_from_thread(topic, reply):
+            # Reply once the request has been sent
+            self.client.executor.submit(int).result()
+            message = defs.Message(topic, reply)
+            threading.Thread(target=handler.handle_message,
+                             args=(message,)).start()
+
+        # Publishes without cloud_response are resolved straight away
+        future = self.client.telemetry_publish("key", 1)
+        assert loop.run_until_complete(future) == device_cloud.STATUS_SUCCESS
+        handler.publish_queue.get()
+
+        # Publishes with cloud_response are resolved by the reply
+        future = self.client.telemetry_publish("key", 2, cloud_response=True)
+        assert not future.done()
+        pub = handler.publish_queue.get()
+        threading.Thread(target=pub.future.set_reply,
+                         args=({"success":True},)).start()
+        assert loop.run_until_complete(future) == device_cloud.STATUS_SUCCESS
+
+        # Current values are resolved with (status, value, timestamp)
+        future = self.client.telemetry_read_last_sample("key")
+        reply_from_thread("reply/0001",
+                          {"1":{"success":True,
+                                "params":{"value":2, "ts":"timestamp"}}})
+        assert loop.run_until_complete(future) == \
+               (device_cloud.STATUS_SUCCESS, 2, "timestamp")
+
+        # File transfers are resolved once they end, even if they fail
+        future = self.client.file_download("file", "/tmp/file")
+        reply_from_thread("reply/0002", {"1":{"success":False,
+                                              "errorCodes":[-90008]}})
+        assert loop.run_until_complete(future) == device_cloud.STATUS_NOT_FOUND
+        assert len(send_threads) == 2
+        assert threading.current_thread() not in send_threads
+
+        # A directory upload takes the highest status of its files, and is
+        # cancelled or fails along with any of them
+        for outcome in ["result", "cancel", "exception"]:
+            transfers = [loop.create_future() for _ in range(2)]
+            with mock.patch("os.path.isdir", return_value=True), \
+                 mock.patch("os.listdir", return_value=["a", "b"]), \
+                 mock.patch.object(self.client, "_request_transfer",
+                                   side_effect=transfers):
+                future = self.client.file_upload("/tmp/dir")
+            transfers[0].set_result(device_cloud.STATUS_SUCCESS)
+            if outcome == "result":
+                transfers[1].set_result(device_cloud.STATUS_NOT_FOUND)
+                assert loop.run_until_complete(future) == \
+                       device_cloud.STATUS_NOT_FOUND
+            elif outcome == "cancel":
+                transfers[1].cancel()
+                self.assertRaises(asyncio.CancelledError,
+                                  loop.run_until_complete, future)
+            else:
+                transfers[1].set_exception(IOError("failed"))
+                self.assertRaises(IOError, loop.run_until_complete, future)
+
+        # Coroutine actions are reported as invoked, then acknowledged with
+        # their result once they return
+        def callback(client, params):
+            return asyncio.sleep(0, result=(device_cloud.STATUS_SUCCESS,
+                                            "done"))
+        action = device_cloud._core.async_client.AsyncAction(
+            "async_action", callback, self.client, loop)
+        assert handler.action_register(action) == device_cloud.STATUS_SUCCESS
+        ack_threads = []
+        def queue_send(message):
+            ack_threads.append(threading.current_thread())
+        with mock.patch.object(handler, "queue_send",
+                               side_effect=queue_send) as mock_send:
+            request = defs.ActionRequest("1", "async_action", {})
+            loop.run_until_complete(loop.run_in_executor(
+                None, handler.handle_action, request))
+            for _ in range(10):
+                if mock_send.call_count == 2:
+                    break
+                loop.run_until_complete(asyncio.sleep(0.01))
+            commands = [call[0][0].command for call in
+                        mock_send.call_args_list]
+        assert commands[0]["command"] == "mailbox.update"
+        assert commands[1]["command"] == "mailbox.ack"
+        assert commands[1]["params"]["errorMessage"] == "done"
+        assert threading.current_thread() not in ack_threads
+
+        # Disconnecting shuts down the send thread, and a new one is used
+        # after reconnecting
+        executor = self.client.executor
+        with mock.patch.object(device_cloud.Client, "disconnect",
+                               return_value=device_cloud.STATUS_SUCCESS):
+            assert loop.run_until_complete(self.client.disconnect()) == \
+                   device_cloud.STATUS_SUCCESS
+        assert self.client.executor is not executor
+        self.assertRaises(RuntimeError, executor.submit, int)
+        assert self.client.executor.submit(int).result() == 0
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleGatewayChildren(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "publish_combine":True}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.state = device_cloud._core.constants.STATE_CONNECTED
+        defs = device_cloud._core.defs
+
+        # Publishes for child devices are batched per thing key
+        self.client.telemetry_publish("temp", 1)
+        self.client.telemetry_publish("temp", 2, thing_key="child-1")
+        self.client.telemetry_publish("temp", 3, thing_key="child-2")
+        self.client.telemetry_publish("temp", 4, thing_key="child-1")
+        self.client.event_publish("event", thing_key="child-2")
+        assert self.client.telemetry_publish("temp", 5, aggregate=True,
+                                             thing_key="child-1") == \
+               device_cloud.STATUS_BAD_PARAMETER
+        handler.handle_publish()
+        payload = json.loads(handler.mqtt.publish.call_args[0][1])
+        commands = [payload[num] for num in sorted(payload, key=int)]
+        assert [cmd["command"] for cmd in commands] == \
+               ["log.publish", "property.batch", "property.batch",
+                "property.batch"]
+        assert commands[0]["params"]["thingKey"] == "child-2"
+        assert commands[1]["params"]["thingKey"] == handler.config.key
+        things = dict((cmd["params"]["thingKey"],
+                       [item["value"] for item in cmd["params"]["data"]])
+                      for cmd in commands[1:])
+        assert things == {handler.config.key:[1], "child-1":[2, 4],
+                          "child-2":[3]}
+
+        # Actions for a child go to its own action, or the shared one
+        requests = []
+        def child_action(client, params, user_data, request):
+            requests.append(("child", request.thing_key))
+        def shared_action(client, params, user_data, request):
+            requests.append(("shared", request.thing_key))
+        self.client.action_register_callback("act", shared_action)
+        self.client.action_register_callback("act", child_action,
+                                             thing_key="child-1")
+        assert self.client.child_register("child-1") == \
+               device_cloud.STATUS_EXISTS
+        assert self.client.child_register("child-2") == \
+               device_cloud.STATUS_SUCCESS
+        callbacks = handler.callbacks
+        action = callbacks.find_action(defs.ActionRequest("1", "act", None,
+                                                          "child-1"))
+        assert action.callback is child_action
+        action = callbacks.find_action(defs.ActionRequest("2", "act", None,
+                                                          "child-2"))
+        assert action.callback is shared_action
+
+        # Registering a child while connected checks its mailbox
+        work = [handler.work_queue.get() for _ in range(2)]
+        assert [(item.type, item.data) for item in work] == \
+               [(device_cloud._core.constants.WORK_MAILBOX, ["child-1"]),
+                (device_cloud._core.constants.WORK_MAILBOX, ["child-2"])]
+        assert handler.work_queue.empty()
+
+        # Mailbox activity is only for the gateway's own mailbox
+        handler.handle_message(defs.Message("notify/mailbox_activity", {}))
+        payload = json.loads(handler.mqtt.publish.call_args[0][1])
+        assert list(payload) == ["1"]
+        assert "thingKey" not in payload["1"]["params"]
+
+        # Child mailboxes are checked on connecting and every
+        # child_mailbox_interval seconds
+        assert handler.schedule_child_check() is True
+        assert handler.schedule_child_check() is False
+        handler.child_check_time -= handler.config.child_mailbox_interval
+        assert handler.schedule_child_check() is True
+        work = handler.work_queue.get()
+        assert work.type == device_cloud._core.constants.WORK_MAILBOX
+        assert work.data is None
+        handler.work_queue.get()
+
+        # Checks are split to fit publish_max_payload
+        handler.config.publish_max_payload = 120
+        calls = handler.mqtt.publish.call_count
+        handler.check_child_mailboxes()
+        assert handler.mqtt.publish.call_count == calls + 2
+        handler.config.publish_max_payload = 0
+        handler.check_child_mailboxes()
+        payload = json.loads(handler.mqtt.publish.call_args[0][1])
+        assert [payload[num]["params"].get("thingKey")
+                for num in sorted(payload, key=int)] == ["child-1", "child-2"]
+        topic = handler.mqtt.publish.call_args[0][0][len("api/"):]
+        mail = {"command":"method.exec", "id":"mail",
+                "params":{"method":"act"}}
+        reply = dict((num, {"success":True, "params":{"messages":[mail]}})
+                     for num in ("1", "2"))
+        handler.handle_message(defs.Message("reply/" + topic, reply))
+        work = [handler.work_queue.get().data for _ in range(2)]
+        assert sorted(request.thing_key for request in work) == \
+               ["child-1", "child-2"]
+
+        assert self.client.child_deregister("child-2") == \
+               device_cloud.STATUS_SUCCESS
+        assert self.client.child_deregister("child-2") == \
+               device_cloud.STATUS_NOT_FOUND
+        assert self.client.action_deregister("act", thing_key="child-1") == \
+               device_cloud.STATUS_SUCCESS
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()